@@ -0,0 +1,91 @@
+import hashlib
+import re
+import sys
+import numpy as np
+import unidecode
+
+# Offline index of the addresses of some cities, built from overpass and saved as a .npy file
+# of records sorted by the hash of their normalized (city, street, housenumber) key.
+# It is loaded memory-mapped so it costs nothing until addresses are looked up,
+# and a lookup is a binary search.
+
+RECORD_TYPE = np.dtype([('key', '<u8'), ('lat', '<f8'), ('lon', '<f8'), ('id', '<i8')])
+
+# same tolerance as the regexes of get_street_location: no accents nor case,
+# abbreviations of boulevard expanded and only the significant words
+def normalize_nouns(text):
+    nouns = re.split("-|'| |,", unidecode.unidecode(text).lower())
+    nouns = ['boulevard' if noun in ['bd', 'bv'] else noun for noun in nouns]
+    return ' '.join(noun for noun in nouns if len(noun) > 3 or noun == 'rue')
+
+def get_address_key(n, way, city):
+    return normalize_nouns(city) + '|' + normalize_nouns(way) + '|' + str(n).strip().lower()
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+class AddressIndex:
+    def __init__(self, records):
+        self.records = records
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode='r'))
+
+    def lookup(self, n, way, city):
+        key = hash_key(get_address_key(n, way, city))
+        i = np.searchsorted(self.records['key'], key)
+        if i == len(self.records) or self.records['key'][i] != key:
+            return None
+        record = self.records[i]
+        return {'type': 'node', 'id': int(record['id']), 'lat': float(record['lat']), 'lon': float(record['lon'])}
+
+def get_housenumbers(tags):
+    return [number for number in tags.get('addr:housenumber', '').split(';') if number.strip()]
+
+# downloads the addresses of the city: the nodes of its associatedStreet relations,
+# like get_street_location, and the nodes with an addr:street tag
+def get_city_addresses(city):
+    # overpass_api loads the index, it is only needed here to build it
+    import overpass_api
+    city_regex = '.*'.join(overpass_api.prepare_noun_for_regex(noun)
+                           for noun in re.split("-|'| ", city.lower()) if len(noun) > 3)
+    addresses_query = f"""
+    [out:json];
+    area[name~"{city_regex}"][postal_code]->.city;
+    rel(area.city)[type=associatedStreet][name]->.streets;
+    .streets out;
+    node(r.streets)["addr:housenumber"];
+    out;
+    node(area.city)["addr:housenumber"]["addr:street"];
+    out;
+    """
+    elements = overpass_api.query_overpass(addresses_query)['elements']
+    street_of_node = {}
+    for element in elements:
+        if element['type'] == 'relation':
+            for member in element['members']:
+                if member['type'] == 'node':
+                    street_of_node[member['ref']] = element['tags']['name']
+    for element in elements:
+        if element['type'] != 'node':
+            continue
+        street = element['tags'].get('addr:street', street_of_node.get(element['id']))
+        if street is None:
+            continue
+        for number in get_housenumbers(element['tags']):
+            yield get_address_key(number, street, city), element
+
+def build_address_index(cities, path):
+    records = {}
+    for city in cities:
+        for key, node in get_city_addresses(city):
+            records[hash_key(key)] = (node['lat'], node['lon'], node['id'])
+    array = np.array([(key, lat, lon, node_id) for key, (lat, lon, node_id) in records.items()], dtype=RECORD_TYPE)
+    array.sort(order='key')
+    np.save(path, array)
+    print(f'{len(array)} addresses saved to {path}')
+
+# python address_index.py address_index.npy paris dunkerque
+if __name__ == "__main__":
+    build_address_index(sys.argv[2:], sys.argv[1])
@@ -1,48 +1,128 @@
 import os
-from flask import Flask, request
-from twilio.rest import Client
-from twilio.twiml.messaging_response import MessagingResponse
+import threading
+from flask import Flask, request, jsonify
 
-from weather import get_rain_response
-from routing import get_walking_itinerary_response
+from jobs import make_job_queue, JobQueueFull
+from instrumentation import metrics, trace_request
+from warmup import is_ready, start_warm_up
+import constants
+
+# the weather, routing and sms modules, with requests and numpy, are imported by the
+# first job needing them, or before by warmup.py, so that the app starts listening quickly
 
 app = Flask(__name__)
 
-# Find these values at https://twilio.com/user/account
-twilio_sid = os.environ['TWILIO_ACCOUNT_SID']
-twilio_token = os.environ['TWILIO_AUTH_TOKEN']
-client = Client(twilio_sid, twilio_token)
+sms_sender = None
+sms_sender_lock = threading.Lock()
 
-def send_message(msg, destination):
-    if msg and msg != '':
-        client.messages.create(from_=os.environ.get('TWILIO_NUMBER'),
-                      to=destination,
-                      body=msg)
+def get_sms_sender():
+    global sms_sender
+    from sms_delivery import make_sms_sender
+    with sms_sender_lock:
+        if sms_sender is None:
+            sms_sender = make_sms_sender()
+        return sms_sender
 
-@app.route("/", methods=['POST'])
-def incoming_sms():
-    """Send a dynamic reply to an incoming text message"""
-    # Get the message the user sent our Twilio number
-    body = request.values.get('Body', None)
-    phone_number = os.environ.get('PHONE_NUMBER')
+# the kind of request in the metrics, the first words of the body
+def get_request_kind(body):
+    for kind in ['Hello', 'Will it rain', 'Subscribe rain', 'Unsubscribe rain', 'Walk from']:
+        if body.startswith(kind):
+            return kind
+    return 'other'
+
+# The reply is computed by a job that can be retried, then sent by another one
+# which is not, so that a retry does not send sms the user already received.
+def reply_to_sms(body, phone_number):
+    with trace_request(get_request_kind(body)):
+        message = get_reply(body, phone_number)
+    if message:
+        job_queue.enqueue('send_sms', get_sms_sender().split(message), phone_number, 0)
+    return message
+
+# The parts that failed for a reason worth retrying are sent again by a new job, up to
+# JOB_MAX_RETRIES times, the others are not sent twice. The job fails if a part did.
+def send_sms(parts, destination, retries):
+    from sms_delivery import is_retryable
+    with trace_request('send sms'):
+        outcomes = get_sms_sender().send_parts(parts, destination)
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    failed = [part for part, outcome in zip(parts, outcomes) if isinstance(outcome, Exception) and is_retryable(outcome)]
+    if failed and retries < constants.JOB_MAX_RETRIES:
+        job_queue.enqueue('send_sms', failed, destination, retries + 1)
+    if errors:
+        raise errors[0]
+    return len(parts)
+
+def get_reply(body, phone_number):
     message = ''
 
     # Determine the right reply for this message
     if body == 'Hello':
-        # Start our TwiML response
         message = 'Hi'
     elif body[:12] == 'Will it rain':
+        from weather import get_rain_response
         message = get_rain_response(body)
+    elif body[:14] == 'Subscribe rain':
+        from weather import get_request_insee, get_request_town
+        from rain_alerts import get_subscription_store
+        insee = get_request_insee(body)
+        if insee:
+            get_subscription_store().subscribe(phone_number, insee)
+            message = 'You will be told when it is likely to rain at ' + get_request_town(body)
+    elif body[:16] == 'Unsubscribe rain':
+        from rain_alerts import get_subscription_store
+        get_subscription_store().unsubscribe(phone_number)
+        message = 'You will not be told about rain anymore'
     elif body[:9] == 'Walk from':
+        from routing import get_walking_itinerary_response
         message = get_walking_itinerary_response(body)
-    if message and message != '':
-        send_message(message, phone_number)
-    # for long requests like routing, twilio may have stopped listening
-    # TODO set up a task queue or make hacks
-    # https://stackoverflow.com/questions/48994440/execute-a-function-after-flask-returns-response
-    return '', 200
+    return message
+
+job_queue = make_job_queue(
+    os.environ.get('JOB_BACKEND', constants.JOB_BACKEND), os.environ.get('JOB_DATABASE', constants.JOB_DATABASE),
+    constants.JOB_QUEUE_SIZE, constants.JOB_WORKERS, constants.JOB_TIMEOUT,
+    constants.JOB_MAX_RETRIES, constants.JOB_RETRY_DELAY, constants.JOB_HISTORY_TTL)
+job_queue.register('reply_to_sms', reply_to_sms)
+job_queue.register('send_sms', send_sms, retryable=False)
+
+@app.route("/", methods=['POST'])
+def incoming_sms():
+    """Queue the reply to an incoming text message"""
+    # Get the message the user sent our Twilio number
+    body = request.values.get('Body', None)
+    # the subscriptions to rain alerts are made by the sender
+    phone_number = request.values.get('From') or os.environ.get('PHONE_NUMBER')
+    if not body:
+        return '', 200
+    # for long requests like routing, twilio would stop listening
+    # before we answer, so the reply is sent by a background job
+    try:
+        job_id = job_queue.enqueue('reply_to_sms', body, phone_number)
+    except JobQueueFull:
+        return '', 503
+    return '', 200, {'X-Job-Id': job_id}
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def job_status(job_id):
+    status = job_queue.get_status(job_id)
+    if status is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(status)
+
+# answers 503 until the routing stack and the regional graphs are loaded
+@app.route("/ready", methods=['GET'])
+def ready():
+    if not is_ready():
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True})
+
+# timings and counters of the requests served by this process
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return jsonify(metrics.snapshot())
 
 
 if __name__ == "__main__":
+    start_warm_up()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
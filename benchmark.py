@@ -0,0 +1,157 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Measures the routing of a corpus of walks on overpass answers recorded in the fixtures
+# directory (see overpass_api.py), and compares the results with a stored baseline.
+#
+# python benchmark.py --record            record the answers of overpass for the corpus
+# python benchmark.py                     replay them and flag regressions against the baseline
+# python benchmark.py --update-baseline   replay them and store the results as the new baseline
+
+# the examples of the README
+WALKS = [
+    'Walk from 156 avenue loubet, dunkerque to 168 avenue de la libération',
+    'Walk from 41 rue joseph jacquard, dunkerque to 52 rue pierre et marie curie',
+    'Walk from 22 rue doudeauville, paris to 5 avenue république, paris'
+]
+
+# engine settings measured on the map of each walk, as (name, force_short_sms, strategy)
+ENGINE_SETTINGS = [
+    ('plain dijkstra', False, 'dijkstra'),
+    ('plain astar', False, 'astar'),
+    ('plain bidirectional', False, 'bidirectional'),
+    ('short sms dijkstra', True, 'dijkstra'),
+    ('short sms astar', True, 'astar')
+]
+
+BASELINE_PATH = 'benchmark_baseline.json'
+
+# a measure is a regression when it is above baseline * (1 + relative) + absolute
+TOLERANCES = {
+    'wall_time': (0.2, 0.05),
+    'labels_settled': (0.1, 10),
+    'peak_memory': (0.2, 1024 * 1024),
+    'sms_count': (0, 0)
+}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='routing benchmark on recorded overpass answers')
+    parser.add_argument('--record', action='store_true', help='ask overpass and record its answers')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--repeat', type=int, default=3, help='the best wall time of this many runs is kept')
+    return parser.parse_args()
+
+# runs function once with tracemalloc for the peak memory, then repeat times for the best wall time
+def measure(function, repeat):
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    wall_time = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        duration = time.perf_counter() - start
+        wall_time = duration if wall_time is None else min(wall_time, duration)
+    return result, {'wall_time': wall_time, 'peak_memory': peak_memory}
+
+def get_sms_count(routing_engine, msg):
+    if not msg:
+        return 0
+    return routing_engine.get_required_sms_number(len(msg))
+
+def run_benchmark(repeat):
+    import overpass_api
+    import routing_engine
+    from graph import PreparedRoute
+    from routing import get_walking_itinerary, get_message_from_itinerary, parse_walking_request
+    import constants
+
+    def settled_labels():
+        return sum(routing_engine.settled_label_counts.values())
+
+    results = {}
+    for walk in WALKS:
+        nA, wayA, cityA, nB, wayB, cityB = parse_walking_request(walk)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pointA = overpass_api.get_street_location(nA, wayA, cityA)
+                pointB = overpass_api.get_street_location(nB, wayB, cityB)
+                map_data = overpass_api.get_map_between_points(pointA, pointB)
+        except FileNotFoundError as e:
+            print(f'skipping "{walk}": {str(e).splitlines()[0]}')
+            continue
+
+        def end_to_end():
+            overpass_api.street_location_cache.clear()
+            return get_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB)
+        labels_before = settled_labels()
+        msg, measures = measure(end_to_end, repeat)
+        measures['labels_settled'] = (settled_labels() - labels_before) // (repeat + 1)
+        measures['sms_count'] = get_sms_count(routing_engine, msg)
+        results[walk + ' | end to end'] = measures
+
+        for name, force_short_sms, strategy in ENGINE_SETTINGS:
+            preference = constants.SMS_TO_METER_PREFERENCE if force_short_sms else 0
+            engine = routing_engine.RoutingEngine(force_short_sms, preference, strategy)
+            itinerary, measures = measure(
+                lambda: engine.search(PreparedRoute.from_map_data(map_data, pointA, pointB)), repeat)
+            msg = get_message_from_itinerary(itinerary) if itinerary['distance'] else ''
+            measures['labels_settled'] = engine.settled_label_count
+            measures['sms_count'] = get_sms_count(routing_engine, msg)
+            results[walk + ' | ' + name] = measures
+    return results
+
+def find_regressions(results, baseline):
+    regressions = []
+    for key, measures in results.items():
+        if key not in baseline:
+            continue
+        for measure, (relative, absolute) in TOLERANCES.items():
+            reference = baseline[key][measure]
+            if measures[measure] > reference * (1 + relative) + absolute:
+                regressions.append(f'{key}: {measure} {measures[measure]} > {reference}')
+    return regressions
+
+def print_results(results, baseline):
+    for key, measures in results.items():
+        reference = baseline.get(key, {})
+        columns = [f'{measure} {measures[measure]:.3f}' if measure == 'wall_time' else f'{measure} {measures[measure]}'
+                   for measure in TOLERANCES]
+        if reference:
+            columns.append(f'(baseline {reference["wall_time"]:.3f}s)')
+        print(key + ': ' + ', '.join(columns))
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    # the environment is read when overpass_api is imported
+    os.environ['OVERPASS_MODE'] = 'record' if arguments.record else 'replay'
+    # the routing is measured without the map tiles cache
+    os.environ['MAP_TILE_CACHE_DIR'] = ''
+    os.environ['ITINERARY_CACHE_DATABASE'] = ''
+    # nor the regional graphs, which would answer the walks they cover without the recorded maps
+    os.environ['REGIONAL_GRAPHS_DIR'] = ''
+    results = run_benchmark(arguments.repeat)
+    baseline = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if arguments.update_baseline:
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('baseline updated')
+    else:
+        regressions = find_regressions(results, baseline)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
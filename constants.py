@@ -3,6 +3,8 @@ TWILIO_MESSAGE_CHARACTER_COUNT = 38
 
 # careful, most characters which aren't ascii will count for many characters
 MAX_SMS_CHARACTER_COUNT = 160
+# a message with a character out of the gsm alphabet is sent in ucs-2
+MAX_UCS2_SMS_CHARACTER_COUNT = 70
 
 # abort routing computation if A and B are too far from each other (in km)
 MAX_FLYING_DISTANCE = 30
@@ -19,10 +21,173 @@ ITINERARY_BASE_DIRECTION_CHARACTER_COUNT= 13
 # how many kilometers I am ready to walk to save one sms
 SMS_TO_METER_PREFERENCE = 0.3
 
+# above this flying distance (in km) itineraries rarely fit in 2 sms,
+# so we search the shortest and the short sms itineraries at once
+COMBINED_SEARCH_MIN_DISTANCE = 2
+
+# see routing_engine.ROUTING_STRATEGIES
+ROUTING_STRATEGY = 'astar'
+
+# a search gives the best itinerary it has after popping this many labels or after
+# this many seconds, so that a big full map cannot hold a worker for minutes
+SEARCH_LABEL_BUDGET = 500000
+SEARCH_TIME_BUDGET = 20
+# the part of these budgets kept for the plain bidirectional search run when the budget
+# runs out before any itinerary reached the target
+SEARCH_FALLBACK_BUDGET_SHARE = 0.2
+
+# run the short sms searches of the regional graphs for several preferences at once in a pool
+# of processes, for workers with idle cores, the best itinerary being scored with
+# SMS_TO_METER_PREFERENCE. Off until a benchmark shows it is faster than a single search.
+PARALLEL_ROUTING = False
+PARALLEL_ROUTING_PROCESSES = 4
+PARALLEL_SMS_PREFERENCES = [0.1, 0.3, 1]
+# regional graphs kept loaded by each process of the pool
+PARALLEL_ROUTING_LOADED_GRAPHS = 2
+
+# points of interest of "Walk from X to <kind>": the overpass filters of their nodes,
+# the radius around X (in km) they are searched in and the label written before their name
+POI_KINDS = {
+    'atm': {
+        'filters': ['node[amenity=atm]', 'node[amenity=bank][atm=yes]'],
+        'radius': 1,
+        'label': 'ATM'
+    },
+    'sncf': {
+        'filters': ['node[railway=station][operator~"SNCF"]', 'node[railway=station][network~"SNCF|TER|Transilien"]'],
+        'radius': 3,
+        'label': 'Gare'
+    }
+}
+
+# how many ways near pointA the search can start from
+SOURCE_SNAP_CANDIDATES = 3
+
 # in degrees
 PARALLELISM_TOLERANCE = 20
 
 # in km
 MIN_DISTANCE_FOR_WAY_BEARING = 0.02
 
-DIFFICULT_WAYS = ['path', 'cycleway', 'chemin']
\ No newline at end of file
+DIFFICULT_WAYS = ['path', 'cycleway', 'chemin']
+
+# overpass maps are downloaded by square tiles of this size (in degrees)
+# and cached on disk in this directory, no cache if empty
+MAP_TILE_SIZE = 0.02
+MAP_TILE_CACHE_DIR = 'map_tiles_cache'
+
+# in seconds
+MAP_TILE_TTL = 7 * 24 * 3600
+
+MAP_TILE_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# built by address_index.py, looked up before asking overpass for addresses
+ADDRESS_INDEX_PATH = 'address_index.npy'
+
+# how many addresses are kept in memory
+STREET_LOCATION_CACHE_SIZE = 10000
+
+# messages of the walks already answered, no cache if the database path is empty,
+# they expire with the map tiles
+ITINERARY_CACHE_DATABASE = 'itineraries.sqlite'
+ITINERARY_CACHE_SIZE = 1000
+ITINERARY_CACHE_MAX_ROWS = 100000
+ITINERARY_CACHE_TTL = 7 * 24 * 3600
+
+# replies are computed by background jobs, 'memory' or 'sqlite' backend
+JOB_BACKEND = 'memory'
+JOB_DATABASE = 'jobs.sqlite'
+JOB_QUEUE_SIZE = 100
+JOB_WORKERS = 4
+
+# in seconds
+JOB_TIMEOUT = 300
+JOB_MAX_RETRIES = 1
+JOB_RETRY_DELAY = 5
+# finished jobs are kept this long for /jobs/<id>
+JOB_HISTORY_TTL = 24 * 3600
+
+# concurrent fetches for all the requests
+FETCH_WORKERS = 8
+
+# connections kept open to each server
+HTTP_POOL_SIZE = 8
+
+# failed requests are retried after 1, 2, 4... seconds
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 1
+HTTP_MAX_RETRY_DELAY = 30
+
+# in bytes, responses are parsed as they are downloaded
+HTTP_CHUNK_SIZE = 64 * 1024
+
+# where overpass answers are recorded and replayed, see overpass_api.py
+OVERPASS_FIXTURES_DIR = 'fixtures/overpass'
+
+# tried in turn when one is overloaded
+OVERPASS_ENDPOINTS = [
+    'https://overpass-api.de/api/interpreter',
+    'https://overpass.kumi.systems/api/interpreter',
+    'https://maps.mail.ru/osm/tools/overpass/api/interpreter'
+]
+
+# in seconds, an http timeout bounds all the attempts of a request
+OVERPASS_TIMEOUT = 60
+WEATHER_TIMEOUT = 10
+GEOCODE_TIMEOUT = 30
+MAP_TIMEOUT = 90
+
+# download the full map while routing on the filtered one, in case no path is found:
+# off since it costs a second download and graph build to every walk that finds a path
+SPECULATIVE_FULL_MAP_PREFETCH = False
+
+# when no path is found, only the ways missing from the filtered map are downloaded,
+# added to its graph and the search goes on from where it stopped
+INCREMENTAL_MAP_EXPANSION = True
+
+# city names already resolved to their insee code, kept across restarts
+INSEE_CODES_PATH = 'insee_codes.json'
+
+# forecasts are issued every hour, we ask again this many seconds after the hour
+FORECAST_ISSUE_DELAY = 300
+FORECAST_CACHE_SIZE = 1000
+
+# phone numbers subscribed to the rain alerts of a town
+RAIN_ALERTS_DATABASE = 'rain_alerts.sqlite'
+# twilio accepts about one sms per second per number
+SMS_SEND_RATE = 1
+SMS_SEND_BURST = 5
+# the rate is shared by the processes of the machine (web workers, clock) through this
+# file, '' for a rate per process
+SMS_RATE_LIMIT_PATH = 'sms_rate_limit'
+SMS_SEND_WORKERS = 4
+# long messages are sent in at most this many numbered sms
+SMS_MAX_PARTS = 10
+SMS_SEND_RETRIES = 3
+# in seconds, doubled at each retry
+SMS_SEND_RETRY_BACKOFF = 1
+
+# regions whose walking graph is built offline by regional_graph.py, as (south, west, north, east)
+ROUTING_REGIONS = {
+    'paris': (48.812, 2.22, 48.905, 2.475),
+    'dunkerque': (50.99, 2.25, 51.07, 2.45)
+}
+REGIONAL_GRAPHS_DIR = 'regional_graphs'
+# in degrees, points closer to the border of a region are routed on overpass maps
+ROUTING_REGION_MARGIN = 0.005
+# in seconds
+REGION_DOWNLOAD_TIMEOUT = 900
+# in seconds, the time overpass may spend on the query of a region, below the download timeout
+REGION_QUERY_TIMEOUT = 600
+# in bytes, the memory overpass may use for the query of a region (its default is 512 MiB)
+REGION_QUERY_MAXSIZE = 1073741824
+# the contraction grows faster than the graph, about 40s for 10k nodes and 7 min for 50k
+REGION_MAX_NODES = 50000
+# nodes settled by the searches looking for shorter paths than shortcuts, more gives less shortcuts
+CONTRACTION_WITNESS_LIMIT = 50
+
+# traces of the last requests served by the /metrics endpoint
+METRICS_RECENT_REQUESTS = 50
+# fraction of the requests profiled with cProfile, 0 to never profile
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = 'profiles'
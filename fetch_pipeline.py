@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from instrumentation import phase
+import constants
+
+# shared by all the requests, fetches mostly wait for the network
+executor = ThreadPoolExecutor(max_workers=constants.FETCH_WORKERS, thread_name_prefix='fetch')
+
+# Runs the fetches of one request concurrently and records how long each step took
+# as a phase of the trace of the request, which the fetch threads are given.
+class FetchPipeline:
+    def __init__(self):
+        self.futures = {}
+
+    def submit(self, name, function, *args):
+        def timed():
+            with phase(name):
+                return function(*args)
+        self.futures[name] = executor.submit(contextvars.copy_context().run, timed)
+        return self.futures[name]
+
+    # waits at most timeout seconds for the result of a submitted fetch
+    def result(self, name, timeout=None):
+        return self.futures[name].result(timeout)
+
+    # a fetch that has not started yet is dropped, a running one is left
+    # to finish in the background and its result ignored
+    def cancel(self, name):
+        future = self.futures.pop(name, None)
+        if future is not None and not future.done() and not future.cancel():
+            print(name + ' was not needed')
+
+    # runs function in the current thread, timing it like the fetches
+    def run(self, name, function, *args):
+        with phase(name):
+            return function(*args)
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 import constants
 
 def radians(x):
@@ -7,121 +8,163 @@ def radians(x):
 def degrees(x):
     return 180.*x/math.pi
 
-def get_flying_distance(point1, point2):
+# The functions on arrays take the coordinates in degrees of points or segments as numpy arrays
+# (or numbers, broadcast like numpy does), the ones on {'lat', 'lon'} dicts wrap them.
+
+# haversine distances in km between points 1 and points 2
+def get_flying_distances(lats1, lons1, lats2, lons2):
     R = 6370
-    lat1 = radians(point1['lat'])
-    lon1 = radians(point1['lon'])
-    lat2 = radians(point2['lat'])
-    lon2 = radians(point2['lon'])
+    lat1 = np.radians(lats1)
+    lon1 = np.radians(lons1)
+    lat2 = np.radians(lats2)
+    lon2 = np.radians(lons2)
 
     dlon = lon2 - lon1
     dlat = lat2 - lat1
 
-    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return R * c
 
-# to the equator I think
-def get_bearing(point1, point2):
-    lat1 = radians(point1['lat'])
-    lon1 = radians(point1['lon'])
-    lat2 = radians(point2['lat'])
-    lon2 = radians(point2['lon'])
-    
-    dLon = (lon2 - lon1)
+def get_flying_distance(point1, point2):
+    return float(get_flying_distances(point1['lat'], point1['lon'], point2['lat'], point2['lon']))
 
-    y = math.sin(dLon) * math.cos(lat2)
-    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dLon)
+# initial bearings from points 1 to points 2, in degrees from the north (I think)
+def get_bearings(lats1, lons1, lats2, lons2):
+    lat1 = math.pi*np.asarray(lats1)/180.
+    lon1 = math.pi*np.asarray(lons1)/180.
+    lat2 = math.pi*np.asarray(lats2)/180.
+    lon2 = math.pi*np.asarray(lons2)/180.
 
-    brng = math.atan2(y, x)
+    dLon = (lon2 - lon1)
 
-    brng = 180*brng/math.pi
+    y = np.sin(dLon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dLon)
 
-    brng = brng % 360
+    return 180*np.arctan2(y, x)/math.pi % 360
 
-    return brng
+def get_bearing(point1, point2):
+    return float(get_bearings(point1['lat'], point1['lon'], point2['lat'], point2['lon']))
 
+# angles of the turns at points 2 when going from points 1 to points 3
+def get_angles(lats1, lons1, lats2, lons2, lats3, lons3):
+    return (get_bearings(lats1, lons1, lats2, lons2) - 180 - get_bearings(lats2, lons2, lats3, lons3)) % 360
 
 def get_angle(point1, point2, point3):
-    return (get_bearing(point1, point2) - 180 - get_bearing(point2, point3)) % 360
+    return float(get_angles(point1['lat'], point1['lon'], point2['lat'], point2['lon'], point3['lat'], point3['lon']))
+
+# the point at the mean coordinates of a set of points
+def get_center(lats, lons):
+    return {'lat': float(np.mean(lats)), 'lon': float(np.mean(lons))}
 
 def get_midpoint(point1, point2):
-    return {
-       'lat': (point1['lat'] + point2['lat'])/2.,
-       'lon': (point1['lon'] + point2['lon'])/2.
-    }
+    return get_center([point1['lat'], point2['lat']], [point1['lon'], point2['lon']])
+
+# (south, west, north, east) of a set of points
+def get_bounding_box(lats, lons):
+    return float(np.min(lats)), float(np.min(lons)), float(np.max(lats)), float(np.max(lons))
+
+# Projections of one point on segments from points 1 to points 2, returned as arrays of lats and lons.
+# Here we do simple stuff, we do not try to solve tediously difficult problems on spheres or ellipsoids:
+# the segments are projected on the plane tangent to the earth at the point.
+def get_projections_on_segments(lat, lon, lats1, lons1, lats2, lons2):
+    proj1_x = np.radians(lats1) - radians(lat)
+    proj1_y = math.cos(radians(lat)) * (np.radians(lons1) - radians(lon))
+    proj2_x = np.radians(lats2) - radians(lat)
+    proj2_y = math.cos(radians(lat)) * (np.radians(lons2) - radians(lon))
+
+    denominator = (proj1_x - proj2_x)**2 + (proj1_y - proj2_y)**2
+    numerator = (proj2_x - proj1_x)*proj2_x + (proj2_y - proj1_y)*proj2_y
+    # segments of length 0 are projected on their first end
+    t = np.divide(numerator, denominator, out=np.ones_like(numerator), where=denominator > 0)
+    t = np.clip(t, 0, 1)
+    return t * lats1 + (1-t) * lats2, t * lons1 + (1-t) * lons2
 
-# here we do simple stuff
-# we do not try to solve tediously difficult problems on spheres or ellipsoids
 def get_projection_on_segment(point, segment):
-    segpoint1 = segment[0]
-    segpoint2 = segment[1]
-    
-    # project on plane tangent of earth at point (at least that's what I'm trying to do)
-    proj1 = [
-        radians(segpoint1['lat']) - radians(point['lat']),
-        math.cos(radians(point['lat'])) * (radians(segpoint1['lon']) - radians(point['lon']))
-    ]
-    proj2 = [
-        radians(segpoint2['lat']) - radians(point['lat']),
-        math.cos(radians(point['lat'])) * (radians(segpoint2['lon']) - radians(point['lon']))
-    ]
-    
-    # find the projection
-    t = ((proj2[0] - proj1[0])*proj2[0] + (proj2[1] - proj1[1])*proj2[1]) / ((proj1[0] - proj2[0])**2 + (proj1[1] - proj2[1])**2)
-    if t > 1:
-        t = 1
-    if t < 0:
-        t = 0
-
-    projection = {
-        'lat': t * segpoint1['lat'] + (1-t) * segpoint2['lat'],
-        'lon': t * segpoint1['lon'] + (1-t) * segpoint2['lon']
-    }
-
-    return projection
-
+    lats, lons = get_projections_on_segments(
+        point['lat'], point['lon'], np.array([segment[0]['lat']]), np.array([segment[0]['lon']]),
+        np.array([segment[1]['lat']]), np.array([segment[1]['lon']]))
+    return {'lat': float(lats[0]), 'lon': float(lons[0])}
+
+# the projections of one point on segments and their distances to it, as arrays of lats, lons and distances
+def get_distances_to_segments(lat, lon, lats1, lons1, lats2, lons2):
+    lats, lons = get_projections_on_segments(lat, lon, lats1, lons1, lats2, lons2)
+    return lats, lons, get_flying_distances(lats, lons, lat, lon)
+
+# get_half_bearing_at_node for all the points at once: the walk from each point
+# starts with segment first_segments[i] and goes on with the segments step after it,
+# segment j having length lengths[j] and bearing bearings[j], while is_segment[j] is true.
+# Points without a bearing are given nan.
+def get_half_bearings(lengths, bearings, is_segment, first_segments, step):
+    point_count = len(first_segments)
+    results = np.full(point_count, np.nan)
+    sum_d = np.zeros(point_count)
+    sum_bearing = np.zeros(point_count)
+    in_range = (first_segments >= 0) & (first_segments < len(is_segment))
+    active = np.nonzero(in_range)[0]
+    active = active[is_segment[first_segments[active]]]
+    segments = first_segments[active]
+    initial_bearings = np.zeros(point_count)
+    initial_bearings[active] = bearings[segments]
+    while len(active):
+        d = lengths[segments]
+        bearing = bearings[segments]
+        # the bearing closest to the initial one, modulo 360
+        difference = bearing - initial_bearings[active]
+        bearing = np.where(difference < -180, bearing + 360, np.where(difference > 180, bearing - 360, bearing))
+        sum_d[active] += d
+        sum_bearing[active] += d*bearing
+        done = sum_d[active] >= constants.MIN_DISTANCE_FOR_WAY_BEARING
+        results[active[done]] = sum_bearing[active[done]]/sum_d[active[done]] % 180
+        segments = segments + step
+        going_on = ~done & (segments >= 0) & (segments < len(is_segment))
+        going_on[going_on] = is_segment[segments[going_on]]
+        active = active[going_on]
+        segments = segments[going_on]
+    return results
+
+# get_bearing_at_index for all the points of polylines at once, the points of polyline p
+# being offsets[p] to offsets[p+1] - 1 of lats and lons. Points without a bearing are given nan.
+def get_polyline_bearings(lats, lons, offsets):
+    point_count = len(lats)
+    polylines = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    # segment j goes from point j to point j + 1 of the same polyline
+    is_segment = np.zeros(point_count, dtype=bool)
+    is_segment[:-1] = polylines[:-1] == polylines[1:]
+    lengths = np.zeros(point_count)
+    forward_bearings = np.zeros(point_count)
+    backward_bearings = np.zeros(point_count)
+    lengths[:-1] = get_flying_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    forward_bearings[:-1] = get_bearings(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    backward_bearings[:-1] = get_bearings(lats[1:], lons[1:], lats[:-1], lons[:-1])
+    points = np.arange(point_count)
+    bearings_after = get_half_bearings(lengths, forward_bearings, is_segment, points, 1)
+    bearings_before = get_half_bearings(lengths, backward_bearings, is_segment, points - 1, -1)
+    # the ends of polylines only have one side, points where the sides disagree have no bearing
+    return np.where(np.isnan(bearings_before), bearings_after, np.where(
+        np.isnan(bearings_after), bearings_before, np.where(
+            np.abs(bearings_before - bearings_after) > constants.PARALLELISM_TOLERANCE,
+            np.nan, (bearings_after + bearings_before)/2.)))
+
+def get_way_coordinates(nodes_forming_way, nodes):
+    points = [nodes[node] for node in nodes_forming_way]
+    return np.array([point['lat'] for point in points]), np.array([point['lon'] for point in points])
+
+# mean bearing modulo 180 of the first MIN_DISTANCE_FOR_WAY_BEARING km of the way, None if it is shorter
 def get_half_bearing_at_node(nodes_forming_way, nodes):
-    sum_d = 0
-    i = 0
-    sum_bearing = 0
-    initial_bearing = get_bearing(nodes[nodes_forming_way[0]], nodes[nodes_forming_way[1]])
-    while sum_d < constants.MIN_DISTANCE_FOR_WAY_BEARING and i < len(nodes_forming_way) - 1:
-        d = get_flying_distance(nodes[nodes_forming_way[i]], nodes[nodes_forming_way[i+1]])
-        sum_d += d
-        bearing = get_bearing(nodes[nodes_forming_way[i]], nodes[nodes_forming_way[i+1]])
-        if abs(initial_bearing - (bearing + 360)) < abs(initial_bearing - bearing):
-            bearing = bearing + 360
-        elif abs(initial_bearing - (bearing - 360)) < abs(initial_bearing - bearing):
-            bearing = bearing - 360
-        sum_bearing += d*bearing
-        i += 1
-    if sum_d < constants.MIN_DISTANCE_FOR_WAY_BEARING:
-        return None
-    else:
-        return sum_bearing/sum_d % 180
+    lats, lons = get_way_coordinates(nodes_forming_way, nodes)
+    lengths = get_flying_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    bearings = get_bearings(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    bearing = get_half_bearings(lengths, bearings, np.ones(len(lengths), dtype=bool), np.array([0]), 1)[0]
+    return None if np.isnan(bearing) else float(bearing)
+
+# bearing of the way formed by nodes_forming_way at its index-th node
+def get_bearing_at_index(nodes_forming_way, index, nodes, debug=False):
+    lats, lons = get_way_coordinates(nodes_forming_way, nodes)
+    bearing = get_polyline_bearings(lats, lons, np.array([0, len(lats)]))[index]
+    if debug and np.isnan(bearing):
+        print('no bearing at node ' + str(nodes_forming_way[index]))
+    return None if np.isnan(bearing) else float(bearing)
 
 def get_bearing_at_node(way, node, nodes, debug=False):
-    index = way['nodes'].index(node['id'])
-    if index == 0:
-        return get_half_bearing_at_node(way['nodes'], nodes)
-    elif index == len(way['nodes']) - 1:
-        return get_half_bearing_at_node(way['nodes'][::-1], nodes)
-    else:
-        bearing_before = get_half_bearing_at_node(way['nodes'][index::-1], nodes)
-        bearing_after = get_half_bearing_at_node(way['nodes'][index:], nodes)
-        if bearing_before is None and bearing_after is None:
-            if debug:
-                print('no bearing')
-            return None
-        elif bearing_after is None:
-            return bearing_before
-        elif bearing_before is None:
-            return bearing_after
-        elif abs(bearing_before - bearing_after) > constants.PARALLELISM_TOLERANCE:
-            if debug:
-                print(bearing_before, bearing_after)
-            return None
-        else:
-            return (bearing_after + bearing_before)/2.
\ No newline at end of file
+    return get_bearing_at_index(way['nodes'], way['nodes'].index(node['id']), nodes, debug)
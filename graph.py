@@ -0,0 +1,432 @@
+from array import array
+import os
+import numpy as np
+from geometry_utils import get_flying_distances, get_polyline_bearings
+from spatial_index import GridIndex
+from instrumentation import count, phase, set_value
+import constants
+
+def get_way_name(way):
+    return way['tags']['name'] if 'name' in way['tags'] else way['tags']['highway']
+
+# Collects the elements of an overpass map as they are parsed into compact arrays, keeping only
+# what the graph needs: the coordinates of nodes and the nodes, name and highway of ways.
+# Ways can come before their nodes, they are resolved by build.
+class GraphBuilder:
+    def __init__(self):
+        self.node_ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.way_ids = array('q')
+        self.way_names = []
+        self.way_highways = []
+        self.way_offsets = array('q', [0])
+        self.way_node_ids = array('q')
+        # elements of a graph being extended, added again they are ignored: the nodes
+        # are dropped by build, after the first known_node_count ones
+        self.known_node_count = 0
+        self.known_way_ids = set()
+
+    # starts with the nodes and ways of graph, which keep their indices in the built graph
+    @classmethod
+    def from_graph(cls, graph):
+        builder = cls()
+        builder.node_ids.frombytes(np.ascontiguousarray(graph.node_ids, dtype=np.int64).tobytes())
+        builder.lats.frombytes(np.ascontiguousarray(graph.lats, dtype=np.float64).tobytes())
+        builder.lons.frombytes(np.ascontiguousarray(graph.lons, dtype=np.float64).tobytes())
+        builder.way_ids.frombytes(np.ascontiguousarray(graph.way_ids, dtype=np.int64).tobytes())
+        builder.way_names = [str(name) for name in graph.way_names]
+        builder.way_highways = [str(highway) for highway in graph.way_highways]
+        builder.way_offsets = array('q')
+        builder.way_offsets.frombytes(np.asarray(graph.way_offsets, dtype=np.int64).tobytes())
+        builder.way_node_ids.frombytes(np.asarray(graph.node_ids[graph.way_nodes], dtype=np.int64).tobytes())
+        builder.known_node_count = graph.node_count
+        builder.known_way_ids = set(graph.way_ids.tolist())
+        return builder
+
+    def add(self, element):
+        if element['type'] == 'node':
+            self.node_ids.append(element['id'])
+            self.lats.append(element['lat'])
+            self.lons.append(element['lon'])
+        elif element['type'] == 'way':
+            if element['id'] in self.known_way_ids:
+                return
+            self.way_ids.append(element['id'])
+            self.way_names.append(get_way_name(element))
+            self.way_highways.append(element['tags']['highway'])
+            self.way_node_ids.extend(element['nodes'])
+            self.way_offsets.append(len(self.way_node_ids))
+
+    # Adds nodes and ways given as arrays, as in the map tiles, the ways already known being
+    # skipped and the others becoming known. Only the nodes of the added ways are kept.
+    def add_arrays(self, node_ids, lats, lons, way_ids, way_names, way_highways, way_offsets, way_node_ids):
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        way_offsets = np.asarray(way_offsets, dtype=np.int64)
+        added_ways = ~np.isin(way_ids, np.fromiter(self.known_way_ids, dtype=np.int64, count=len(self.known_way_ids)))
+        added_way_node_ids = np.asarray(way_node_ids, dtype=np.int64)[np.repeat(added_ways, np.diff(way_offsets))]
+        added_nodes = np.isin(node_ids, added_way_node_ids)
+        self.node_ids.frombytes(np.ascontiguousarray(node_ids[added_nodes], dtype=np.int64).tobytes())
+        self.lats.frombytes(np.ascontiguousarray(lats[added_nodes], dtype=np.float64).tobytes())
+        self.lons.frombytes(np.ascontiguousarray(lons[added_nodes], dtype=np.float64).tobytes())
+        self.way_ids.frombytes(way_ids[added_ways].tobytes())
+        added = added_ways.tolist()
+        self.way_names += [str(name) for name, add in zip(way_names, added) if add]
+        self.way_highways += [str(highway) for highway, add in zip(way_highways, added) if add]
+        self.way_offsets.frombytes((len(self.way_node_ids) + np.cumsum(np.diff(way_offsets)[added_ways])).tobytes())
+        self.way_node_ids.frombytes(added_way_node_ids.tobytes())
+        self.known_way_ids.update(way_ids[added_ways].tolist())
+
+    # adds what another builder collected
+    def merge(self, builder):
+        self.add_arrays(
+            np.frombuffer(builder.node_ids, dtype=np.int64), np.frombuffer(builder.lats, dtype=np.float64),
+            np.frombuffer(builder.lons, dtype=np.float64), np.frombuffer(builder.way_ids, dtype=np.int64),
+            builder.way_names, builder.way_highways, np.frombuffer(builder.way_offsets, dtype=np.int64),
+            np.frombuffer(builder.way_node_ids, dtype=np.int64))
+
+    def build(self):
+        with phase('graph build'):
+            return self.build_graph()
+
+    def build_graph(self):
+        node_ids = np.frombuffer(self.node_ids, dtype=np.int64).copy()
+        lats = np.frombuffer(self.lats, dtype=np.float64).copy()
+        lons = np.frombuffer(self.lons, dtype=np.float64).copy()
+        if self.known_node_count and len(node_ids) > self.known_node_count:
+            known_ids = np.sort(node_ids[:self.known_node_count])
+            new_ids = node_ids[self.known_node_count:]
+            positions = np.minimum(np.searchsorted(known_ids, new_ids), len(known_ids) - 1)
+            # the new nodes can also repeat each other, their first occurrence is kept
+            first_occurrences = np.zeros(len(new_ids), dtype=bool)
+            first_occurrences[np.unique(new_ids, return_index=True)[1]] = True
+            kept_nodes = np.concatenate([np.ones(self.known_node_count, dtype=bool),
+                                         (known_ids[positions] != new_ids) & first_occurrences])
+            node_ids, lats, lons = node_ids[kept_nodes], lats[kept_nodes], lons[kept_nodes]
+        way_ids = np.frombuffer(self.way_ids, dtype=np.int64).copy()
+        way_offsets = np.frombuffer(self.way_offsets, dtype=np.int64)
+        way_node_ids = np.frombuffer(self.way_node_ids, dtype=np.int64)
+        # node ids are looked up by bisection in the sorted ids
+        order = np.argsort(node_ids, kind='stable')
+        sorted_ids = node_ids[order]
+        positions = np.minimum(np.searchsorted(sorted_ids, way_node_ids), max(len(node_ids) - 1, 0))
+        known = sorted_ids[positions] == way_node_ids if len(node_ids) else np.zeros(len(way_node_ids), dtype=bool)
+        lengths = np.diff(way_offsets)
+        slot_ways = np.repeat(np.arange(len(way_ids)), lengths)
+        kept_ways = np.bincount(slot_ways[~known], minlength=len(way_ids)) == 0
+        for way_id in way_ids[~kept_ways].tolist():
+            print('way ' + str(way_id) + ' has unknown nodes, it is ignored')
+        kept_slots = kept_ways[slot_ways]
+        kept = kept_ways.tolist()
+        return Graph(
+            node_ids, lats, lons, way_ids[kept_ways],
+            [name for name, keep in zip(self.way_names, kept) if keep],
+            [highway for highway, keep in zip(self.way_highways, kept) if keep],
+            np.concatenate([[0], np.cumsum(lengths[kept_ways])]).astype(np.int64),
+            order[positions[kept_slots]].astype(np.int64))
+
+# gives {'lat', 'lon'} dicts for node indices so that the geometry_utils functions
+# can be used on the graph without keeping one dict per node
+class CoordinatesView:
+    def __init__(self, lats, lons):
+        self.lats = lats
+        self.lons = lons
+
+    def __getitem__(self, i):
+        return {'lat': float(self.lats[i]), 'lon': float(self.lons[i])}
+
+# Walking graph compiled once from the elements of an overpass map.
+# Nodes are indexed from 0 to node_count - 1 and ways from 0 to way_count - 1.
+# The nodes of all the ways are concatenated in way_nodes: the position of a node
+# in a way is called a slot, the nodes of way w are in slots way_offsets[w] to way_offsets[w+1] - 1.
+# Edges are stored in CSR format: the edges leaving node u are edge_offsets[u] to edge_offsets[u+1] - 1,
+# each one going from slot edge_source_slot[e] to the next or previous slot edge_target_slot[e] of the same way.
+# The raw map data is never modified so a graph can be searched several times.
+class Graph:
+    def __init__(self, node_ids, lats, lons, way_ids, way_names, way_highways, way_offsets, way_nodes):
+        self.node_ids = node_ids
+        self.lats = lats
+        self.lons = lons
+        self.coordinates = CoordinatesView(lats, lons)
+
+        self.way_ids = way_ids
+        self.way_names = way_names
+        self.way_highways = way_highways
+        unique_names, self.way_name_ids = np.unique(np.array(way_names, dtype=str), return_inverse=True)
+        self.way_name_character_counts = np.minimum(
+            constants.MAX_CHARS_PER_WAY, np.char.str_len(unique_names))[self.way_name_ids]
+        self.way_offsets = way_offsets
+        self.way_nodes = way_nodes
+        self.slot_way = np.repeat(np.arange(len(way_ids)), np.diff(way_offsets))
+
+        # each pair of consecutive slots of a way gives an edge in both directions
+        tails = np.nonzero(self.slot_way[:-1] == self.slot_way[1:])[0]
+        heads = tails + 1
+        source_slots = np.concatenate([tails, heads])
+        target_slots = np.concatenate([heads, tails])
+        sources = way_nodes[source_slots]
+        order = np.argsort(sources, kind='stable')
+        self.edge_source_slot = source_slots[order]
+        self.edge_target_slot = target_slots[order]
+        self.edge_target = way_nodes[self.edge_target_slot]
+        self.edge_way = self.slot_way[self.edge_source_slot]
+        self.edge_offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=self.edge_offsets[1:])
+        source_nodes = way_nodes[self.edge_source_slot]
+        self.edge_length = get_flying_distances(
+            lats[source_nodes], lons[source_nodes], lats[self.edge_target], lons[self.edge_target])
+
+        self.reset_caches()
+
+    def reset_caches(self):
+        self._search_lists = None
+        self._slot_bearings = None
+        self._segment_index = None
+        self._node_index = None
+
+    # arrays saved by save, way_names and way_highways as arrays of strings
+    SAVED_ARRAYS = [
+        'node_ids', 'lats', 'lons', 'way_ids', 'way_names', 'way_highways', 'way_name_ids',
+        'way_name_character_counts', 'way_offsets', 'way_nodes', 'slot_way', 'edge_offsets',
+        'edge_source_slot', 'edge_target_slot', 'edge_target', 'edge_way', 'edge_length'
+    ]
+
+    # the slot bearings are saved with the arrays, so that each process loading the graph
+    # does not compute them again
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.SAVED_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), np.asarray(getattr(self, name)))
+        np.save(os.path.join(directory, 'slot_bearings.npy'), self.get_slot_bearings())
+
+    # the arrays are memory-mapped, so loading is immediate and the pages
+    # are shared by the processes using the same graph
+    @classmethod
+    def load(cls, directory):
+        graph = cls.__new__(cls)
+        for name in cls.SAVED_ARRAYS:
+            setattr(graph, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        graph.coordinates = CoordinatesView(graph.lats, graph.lons)
+        graph.reset_caches()
+        # graphs saved before the bearings were
+        bearings_path = os.path.join(directory, 'slot_bearings.npy')
+        if os.path.exists(bearings_path):
+            graph._slot_bearings = np.load(bearings_path, mmap_mode='r')
+        return graph
+
+    @classmethod
+    def from_map_data(cls, map_data):
+        return cls.from_elements(map_data['elements'])
+
+    # the elements can be streamed, in any order
+    @classmethod
+    def from_elements(cls, elements):
+        builder = GraphBuilder()
+        for element in elements:
+            builder.add(element)
+        count('map elements', len(builder.node_ids) + len(builder.way_ids))
+        graph = builder.build()
+        set_value('graph', {'nodes': graph.node_count, 'ways': graph.way_count})
+        return graph
+
+    # a new graph with the nodes and ways of the elements that are not in this one,
+    # the nodes, ways and slots of this one keep their indices
+    def extend(self, elements):
+        delta = GraphBuilder()
+        for element in elements:
+            delta.add(element)
+        return self.merge(delta)
+
+    # the same with the elements already collected by a GraphBuilder
+    def merge(self, delta):
+        builder = GraphBuilder.from_graph(self)
+        builder.merge(delta)
+        return builder.build()
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def way_count(self):
+        return len(self.way_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.edge_target)
+
+    # python lists are much faster than numpy arrays when read one item at a time in the search loop,
+    # slot bearings are None where the way has no clear bearing
+    def get_search_lists(self):
+        if self._search_lists is None:
+            slot_bearings = self.get_slot_bearings()
+            self._search_lists = (
+                self.edge_offsets.tolist(),
+                self.edge_target.tolist(),
+                self.edge_length.tolist(),
+                self.edge_source_slot.tolist(),
+                self.edge_target_slot.tolist(),
+                self.slot_way.tolist(),
+                self.way_name_ids.tolist(),
+                self.way_name_character_counts.tolist(),
+                [name in constants.DIFFICULT_WAYS for name in self.way_names],
+                np.where(np.isnan(slot_bearings), None, slot_bearings).tolist()
+            )
+        return self._search_lists
+
+    # the bearings of the ways at all their slots are computed at once, nan where there is none
+    def get_slot_bearings(self):
+        if self._slot_bearings is None:
+            self._slot_bearings = get_polyline_bearings(
+                self.lats[self.way_nodes], self.lons[self.way_nodes], self.way_offsets)
+        return self._slot_bearings
+
+    # segments are indexed by the slot of their first node
+    def get_segment_index(self):
+        if self._segment_index is None:
+            slots = np.nonzero(self.slot_way[:-1] == self.slot_way[1:])[0]
+            self._segment_slots = slots
+            nodes1 = self.way_nodes[slots]
+            nodes2 = self.way_nodes[slots + 1]
+            self._segment_index = GridIndex(
+                self.lats[nodes1], self.lons[nodes1], self.lats[nodes2], self.lons[nodes2], self.slot_way[slots])
+        return self._segment_index
+
+    # only nodes of ways are indexed
+    def get_node_index(self):
+        if self._node_index is None:
+            self._indexed_nodes = np.nonzero(np.diff(self.edge_offsets) > 0)[0]
+            lats = self.lats[self._indexed_nodes]
+            lons = self.lons[self._indexed_nodes]
+            self._node_index = GridIndex(lats, lons, lats, lons)
+        return self._node_index
+
+    # The sources are the projections of pointA on the closest ways.
+    # The nearest node of the nearest way could be dozens of meters away
+    # in either direction so it would be impractical to use it.
+    # Up to k projections on distinct ways are returned so that the search can
+    # choose the best entry point, each one as a (projection, distance, links) tuple
+    # where links go from the projection to the ends of its segment
+    # as (node, distance, slot) tuples.
+    def find_sources(self, pointA, k=1):
+        sources = []
+        nearest = self.get_segment_index().nearest(pointA, k, distinct_groups=True)
+        if nearest:
+            slots = self._segment_slots[[segment for segment, _, _ in nearest]]
+            # the ends of all the segments at once
+            nodes = np.stack([self.way_nodes[slots], self.way_nodes[slots + 1]], axis=1)
+            projection_lats = np.array([[projection['lat']] for _, _, projection in nearest])
+            projection_lons = np.array([[projection['lon']] for _, _, projection in nearest])
+            link_distances = get_flying_distances(
+                projection_lats, projection_lons, self.lats[nodes], self.lons[nodes]).tolist()
+            for (_, distance, projection), slot, (node1, node2), (distance1, distance2) in zip(
+                    nearest, slots.tolist(), nodes.tolist(), link_distances):
+                sources.append((projection, distance, [(node1, distance1, slot), (node2, distance2, slot + 1)]))
+        if sources:
+            set_value('source distance', sources[0][1])
+        return sources
+
+    # The targets are the closest nodes of ways to pointB, as (node, distance) tuples.
+    def find_targets(self, pointB, k=1):
+        return [
+            (int(self._indexed_nodes[i]), distance)
+            for i, distance, _ in self.get_node_index().nearest(pointB, k)
+        ]
+
+# A graph with the source and target of an itinerary snapped once,
+# so that it can be searched with several engine settings.
+# A route can have several target points, the search stopping at the first one reached:
+# targets are the nodes they are snapped to, target the one of pointB.
+class PreparedRoute:
+    def __init__(self, graph, pointA, pointB, target_points=None):
+        self.graph = graph
+        self.pointA = pointA
+        self.pointB = pointB
+        self.target_points = target_points if target_points is not None else [pointB]
+        # the walk from pointA to each entry point is part of the itinerary
+        # so that the search picks the best one
+        self.source_points = []
+        self.source_links = []
+        self.snap()
+        self._source_edges = None
+        self._target_distances = None
+        # set on extended routes, what the route had before being extended
+        self.previous_way_count = None
+        self.previous_source_link_count = None
+
+    def snap(self):
+        with phase('snapping'):
+            self.add_sources()
+            targets = self.graph.find_targets(self.pointB)
+            self.target = targets[0][0] if targets else None
+            self.targets = {node for point in self.target_points for node, _ in self.graph.find_targets(point)}
+
+    # entry points on segments that already have links are skipped,
+    # the links of an entry point being the ends of its segment
+    def add_sources(self):
+        linked_segments = {slot for _, _, slot in self.source_links[::2]}
+        for projection, distance, links in self.graph.find_sources(self.pointA, constants.SOURCE_SNAP_CANDIDATES):
+            if links[0][2] in linked_segments:
+                continue
+            self.source_points.append(projection)
+            self.source_links += [(node, distance + d, slot) for node, d, slot in links]
+
+    # The same route on graph, an extension of the graph of this one. The links of the source
+    # are kept, since a search may have used them, and new ones are added if new ways are closer.
+    # The target is snapped again.
+    def extend(self, graph):
+        route = PreparedRoute.__new__(PreparedRoute)
+        route.graph = graph
+        route.pointA = self.pointA
+        route.pointB = self.pointB
+        route.target_points = self.target_points
+        route.source_points = list(self.source_points)
+        route.source_links = list(self.source_links)
+        route.snap()
+        route._source_edges = None
+        route._target_distances = None
+        route.previous_way_count = self.graph.way_count
+        route.previous_source_link_count = len(self.source_links)
+        return route
+
+    # a route to the closest of points, pointB being the closest one as the crow flies
+    @classmethod
+    def to_nearest(cls, graph, pointA, points):
+        distances = get_flying_distances(
+            pointA['lat'], pointA['lon'], np.array([point['lat'] for point in points]),
+            np.array([point['lon'] for point in points]))
+        return cls(graph, pointA, points[int(np.argmin(distances))], points)
+
+    @classmethod
+    def from_map_data(cls, map_data, pointA, pointB):
+        return cls(Graph.from_map_data(map_data), pointA, pointB)
+
+    def is_routable(self):
+        return len(self.source_points) > 0 and self.target is not None
+
+    # the source links as the edge lists used by the search, the source slot of the i-th link being -1 - i
+    def get_source_edges(self):
+        if self._source_edges is None:
+            self._source_edges = (
+                [node for node, _, _ in self.source_links],
+                [distance for _, distance, _ in self.source_links],
+                [-1 - i for i in range(len(self.source_links))],
+                [slot for _, _, slot in self.source_links]
+            )
+        return self._source_edges
+
+    # flying distances from every node to the closest target, a lower bound of the walking distance
+    def get_target_distances(self):
+        if self._target_distances is None:
+            graph = self.graph
+            distances = None
+            for target in self.targets:
+                target_distances = get_flying_distances(
+                    graph.lats, graph.lons, graph.lats[target], graph.lons[target])
+                distances = target_distances if distances is None else np.minimum(distances, target_distances)
+            self._target_distances = distances.tolist()
+        return self._target_distances
+
+    # the links of the i-th entry point are the (2i)-th and (2i+1)-th
+    def get_source_point(self, link):
+        return self.source_points[link // 2]
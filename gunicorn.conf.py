@@ -0,0 +1,19 @@
+import gc
+import os
+
+# gunicorn app:app reads this file from the working directory.
+# The app is loaded and warmed up in the master process, then the workers are forked
+# and share its memory copy-on-write.
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# the replies are computed by the job threads, requests only queue them
+threads = 4
+preload_app = True
+
+def on_starting(server):
+    from warmup import warm_up
+    warm_up()
+    # the objects loaded so far are never collected, so the collections of the
+    # workers do not write to their pages and they stay shared
+    gc.freeze()
@@ -0,0 +1,141 @@
+import codecs
+import json
+import time
+import requests
+from instrumentation import count
+import constants
+
+# statuses of overloaded servers, worth retrying later or on a mirror
+RETRY_STATUSES = [429, 502, 503, 504]
+
+class HttpError(Exception):
+    pass
+
+# Keeps connections open between requests to the same servers, asks for gzip,
+# and retries failed requests with an exponential backoff, trying the urls in turn
+# so that a request given several mirrors fails over to the next one.
+class HttpClient:
+    def __init__(self, pool_size, retries, backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # Timeout (in seconds) bounds the whole call, so that a caller giving up does not leave
+    # it retrying: each attempt waits for what is left of it, and none starts once it has passed.
+    # The deadline is kept on the response, a streamed body being read before it by iter_counted_chunks.
+    def get(self, urls, params=None, timeout=None, stream=False):
+        if isinstance(urls, str):
+            urls = [urls]
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        error = None
+        attempts = 0
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.get_delay(attempt, error)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+            url = urls[attempt % len(urls)]
+            count('http requests')
+            attempts += 1
+            try:
+                response = self.session.get(url, params=params, stream=stream,
+                                            timeout=deadline - time.monotonic() if deadline is not None else None)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                print(f'{url} failed: {e}')
+                error = e
+                continue
+            if response.status_code in RETRY_STATUSES:
+                print(f'{url} answered {response.status_code}')
+                error = response
+                response.close()
+                continue
+            if not response.ok:
+                # the connection goes back to the pool
+                response.close()
+                response.raise_for_status()
+            response.deadline = deadline
+            return response
+        raise HttpError(f'no answer after {attempts} attempts: {error}')
+
+    # overloaded servers may tell how long to wait
+    def get_delay(self, attempt, error):
+        delay = self.backoff * 2 ** (attempt - 1)
+        if isinstance(error, requests.Response) and error.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(error.headers['Retry-After']))
+        return min(delay, constants.HTTP_MAX_RETRY_DELAY)
+
+    def get_json(self, urls, params=None, timeout=None):
+        response = self.get(urls, params, timeout, stream=True)
+        try:
+            return json.loads(b''.join(iter_counted_chunks(response.iter_content(constants.HTTP_CHUNK_SIZE),
+                                                           response.deadline)))
+        finally:
+            response.close()
+
+# the chunks of a body, which must be downloaded before the deadline of its call
+def iter_counted_chunks(chunks, deadline=None):
+    for chunk in chunks:
+        if deadline is not None and time.monotonic() > deadline:
+            raise HttpError('answer not downloaded before the timeout')
+        count('bytes downloaded', len(chunk))
+        yield chunk
+
+# Yields the items of the array under key in the json object sent in chunks of bytes,
+# without holding the whole document in memory. The items must be objects or arrays,
+# the members before the array are ignored, the ones after it are put in following when given.
+def iter_json_array(chunks, key, following=None):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    in_array = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        if not in_array:
+            start = buffer.find('"' + key + '"')
+            if start < 0:
+                continue
+            bracket = buffer.find('[', start)
+            if bracket < 0:
+                continue
+            position = bracket + 1
+            in_array = True
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                if following is not None:
+                    rest = buffer[position + 1:] + ''.join(text_decoder.decode(chunk) for chunk in chunks)
+                    try:
+                        members = json.loads('{"' + key + '": []' + rest + text_decoder.decode(b'', True))
+                    except json.JSONDecodeError:
+                        raise HttpError('truncated json object after the array ' + key)
+                    del members[key]
+                    following.update(members)
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item is not complete yet
+                break
+            yield item
+    if in_array:
+        raise HttpError('truncated json array ' + key)
+
+def iter_response_array(response, key, following=None):
+    try:
+        yield from iter_json_array(
+            iter_counted_chunks(response.iter_content(constants.HTTP_CHUNK_SIZE), response.deadline), key, following)
+    finally:
+        response.close()
+
+default_client = HttpClient(constants.HTTP_POOL_SIZE, constants.HTTP_RETRIES, constants.HTTP_RETRY_BACKOFF)
@@ -0,0 +1,163 @@
+import contextvars
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+import constants
+
+# Timings of the phases of each request (geocoding, map fetch, searches, sending...) and
+# counters (labels, bytes downloaded...). A request is traced from the thread that answers it
+# and the functions it runs in the fetch threads, the trace is printed as one json line when
+# the request ends and aggregated in memory for the /metrics endpoint of the app.
+# Phases and counters outside of a traced request are ignored.
+
+class RequestTrace:
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = time.time()
+        self.duration = None
+        self.phases = {}
+        self.counters = Counter()
+        self.values = {}
+        self.profile_path = None
+        # the fetch threads of the request record in it at the same time
+        self.lock = threading.Lock()
+
+    def add_phase(self, name, duration):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    def count(self, name, n):
+        with self.lock:
+            self.counters[name] += n
+
+    def set_value(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def to_dict(self):
+        with self.lock:
+            trace = {
+                'kind': self.kind,
+                'started_at': self.started_at,
+                'duration': self.duration,
+                'phases': {name: round(duration, 4) for name, duration in self.phases.items()},
+                'counters': dict(self.counters),
+                'values': dict(self.values)
+            }
+        if self.profile_path:
+            trace['profile'] = self.profile_path
+        return trace
+
+# totals of the traced requests since the start of the process and the last ones in full
+class Metrics:
+    def __init__(self, recent_size):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.request_counts = Counter()
+        self.request_durations = Counter()
+        # name: [count, total duration, max duration]
+        self.phases = {}
+        self.counters = Counter()
+        self.recent = deque(maxlen=recent_size)
+
+    def record(self, trace):
+        trace_dict = trace.to_dict()
+        with self.lock:
+            self.request_counts[trace.kind] += 1
+            self.request_durations[trace.kind] += trace.duration
+            for name, duration in trace_dict['phases'].items():
+                stats = self.phases.setdefault(name, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+            self.counters.update(trace_dict['counters'])
+            self.recent.append(trace_dict)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started_at,
+                'requests': {kind: {'count': count, 'mean_duration': self.request_durations[kind] / count}
+                             for kind, count in self.request_counts.items()},
+                'phases': {name: {'count': count, 'mean': total / count, 'max': longest}
+                           for name, (count, total, longest) in self.phases.items()},
+                'counters': dict(self.counters),
+                'recent': list(self.recent)
+            }
+
+metrics = Metrics(constants.METRICS_RECENT_REQUESTS)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# a fraction of the requests is profiled, the stats are saved in profile_directory
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', constants.PROFILE_SAMPLE_RATE))
+profile_directory = os.environ.get('PROFILE_DIR', constants.PROFILE_DIR)
+# only one profiler can be enabled at a time in the process
+profiler_lock = threading.Lock()
+
+def get_current_trace():
+    return current_trace.get()
+
+# Profiles the thread answering the request, which runs the searches. The fetches run in
+# other threads and mostly wait for the network, their phases tell how long they took.
+@contextmanager
+def sample_profile(trace):
+    if profile_sample_rate <= 0 or random.random() >= profile_sample_rate \
+            or not profiler_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        os.makedirs(profile_directory, exist_ok=True)
+        name = trace.kind.lower().replace(' ', '_')
+        trace.profile_path = os.path.join(
+            profile_directory, f'{name}_{time.strftime("%Y%m%d_%H%M%S")}_{threading.get_ident()}.prof')
+        profiler.dump_stats(trace.profile_path)
+    finally:
+        profiler_lock.release()
+
+@contextmanager
+def trace_request(kind):
+    trace = RequestTrace(kind)
+    token = current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        with sample_profile(trace):
+            yield trace
+    finally:
+        trace.duration = time.perf_counter() - start
+        current_trace.reset(token)
+        metrics.record(trace)
+        print('trace ' + json.dumps(trace.to_dict()))
+
+def record_phase(name, duration):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_phase(name, duration)
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+def count(name, n=1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.count(name, n)
+
+def set_value(name, value):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.set_value(name, value)
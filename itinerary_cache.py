@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+import time
+
+from caching import LRUCache
+
+# Messages of the walks already answered, so that repeated ones (daily commutes...) are answered
+# without geocoding, downloading maps or searching. Entries are kept in memory and in SQLite,
+# the least recently used ones being dropped, and expire after ttl seconds.
+# An entry records the maps it was computed on as [source, version] pairs, get_map_version(source)
+# giving the current version of a source: when one changed, the entry is dropped.
+
+class ItineraryCache:
+    def __init__(self, path, size, ttl, max_rows, get_map_version):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.get_map_version = get_map_version
+        self.memory_cache = LRUCache(size, ttl)
+        self.lock = threading.Lock()
+        with self.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS itineraries (
+                    key TEXT PRIMARY KEY, message TEXT, map_versions TEXT, created_at REAL, used_at REAL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS itineraries_used_at ON itineraries (used_at)")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            connection = sqlite3.connect(self.path, timeout=10)
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def is_current(self, map_versions):
+        return all(self.get_map_version(source) == version for source, version in map_versions)
+
+    def get(self, key):
+        entry = self.memory_cache.get(key)
+        if entry is None:
+            with self.transaction() as connection:
+                row = connection.execute(
+                    "SELECT message, map_versions, created_at FROM itineraries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE itineraries SET used_at = ? WHERE key = ?", (time.time(), key))
+            if row is None or time.time() - row[2] > self.ttl:
+                return None
+            entry = (row[0], json.loads(row[1]))
+            self.memory_cache.put(key, entry, self.ttl - (time.time() - row[2]))
+        message, map_versions = entry
+        if not self.is_current(map_versions):
+            self.invalidate(key)
+            return None
+        return message
+
+    def put(self, key, message, map_versions):
+        self.memory_cache.put(key, (message, map_versions))
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO itineraries VALUES (?, ?, ?, ?, ?)",
+                (key, message, json.dumps(map_versions), now, now))
+            connection.execute("DELETE FROM itineraries WHERE created_at < ?", (now - self.ttl,))
+            connection.execute("""
+                DELETE FROM itineraries WHERE key IN (
+                    SELECT key FROM itineraries ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_rows,))
+
+    def invalidate(self, key):
+        self.memory_cache.pop(key)
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM itineraries WHERE key = ?", (key,))
@@ -0,0 +1,261 @@
+from contextlib import contextmanager
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from caching import LRUCache
+
+# Background execution of the slow replies so that the webhook can answer twilio at once.
+# Jobs are a registered function name with json serializable arguments, so that they can
+# be stored by any backend. Workers are started on the first enqueue of each process,
+# which keeps them out of a pre-fork master.
+# A failed job is run again, unless it was registered as not retryable because it has
+# effects that must not be repeated, like sending sms.
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, name, args, job_id=None, status='queued', attempts=0,
+                 result=None, error=None, created_at=None, run_at=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.args = args
+        self.status = status   # queued, running, done, failed or timeout
+        self.attempts = attempts
+        self.result = result
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.run_at = run_at or self.created_at
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'attempts': self.attempts,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at
+        }
+
+# jobs are kept in memory, the last finished ones only for their status
+class InProcessBackend:
+    def __init__(self, maxsize, history_size=1000):
+        self.queue = queue.Queue(maxsize)
+        self.jobs = LRUCache(history_size)
+
+    def put(self, job):
+        delay = job.run_at - time.time()
+        if delay > 0:
+            self.jobs.put(job.id, job)
+            threading.Timer(delay, self.queue.put, [job]).start()
+            return
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise JobQueueFull()
+        self.jobs.put(job.id, job)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def save(self, job):
+        self.jobs.put(job.id, job)
+
+    def load(self, job_id):
+        return self.jobs.get(job_id)
+
+    # the jobs of a process that stopped are lost with it
+    def reset_stale_jobs(self, started_before, retryable_names):
+        return 0
+
+# Jobs are stored in a sqlite database, so they survive restarts and can be shared
+# by the processes of a server, workers poll it for queued jobs. The finished jobs are
+# deleted after history_ttl seconds, they hold phone numbers and messages.
+# The run_at of a running job is the time it started.
+class SQLiteBackend:
+    def __init__(self, path, maxsize, history_ttl, poll_interval=0.2):
+        self.path = path
+        self.maxsize = maxsize
+        self.history_ttl = history_ttl
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        with self.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, name TEXT, args TEXT, status TEXT, attempts INTEGER,
+                    result TEXT, error TEXT, created_at REAL, run_at REAL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_at)")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level='IMMEDIATE')
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def put(self, job):
+        with self.transaction() as connection:
+            queued = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.maxsize and job.attempts == 0:
+                raise JobQueueFull()
+            connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.name, json.dumps(job.args), job.status, job.attempts,
+                 json.dumps(job.result), job.error, job.created_at, job.run_at))
+            connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'timeout') AND created_at < ?",
+                (time.time() - self.history_ttl,))
+
+    def get(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            with self.transaction() as connection:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? ORDER BY run_at LIMIT 1",
+                    (time.time(),)).fetchone()
+                if row is not None:
+                    job = self.make_job(row)
+                    job.status = 'running'
+                    job.run_at = time.time()
+                    connection.execute(
+                        "UPDATE jobs SET status = 'running', run_at = ? WHERE id = ?", (job.run_at, job.id))
+                    return job
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def save(self, job):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, result = ?, error = ?, run_at = ? WHERE id = ?",
+                (job.status, job.attempts, json.dumps(job.result), job.error, job.run_at, job.id))
+
+    def load(self, job_id):
+        with self.transaction() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.make_job(row) if row is not None else None
+
+    # The jobs still running since before started_before were run by a process that stopped:
+    # the retryable ones are queued again, the others failed. Returns the number of jobs reset.
+    def reset_stale_jobs(self, started_before, retryable_names):
+        names = list(retryable_names)
+        placeholders = ', '.join('?' * len(names))
+        with self.transaction() as connection:
+            requeued = connection.execute(
+                f"UPDATE jobs SET status = 'queued', run_at = ? WHERE status = 'running' AND run_at < ? "
+                f"AND name IN ({placeholders})", [time.time(), started_before] + names).rowcount
+            failed = connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'interrupted' WHERE status = 'running' AND run_at < ?",
+                (started_before,)).rowcount
+        return requeued + failed
+
+    def make_job(self, row):
+        job_id, name, args, status, attempts, result, error, created_at, run_at = row
+        return Job(name, json.loads(args), job_id, status, attempts, json.loads(result), error, created_at, run_at)
+
+class JobQueue:
+    def __init__(self, backend, workers, timeout, max_retries, retry_delay):
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.functions = {}
+        self.retryable_names = set()
+        self.started_pid = None
+        self.lock = threading.Lock()
+
+    def register(self, name, function, retryable=True):
+        self.functions[name] = function
+        if retryable:
+            self.retryable_names.add(name)
+
+    # A job still running after twice the timeout was left by a process that stopped,
+    # since its runner would have marked it as timed out.
+    def start(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+            reset = self.backend.reset_stale_jobs(time.time() - 2 * self.timeout, self.retryable_names)
+            if reset:
+                print(f'{reset} interrupted jobs reset')
+            for _ in range(self.workers):
+                threading.Thread(target=self.work, daemon=True).start()
+
+    # returns the id of the job, raises JobQueueFull if too many jobs are waiting
+    def enqueue(self, name, *args):
+        if name not in self.functions:
+            raise ValueError('unknown job ' + name)
+        self.start()
+        job = Job(name, list(args))
+        self.backend.put(job)
+        return job.id
+
+    def get_status(self, job_id):
+        job = self.backend.load(job_id)
+        return job.to_dict() if job is not None else None
+
+    def work(self):
+        while True:
+            job = self.backend.get(timeout=1)
+            if job is not None:
+                self.run(job)
+
+    # the job runs in its own thread so that we can stop waiting for it after the timeout,
+    # a job that timed out is not retried since it may still be running
+    def run(self, job):
+        job.status = 'running'
+        job.attempts += 1
+        self.backend.save(job)
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = self.functions[job.name](*job.args)
+            except Exception:
+                outcome['error'] = traceback.format_exc()
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            job.status = 'timeout'
+            job.error = f'still running after {self.timeout}s'
+        elif 'error' in outcome:
+            print(outcome['error'])
+            job.error = outcome['error']
+            job.status = 'failed'
+            if job.attempts <= self.max_retries and job.name in self.retryable_names:
+                job.status = 'queued'
+                job.run_at = time.time() + self.retry_delay * job.attempts
+                try:
+                    self.backend.put(job)
+                    return
+                except JobQueueFull:
+                    job.status = 'failed'
+        else:
+            job.status = 'done'
+            job.result = outcome['result']
+        self.backend.save(job)
+
+def make_job_queue(backend_name, database_path, maxsize, workers, timeout, max_retries, retry_delay,
+                   history_ttl):
+    if backend_name == 'sqlite':
+        backend = SQLiteBackend(database_path, maxsize, history_ttl)
+    else:
+        backend = InProcessBackend(maxsize)
+    return JobQueue(backend, workers, timeout, max_retries, retry_delay)
@@ -0,0 +1,272 @@
+from array import array
+import math
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from caching import LRUCache
+
+# A tile holds the ways of one layer (the overpass filters of a kind of map) having nodes
+# in a cell of tile_size degrees, with all their nodes. It is stored in a .npz file of arrays:
+# node ids, lats and lons, way ids, names, highways and node ids concatenated with their offsets.
+# Only the tags used by the routing are kept, a way without name has name ''.
+
+def get_tile_index(lat, lon, tile_size):
+    return int(math.floor(lat / tile_size)), int(math.floor(lon / tile_size))
+
+def get_tiles_covering(south, west, north, east, tile_size):
+    i0, j0 = get_tile_index(south, west, tile_size)
+    i1, j1 = get_tile_index(north, east, tile_size)
+    return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+# The tiles grouped in rectangles of contiguous tiles, each one a sorted list of tiles:
+# the runs of consecutive tiles of each row, merged with the same runs of the next rows.
+def get_tile_rectangles(keys):
+    runs = []
+    for i, j in sorted(keys):
+        if runs and runs[-1][0] == i and runs[-1][2] == j - 1:
+            runs[-1][2] = j
+        else:
+            runs.append([i, j, j])
+    rectangles = []
+    # the last rectangle of each range of columns, as [i0, i1, j0, j1]
+    last_rectangles = {}
+    for i, j0, j1 in runs:
+        rectangle = last_rectangles.get((j0, j1))
+        if rectangle is not None and rectangle[1] == i - 1:
+            rectangle[1] = i
+        else:
+            rectangle = last_rectangles[(j0, j1)] = [i, i, j0, j1]
+            rectangles.append(rectangle)
+    return [[(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)] for i0, i1, j0, j1 in rectangles]
+
+# Collects the elements of the map of a rectangle of tiles into compact arrays as they are
+# downloaded, like GraphBuilder, then splits them into tiles with numpy.
+class TileBuilder:
+    def __init__(self, tile_size):
+        self.tile_size = tile_size
+        self.node_ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.way_ids = array('q')
+        self.way_names = []
+        self.way_highways = []
+        self.way_lengths = array('q')
+        self.way_nodes = array('q')
+
+    def add(self, element):
+        if element['type'] == 'node':
+            self.node_ids.append(element['id'])
+            self.lats.append(element['lat'])
+            self.lons.append(element['lon'])
+        elif element['type'] == 'way':
+            tags = element['tags']
+            self.way_ids.append(element['id'])
+            self.way_names.append(tags.get('name', ''))
+            self.way_highways.append(tags['highway'])
+            self.way_lengths.append(len(element['nodes']))
+            self.way_nodes.extend(element['nodes'])
+
+    # The tiles of keys, each one with the ways having a node in it, the ways with missing nodes
+    # being dropped. The nodes of a tile are in the order of their first way.
+    def build(self, keys):
+        node_ids = np.frombuffer(self.node_ids, dtype=np.int64)
+        lats = np.frombuffer(self.lats, dtype=np.float64)
+        lons = np.frombuffer(self.lons, dtype=np.float64)
+        way_ids = np.frombuffer(self.way_ids, dtype=np.int64)
+        way_names = np.array(self.way_names, dtype=str)
+        way_highways = np.array(self.way_highways, dtype=str)
+        way_lengths = np.frombuffer(self.way_lengths, dtype=np.int64)
+        way_nodes = np.frombuffer(self.way_nodes, dtype=np.int64)
+        slot_ways = np.repeat(np.arange(len(way_ids)), way_lengths)
+
+        # the index of the node of each slot of the ways
+        order = np.argsort(node_ids, kind='stable')
+        sorted_ids = node_ids[order]
+        positions = np.minimum(np.searchsorted(sorted_ids, way_nodes), max(len(sorted_ids) - 1, 0))
+        found = sorted_ids[positions] == way_nodes if len(sorted_ids) else np.zeros(len(way_nodes), dtype=bool)
+        slot_nodes = order[positions] if len(sorted_ids) else positions
+        complete_ways = np.ones(len(way_ids), dtype=bool)
+        complete_ways[slot_ways[~found]] = False
+        slot_i = np.floor(lats[slot_nodes] / self.tile_size).astype(np.int64)
+        slot_j = np.floor(lons[slot_nodes] / self.tile_size).astype(np.int64)
+
+        tiles = {}
+        for i, j in keys:
+            tile_ways = np.zeros(len(way_ids), dtype=bool)
+            tile_ways[slot_ways[found & (slot_i == i) & (slot_j == j)]] = True
+            tile_ways &= complete_ways
+            tile_slots = tile_ways[slot_ways]
+            tile_way_nodes = way_nodes[tile_slots]
+            _, first_slots = np.unique(tile_way_nodes, return_index=True)
+            first_slots.sort()
+            tile_nodes = slot_nodes[tile_slots][first_slots]
+            tiles[(i, j)] = {
+                'node_ids': tile_way_nodes[first_slots],
+                'lats': lats[tile_nodes],
+                'lons': lons[tile_nodes],
+                'way_ids': way_ids[tile_ways],
+                'way_names': way_names[tile_ways],
+                'way_highways': way_highways[tile_ways],
+                'way_offsets': np.concatenate([[0], np.cumsum(way_lengths[tile_ways])]).astype(np.int64),
+                'way_nodes': tile_way_nodes,
+                'fetched_at': np.array(time.time())
+            }
+        return tiles
+
+# yields the elements of the tiles in the overpass json format, each node and way only once
+def get_tiles_elements(tiles):
+    seen_nodes = set()
+    seen_ways = set()
+    for tile in tiles:
+        for node_id, lat, lon in zip(tile['node_ids'].tolist(), tile['lats'].tolist(), tile['lons'].tolist()):
+            if node_id not in seen_nodes:
+                seen_nodes.add(node_id)
+                yield {'type': 'node', 'id': node_id, 'lat': lat, 'lon': lon}
+        way_offsets = tile['way_offsets'].tolist()
+        way_nodes = tile['way_nodes'].tolist()
+        for k, (way_id, name, highway) in enumerate(zip(
+                tile['way_ids'].tolist(), tile['way_names'].tolist(), tile['way_highways'].tolist())):
+            if way_id not in seen_ways:
+                seen_ways.add(way_id)
+                tags = {'highway': highway, 'name': name} if name else {'highway': highway}
+                yield {'type': 'way', 'id': way_id, 'nodes': way_nodes[way_offsets[k]:way_offsets[k+1]], 'tags': tags}
+
+# Cache of map tiles on disk. fetch(layer, south, west, north, east) must return the elements
+# of the overpass map of the layer in this bounding box, they are read once. Tiles older than
+# ttl seconds are fetched again, and when the files take more than max_bytes, the least
+# recently used ones are deleted.
+# The threads missing the same tile wait for the one fetching it, and the processes sharing
+# the directory write their tiles through files of their own.
+# The modification time of a file is when the tile was fetched, its access time the last
+# time it was read, used to evict the least recently used tiles.
+class TileStore:
+    def __init__(self, directory, fetch, tile_size, ttl, max_bytes, memory_tiles=64):
+        self.directory = directory
+        self.fetch = fetch
+        self.tile_size = tile_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_cache = LRUCache(memory_tiles, ttl)
+        self.tile_locks = {}
+        self.tile_locks_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, layer, key):
+        return os.path.join(self.directory, f'{layer}_{key[0]}_{key[1]}.npz')
+
+    # the reads from memory count as accesses of the file too, so that the hottest tiles are not evicted
+    def touch(self, path):
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    # a tile is kept in memory until it is ttl seconds old, like on the disk
+    def load_tile(self, layer, key):
+        path = self.get_path(layer, key)
+        tile = self.memory_cache.get((layer, key))
+        if tile is not None:
+            self.touch(path)
+            return tile
+        try:
+            with np.load(path) as data:
+                tile = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        age = time.time() - float(tile['fetched_at'])
+        if age > self.ttl:
+            return None
+        self.touch(path)
+        self.memory_cache.put((layer, key), tile, self.ttl - age)
+        return tile
+
+    def save_tile(self, layer, key, tile):
+        path = self.get_path(layer, key)
+        descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                np.savez_compressed(f, **tile)
+            fetched_at = float(tile['fetched_at'])
+            os.utime(temporary_path, (fetched_at, fetched_at))
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self.memory_cache.put((layer, key), tile)
+
+    def get_tile_lock(self, layer, key):
+        with self.tile_locks_lock:
+            return self.tile_locks.setdefault((layer, key), threading.Lock())
+
+    # The tiles of the rectangle are locked in their order, so that threads locking rectangles
+    # that overlap do not wait for each other. The tiles fetched meanwhile by another thread are read.
+    def fetch_rectangle(self, layer, keys):
+        locks = [self.get_tile_lock(layer, key) for key in keys]
+        for lock in locks:
+            lock.acquire()
+        try:
+            tiles = {key: self.load_tile(layer, key) for key in keys}
+            missing = [key for key, tile in tiles.items() if tile is None]
+            for rectangle in get_tile_rectangles(missing):
+                tiles.update(self.fetch_tiles(layer, rectangle))
+            return tiles
+        finally:
+            for lock in locks:
+                lock.release()
+
+    # downloads the bounding box of a rectangle of tiles at once and splits it into tiles
+    def fetch_tiles(self, layer, keys):
+        south = min(i for i, _ in keys) * self.tile_size
+        west = min(j for _, j in keys) * self.tile_size
+        north = (max(i for i, _ in keys) + 1) * self.tile_size
+        east = (max(j for _, j in keys) + 1) * self.tile_size
+        print(f'fetching {len(keys)} {layer} tiles')
+        builder = TileBuilder(self.tile_size)
+        for element in self.fetch(layer, south, west, north, east):
+            builder.add(element)
+        tiles = builder.build(keys)
+        for key, tile in tiles.items():
+            self.save_tile(layer, key, tile)
+        self.evict()
+        return tiles
+
+    def get_tiles(self, layer, keys):
+        tiles = {key: self.load_tile(layer, key) for key in keys}
+        missing = [key for key, tile in tiles.items() if tile is None]
+        for rectangle in get_tile_rectangles(missing):
+            tiles.update(self.fetch_rectangle(layer, rectangle))
+        return [tiles[key] for key in keys]
+
+    def iter_elements(self, layer, south, west, north, east):
+        keys = get_tiles_covering(south, west, north, east, self.tile_size)
+        return get_tiles_elements(self.get_tiles(layer, keys))
+
+    # when the tile was fetched, None if it is not cached or too old, read without loading the tile
+    def get_tile_version(self, layer, key):
+        try:
+            fetched_at = os.stat(self.get_path(layer, key)).st_mtime
+        except FileNotFoundError:
+            return None
+        return fetched_at if time.time() - fetched_at <= self.ttl else None
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                files.append((stat.st_atime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
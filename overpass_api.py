@@ -1,32 +1,64 @@
-import requests
+import hashlib
 import json
-import datetime
+import math
+import os
 import re
+import numpy as np
 from geometry_utils import get_flying_distance, get_midpoint
+from graph import Graph, GraphBuilder
+from map_tiles import TileStore, get_tiles_covering
+from caching import LRUCache
+from http_client import default_client, iter_response_array
+import address_index
+import constants
 
-overpass_index = 0
-def query_overpass(query):
-    # temporary hacks used for manual tests
-    global overpass_index
-    # to be used with following query
-    # curl -X POST -F 'Body=Walk from 156 avenue loubet, dunkerque to 168 avenue de la libération' localhost:5000
-    # recorded_results = ['overpass_query_18:00:34.313883.json', 'overpass_query_18:00:51.380400.json', 'overpass_query_20:03:23.125522.json']
-    # curl -X POST -F 'Body=Walk from 41 rue joseph jacquard, dunkerque to 52 rue pierre et marie curie' localhost:5000
-    # recorded_results = ['overpass_query_17:47:21.136546.json', 'overpass_query_17:47:45.812696.json', 'overpass_query_17:47:48.224438.json']
-    # request in paris to 5 av republique
-    # recorded_results = ['overpass_query_17:59:02.245797.json', 'overpass_query_17:59:15.354684.json', 'overpass_query_17:59:16.072067.json', 'overpass_query_18:25:19.209103.json']
-    recorded_results = []
-    if overpass_index < len(recorded_results):
-        with open(recorded_results[overpass_index]) as json_file:
-            result = json.load(json_file)
-        overpass_index += 1
-        return result
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    response = requests.get(overpass_url, params={'data': query})
-    data = response.json()
-    # with open(f'overpass_query_{str(datetime.datetime.now().time())}.json', 'w') as outfile:
-    #     json.dump(data, outfile)
-    return data
+# a local stand-in server can be given for tests
+overpass_endpoints = os.environ['OVERPASS_ENDPOINTS'].split(',') if os.environ.get('OVERPASS_ENDPOINTS') \
+    else constants.OVERPASS_ENDPOINTS
+
+# In record mode, the answers of overpass are saved in the fixtures directory under the hash
+# of their query, in replay mode they are read from there instead of asking overpass,
+# so that routing can be tested and measured offline.
+overpass_mode = os.environ.get('OVERPASS_MODE', 'live')
+overpass_fixtures_directory = os.environ.get('OVERPASS_FIXTURES_DIR', constants.OVERPASS_FIXTURES_DIR)
+
+class OverpassError(Exception):
+    pass
+
+def get_fixture_path(query):
+    # the indentation of the queries is not significant
+    normalized_query = '\n'.join(line.strip() for line in query.strip().splitlines())
+    query_hash = hashlib.sha1(normalized_query.encode()).hexdigest()
+    return os.path.join(overpass_fixtures_directory, query_hash + '.json')
+
+def query_overpass(query, timeout=constants.OVERPASS_TIMEOUT):
+    return {'elements': list(iter_overpass_elements(query, timeout))}
+
+# the elements of the answer are parsed as they are downloaded
+def iter_overpass_elements(query, timeout=constants.OVERPASS_TIMEOUT):
+    if overpass_mode == 'replay':
+        path = get_fixture_path(query)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'no recorded answer for query {query}')
+        with open(path) as json_file:
+            return iter(json.load(json_file)['elements'])
+    response = default_client.get(overpass_endpoints, params={'data': query}, timeout=timeout, stream=True)
+    elements = iter_complete_elements(response)
+    if overpass_mode == 'record':
+        elements = list(elements)
+        os.makedirs(overpass_fixtures_directory, exist_ok=True)
+        with open(get_fixture_path(query), 'w') as outfile:
+            json.dump({'query': query, 'elements': elements}, outfile)
+        return iter(elements)
+    return elements
+
+# Overpass answers the queries it stopped, running out of time or memory, with the elements
+# found so far and a remark after them, such a partial map is not used.
+def iter_complete_elements(response):
+    following = {}
+    yield from iter_response_array(response, 'elements', following)
+    if 'remark' in following:
+        raise OverpassError(following['remark'])
 
 def prepare_letter_for_regex(letter, capitalize):
     if letter == 'a':
@@ -63,7 +95,25 @@ def prepare_noun_for_regex(noun):
         letters[i] = prepare_letter_for_regex(letters[i], False)
     return ''.join(letters)
 
+street_location_cache = LRUCache(constants.STREET_LOCATION_CACHE_SIZE)
+offline_address_index = None
+address_index_path = os.environ.get('ADDRESS_INDEX_PATH', constants.ADDRESS_INDEX_PATH)
+if address_index_path and os.path.exists(address_index_path):
+    offline_address_index = address_index.AddressIndex.load(address_index_path)
+
+# looks for the address in the cache, then in the offline index, then asks overpass
 def get_street_location(n, way, city):
+    key = address_index.get_address_key(n, way, city)
+    point = street_location_cache.get(key)
+    if point is None and offline_address_index is not None:
+        point = offline_address_index.lookup(n, way, city)
+    if point is None:
+        point = query_street_location(n, way, city)
+    street_location_cache.put(key, point)
+    # the caller may modify it
+    return dict(point)
+
+def query_street_location(n, way, city):
     city_nouns = re.split("-|'| ", city.lower())
     city_nouns = [prepare_noun_for_regex(noun) for noun in city_nouns if len(noun) > 3]
     city_regex = '.*'.join(city_nouns)
@@ -85,34 +135,158 @@ def get_street_location(n, way, city):
     point =  query_overpass(street_location_query)['elements'][0]
     return point
 
-def get_map_between_points(pointA, pointB):
+# overpass filters of the ways of each kind of map, the full map adds the named ways
+MAP_LAYERS = {
+    'filtered': ['way[highway][foot=yes]', 'way[highway~"^(footway|path|pedestrian)$"]'],
+    'full': ['way[highway][foot=yes]', 'way[highway][name]', 'way[highway~"^(footway|path|pedestrian)$"]']
+}
+
+# The ways are given with their tags and the ids of their nodes, then the nodes with only
+# their coordinates (skel), both in the order of the storage of overpass (qt) which saves it a sort.
+# Settings such as [timeout:900] are added to [out:json].
+def get_map_query(statements, settings=''):
+    return f"""
+    [out:json]{settings};
+    ({statements})->.ways;
+    .ways out body qt;
+    node(w.ways);
+    out skel qt;
+    """
+
+# The regional graphs are searched without fallback, on the full map without the roads
+# closed to pedestrians: motorways, trunks, links and ways tagged foot=no.
+REGIONAL_WAY_FILTERS = [
+    'way[highway][foot=yes]',
+    'way[highway][name][highway!~"^(motorway|trunk|.*_link)$"][foot!=no]',
+    'way[highway~"^(footway|path|pedestrian)$"][foot!=no]'
+]
+
+def iter_way_filters_elements(way_filters, south, west, north, east, timeout=constants.OVERPASS_TIMEOUT, settings=''):
+    statements = ''.join(f'{way_filter}({south},{west},{north},{east});' for way_filter in way_filters)
+    return iter_overpass_elements(get_map_query(statements, settings), timeout)
+
+def iter_map_layer_elements(layer, south, west, north, east, timeout=constants.OVERPASS_TIMEOUT):
+    return iter_way_filters_elements(MAP_LAYERS[layer], south, west, north, east, timeout)
+
+tile_cache_directory = os.environ.get('MAP_TILE_CACHE_DIR', constants.MAP_TILE_CACHE_DIR)
+tile_store = TileStore(
+    tile_cache_directory, iter_map_layer_elements, constants.MAP_TILE_SIZE,
+    constants.MAP_TILE_TTL, constants.MAP_TILE_CACHE_MAX_BYTES) if tile_cache_directory else None
+
+# the bounding box of the disk of the around: queries below
+def get_tiles_bbox(pointA, pointB):
+    radius = get_flying_distance(pointA, pointB) * 0.6
+    midpoint = get_midpoint(pointA, pointB)
+    dlat = radius / (6370 * math.pi / 180)
+    dlon = dlat / max(0.01, math.cos(math.radians(midpoint['lat'])))
+    return midpoint['lat'] - dlat, midpoint['lon'] - dlon, midpoint['lat'] + dlat, midpoint['lon'] + dlon
+
+def iter_tiles_elements(layer, pointA, pointB):
+    return tile_store.iter_elements(layer, *get_tiles_bbox(pointA, pointB))
+
+# The tiles of the maps of layers between the points, as [source, version] pairs: the source
+# is ['tile', layer, i, j] and the version the time it was fetched, None if it is not cached.
+# Without tiles, the maps have no version.
+def get_map_versions_between_points(pointA, pointB, layers):
+    if tile_store is None:
+        return []
+    keys = get_tiles_covering(*get_tiles_bbox(pointA, pointB), tile_store.tile_size)
+    return [[['tile', layer, i, j], tile_store.get_tile_version(layer, (i, j))]
+            for layer in layers for i, j in keys]
+
+def get_tile_version(layer, i, j):
+    return tile_store.get_tile_version(layer, (i, j)) if tile_store is not None else None
+
+def iter_map_elements_between_points(pointA, pointB):
+    if tile_store is not None:
+        return iter_tiles_elements('filtered', pointA, pointB)
     distance = get_flying_distance(pointA, pointB)
     midpoint = get_midpoint(pointA, pointB)
-    map_query = f"""
-    [out:json];
-    (
+    return iter_overpass_elements(get_map_query(f"""
       way[highway][foot=yes](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
-      way[highway~"^(footway|path|pedestrian)$"](around:{distance*0.6},{midpoint['lat']},{midpoint['lon']});
-    );
-    (._;>;);
-    out;
-    """
-    #print(map_query)
-    map_data = query_overpass(map_query)
-    return map_data
+      way[highway~"^(footway|path|pedestrian)$"](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
+    """))
 
-def get_full_map_between_points(pointA, pointB):
+def iter_full_map_elements_between_points(pointA, pointB):
+    if tile_store is not None:
+        return iter_tiles_elements('full', pointA, pointB)
     distance = get_flying_distance(pointA, pointB)
     midpoint = get_midpoint(pointA, pointB)
-    map_query = f"""
-    [out:json];
-    (
+    return iter_overpass_elements(get_map_query(f"""
       way[highway][foot=yes](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
       way[highway][name](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
-      way[highway~"^(footway|path|pedestrian)$"](around:{distance*0.6},{midpoint['lat']},{midpoint['lon']});
-    );
-    (._;>;);
-    out;
-    """
-    map_data = query_overpass(map_query)
-    return map_data
\ No newline at end of file
+      way[highway~"^(footway|path|pedestrian)$"](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
+    """))
+
+# The ways of the full map that are not in the filtered one, to extend its graph when no path
+# is found on it. Overpass gives them with their nodes, from the tiles they are kept by
+# get_tiles_delta_between_points.
+def iter_delta_elements_between_points(pointA, pointB):
+    distance = get_flying_distance(pointA, pointB)
+    midpoint = get_midpoint(pointA, pointB)
+    return iter_overpass_elements(get_map_query(f"""
+      (
+        way[highway][name](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
+        - (
+          way[highway][foot=yes](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
+          way[highway~"^(footway|path|pedestrian)$"](around:{1000*distance*0.6},{midpoint['lat']},{midpoint['lon']});
+        );
+      );
+    """))
+
+# the ways of the full tiles missing from the filtered ones, which were just loaded for the map,
+# taken from the arrays of the tiles without making their elements
+def get_tiles_delta_between_points(pointA, pointB):
+    keys = get_tiles_covering(*get_tiles_bbox(pointA, pointB), tile_store.tile_size)
+    delta = GraphBuilder()
+    delta.known_way_ids = {way_id for tile in tile_store.get_tiles('filtered', keys) for way_id in tile['way_ids'].tolist()}
+    for tile in tile_store.get_tiles('full', keys):
+        # the ways without name are named by their highway, as by get_way_name
+        way_names = np.where(tile['way_names'] == '', tile['way_highways'], tile['way_names'])
+        delta.add_arrays(tile['node_ids'], tile['lats'], tile['lons'], tile['way_ids'], way_names,
+                         tile['way_highways'], tile['way_offsets'], tile['way_nodes'])
+    return delta
+
+# the delta collected in a GraphBuilder in the fetch thread, to be merged into the graph of the filtered map
+def get_delta_between_points(pointA, pointB):
+    if tile_store is not None:
+        return get_tiles_delta_between_points(pointA, pointB)
+    delta = GraphBuilder()
+    for element in iter_delta_elements_between_points(pointA, pointB):
+        delta.add(element)
+    return delta
+
+# the full map in the disk of radius (in km) around point
+def iter_map_elements_around_point(point, radius):
+    if tile_store is not None:
+        dlat = radius / (6370 * math.pi / 180)
+        dlon = dlat / max(0.01, math.cos(math.radians(point['lat'])))
+        return tile_store.iter_elements(
+            'full', point['lat'] - dlat, point['lon'] - dlon, point['lat'] + dlat, point['lon'] + dlon)
+    around = f"(around:{1000*radius},{point['lat']},{point['lon']})"
+    return iter_overpass_elements(get_map_query(''.join(way_filter + around + ';' for way_filter in MAP_LAYERS['full'])))
+
+def get_graph_around_point(point, radius):
+    return Graph.from_elements(iter_map_elements_around_point(point, radius))
+
+# the points of interest of a kind of constants.POI_KINDS in the disk of radius (in km) around point,
+# as {'lat', 'lon', 'name'} dicts
+def get_pois_around_point(kind, point, radius):
+    around = f"(around:{1000*radius},{point['lat']},{point['lon']})"
+    statements = ''.join(poi_filter + around + ';' for poi_filter in constants.POI_KINDS[kind]['filters'])
+    pois = []
+    for element in iter_overpass_elements(f'[out:json];({statements});out body qt;'):
+        tags = element.get('tags', {})
+        pois.append({'lat': element['lat'], 'lon': element['lon'],
+                     'name': tags.get('name') or tags.get('brand') or tags.get('operator') or ''})
+    return pois
+
+def get_map_between_points(pointA, pointB):
+    return {'elements': list(iter_map_elements_between_points(pointA, pointB))}
+
+# the graphs are built as the elements are downloaded, without keeping them
+def get_graph_between_points(pointA, pointB):
+    return Graph.from_elements(iter_map_elements_between_points(pointA, pointB))
+
+def get_full_graph_between_points(pointA, pointB):
+    return Graph.from_elements(iter_full_map_elements_between_points(pointA, pointB))
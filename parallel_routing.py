@@ -0,0 +1,100 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import multiprocessing
+import os
+import tempfile
+import threading
+import uuid
+
+from caching import LRUCache
+from graph import PreparedRoute
+from regional_graph import RegionalGraph
+from routing_engine import RoutingEngine, SearchCancelled
+import constants
+
+# The searches of a walk in a region run at once in a pool of processes, each on a core of its
+# own instead of waiting for the gil. The processes memory-map the regional graphs from their
+# directory, like the workers, and keep them loaded with their search lists and spatial indexes
+# for the next walks in the region. The searches of a walk are submitted in a SearchRace: when
+# its result is known, those that have not started are cancelled, and those that are running
+# stop at their next budget check instead of using a core until their budget runs out.
+# A pool whose process died, killed for its memory..., refuses new searches: the walk
+# that sees it is searched in process and the next one makes a new pool.
+
+# regional graphs loaded by a process of the pool, by directory and build time,
+# so that a region built again is loaded again
+loaded_regions = LRUCache(constants.PARALLEL_ROUTING_LOADED_GRAPHS)
+
+def get_loaded_region(directory, built_at):
+    region = loaded_regions.get((directory, built_at))
+    if region is None:
+        region = RegionalGraph.load(directory)
+        loaded_regions.put((directory, built_at), region)
+    return region
+
+# Runs in a process of the pool, the endpoints are snapped there. The search stops once
+# cancel_path exists, returning None.
+def search_region(cancel_path, directory, built_at, pointA, pointB, force_short_sms, sms_to_meter_preference):
+    route = PreparedRoute(get_loaded_region(directory, built_at).graph, pointA, pointB)
+    engine = RoutingEngine(force_short_sms, sms_to_meter_preference, constants.ROUTING_STRATEGY,
+                           constants.SEARCH_LABEL_BUDGET, constants.SEARCH_TIME_BUDGET)
+    engine.cancelled = functools.partial(os.path.exists, cancel_path)
+    try:
+        return engine.search(route)
+    except SearchCancelled:
+        return None
+
+process_pool = None
+process_pool_pid = None
+process_pool_lock = threading.Lock()
+
+# The pool is made by the first search of each process, since it cannot be shared by forked
+# workers. Its processes are spawned rather than forked from a process running threads.
+def get_process_pool():
+    global process_pool, process_pool_pid
+    with process_pool_lock:
+        if process_pool is None or process_pool_pid != os.getpid():
+            process_pool = ProcessPoolExecutor(
+                constants.PARALLEL_ROUTING_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+            process_pool_pid = os.getpid()
+        return process_pool
+
+# the broken pool is dropped, unless another thread already replaced it
+def reset_process_pool(pool):
+    global process_pool
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False)
+
+# The searches of a walk in the pool. Those still running when it is cancelled see its marker
+# file, which is removed once they have all stopped.
+class SearchRace:
+    def __init__(self):
+        self.pool = get_process_pool()
+        self.cancel_path = os.path.join(tempfile.gettempdir(), 'sms_app_cancel_' + uuid.uuid4().hex)
+        self.futures = []
+        self.running = 0
+        self.lock = threading.Lock()
+
+    # a future of the itinerary on a region loaded from its directory, in the format of RoutingEngine.search
+    def submit_regional_search(self, region, pointA, pointB, force_short_sms, sms_to_meter_preference):
+        future = self.pool.submit(search_region, self.cancel_path, region.directory, region.built_at,
+                                  pointA, pointB, force_short_sms, sms_to_meter_preference)
+        self.futures.append(future)
+        return future
+
+    def cancel(self):
+        running = [future for future in self.futures if not future.cancel() and not future.done()]
+        if not running:
+            return
+        self.running = len(running)
+        open(self.cancel_path, 'w').close()
+        for future in running:
+            future.add_done_callback(self.search_stopped)
+
+    def search_stopped(self, future):
+        with self.lock:
+            self.running -= 1
+            if self.running == 0:
+                os.remove(self.cancel_path)
@@ -0,0 +1,147 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from weather import get_rain_message, get_forecast_ttl
+import constants
+
+# Rain alerts sent every hour to the subscribers of a town when it is likely to rain.
+# The forecast of each town is fetched once per cycle whatever its number of subscribers,
+# and the sms are sent concurrently, under the rate limit of the sms sender.
+#
+# python rain_alerts.py runs the cycles, in a single process of its own. It sees the
+# subscriptions made through the app when both use the postgres database of DATABASE_URL,
+# as on heroku where each process has its own ephemeral disk. Without it they are
+# kept in a local sqlite file, for a single machine.
+
+# the queries are written with ? placeholders, execute(query, params) returns a cursor
+class SubscriptionStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.create_tables()
+
+    def create_tables(self):
+        with self.transaction() as execute:
+            execute("""
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    phone_number TEXT, insee TEXT, created_at DOUBLE PRECISION, PRIMARY KEY (phone_number, insee)
+                )""")
+            execute("CREATE INDEX IF NOT EXISTS subscriptions_insee ON subscriptions (insee)")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            connection = sqlite3.connect(self.path, timeout=10)
+            try:
+                with connection:
+                    yield connection.execute
+            finally:
+                connection.close()
+
+    def subscribe(self, phone_number, insee):
+        with self.transaction() as execute:
+            execute("INSERT INTO subscriptions VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+                    (phone_number, insee, time.time()))
+
+    # from all the towns if insee is not given, returns the number of subscriptions removed
+    def unsubscribe(self, phone_number, insee=None):
+        with self.transaction() as execute:
+            if insee is None:
+                cursor = execute("DELETE FROM subscriptions WHERE phone_number = ?", (phone_number,))
+            else:
+                cursor = execute(
+                    "DELETE FROM subscriptions WHERE phone_number = ? AND insee = ?", (phone_number, insee))
+            return cursor.rowcount
+
+    def get_subscribers_by_insee(self):
+        subscribers = defaultdict(list)
+        with self.transaction() as execute:
+            for phone_number, insee in execute("SELECT phone_number, insee FROM subscriptions", ()).fetchall():
+                subscribers[insee].append(phone_number)
+        return subscribers
+
+# the same subscriptions in a postgres database, shared by all the processes
+class PostgresSubscriptionStore(SubscriptionStore):
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.create_tables()
+
+    @contextmanager
+    def transaction(self):
+        import psycopg2
+        with self.lock:
+            connection = psycopg2.connect(self.url)
+            try:
+                with connection, connection.cursor() as cursor:
+                    def execute(query, params=()):
+                        cursor.execute(query.replace('?', '%s'), params)
+                        return cursor
+                    yield execute
+            finally:
+                connection.close()
+
+def make_subscription_store(database_url, path):
+    if database_url:
+        return PostgresSubscriptionStore(database_url)
+    return SubscriptionStore(path)
+
+class RainAlerts:
+    def __init__(self, store, send, workers):
+        self.store = store
+        self.send = send
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rain-alert')
+
+    # returns the number of forecasts fetched and of sms sent
+    def run_cycle(self):
+        forecasts = 0
+        futures = []
+        for insee, phone_numbers in self.store.get_subscribers_by_insee().items():
+            try:
+                message = get_rain_message(insee)
+            except Exception:
+                print(traceback.format_exc())
+                continue
+            forecasts += 1
+            if not message:
+                continue
+            futures += [self.executor.submit(self.send, message, phone_number)
+                        for phone_number in phone_numbers]
+        sent = 0
+        for future in futures:
+            try:
+                future.result()
+                sent += 1
+            except Exception:
+                print(traceback.format_exc())
+        print(f'rain alerts: {forecasts} forecasts fetched, {sent} sms sent')
+        return forecasts, sent
+
+    # a cycle just after each forecast is issued
+    def run_forever(self):
+        while True:
+            time.sleep(get_forecast_ttl())
+            self.run_cycle()
+
+subscription_store = None
+subscription_store_lock = threading.Lock()
+
+# the store is made on first use, so that importing the module opens no database
+def get_subscription_store():
+    global subscription_store
+    with subscription_store_lock:
+        if subscription_store is None:
+            subscription_store = make_subscription_store(
+                os.environ.get('DATABASE_URL'),
+                os.environ.get('RAIN_ALERTS_DATABASE', constants.RAIN_ALERTS_DATABASE))
+        return subscription_store
+
+if __name__ == "__main__":
+    from sms_delivery import make_sms_sender
+    RainAlerts(get_subscription_store(), make_sms_sender().send, constants.SMS_SEND_WORKERS).run_forever()
@@ -0,0 +1,61 @@
+import fcntl
+import os
+import threading
+import time
+
+# Token bucket shared by threads: tokens are added at rate per second up to capacity,
+# and each acquire takes one, waiting for it if the bucket is empty.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+# The same token bucket shared by the processes of a machine through a file, which holds
+# the tokens and the time they were counted at. The file is locked while a token is taken.
+class FileTokenBucket:
+    def __init__(self, path, rate, capacity):
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+
+    # takes a token and returns 0, or returns how long to wait for one
+    def take(self):
+        with open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state = state_file.read().split()
+            now = time.time()
+            tokens = self.capacity
+            if len(state) == 2:
+                tokens = min(self.capacity, float(state[0]) + max(0.0, now - float(state[1])) * self.rate)
+            delay = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if tokens >= 1:
+                tokens -= 1
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(f'{tokens} {now}')
+        return delay
+
+    def acquire(self):
+        while True:
+            delay = self.take()
+            if delay == 0:
+                return
+            time.sleep(delay)
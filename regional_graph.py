@@ -0,0 +1,321 @@
+import heapq
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+
+from graph import Graph
+from routing_engine import Label, RoutingEngine
+import constants
+
+# Walking graphs of the regions we serve, built offline from an overpass extract with the
+# filters of the full maps, with a contraction hierarchy answering shortest itinerary queries
+# by settling a few hundred nodes instead of the whole map.
+#
+# python regional_graph.py [region ...]   builds the regions of constants.ROUTING_REGIONS
+#
+# The build runs in pure python and its time grows faster than the number of nodes, as the
+# nodes contracted last have many neighbors: about 5s for 2.5k nodes, 40s for 10k.
+# Regions above constants.REGION_MAX_NODES are refused, they are to be split.
+#
+# The contraction hierarchy orders the nodes by importance and contracts them in that order:
+# a node is removed from the graph and shortcuts are added between its neighbors when it
+# was on their only shortest path. Queries then only go up the order from both ends.
+# Edges are stored upwards, from each node to its neighbors of higher rank at the time
+# of its contraction, shortcuts keeping the node they skip to be unpacked.
+
+# limited dijkstra from u, not going through excluded, looking for paths to the targets
+# shorter than the ones through the contracted node, it stops once they are all settled
+def find_witnesses(adjacency, u, excluded, targets, max_distance, settled_limit):
+    distances = {u: 0}
+    queue = [(0, u)]
+    settled = 0
+    remaining = set(targets)
+    while queue and settled < settled_limit and remaining:
+        distance, node = heapq.heappop(queue)
+        if distance > max_distance:
+            break
+        if distance > distances[node]:
+            continue
+        settled += 1
+        remaining.discard(node)
+        for neighbor, length in adjacency[node].items():
+            if neighbor == excluded:
+                continue
+            new_distance = distance + length
+            if new_distance < distances.get(neighbor, math.inf):
+                distances[neighbor] = new_distance
+                heapq.heappush(queue, (new_distance, neighbor))
+    return distances
+
+# the shortcuts needed to contract v, as (u, w, length) tuples
+def get_shortcuts(adjacency, v, settled_limit):
+    neighbors = list(adjacency[v].items())
+    shortcuts = []
+    for i, (u, length_u) in enumerate(neighbors):
+        others = neighbors[i + 1:]
+        if not others:
+            break
+        max_distance = length_u + max(length for _, length in others)
+        witnesses = find_witnesses(adjacency, u, v, [w for w, _ in others], max_distance, settled_limit)
+        for w, length_w in others:
+            if witnesses.get(w, math.inf) > length_u + length_w:
+                shortcuts.append((u, w, length_u + length_w))
+    return shortcuts
+
+class ContractionHierarchy:
+    def __init__(self, ranks, up_offsets, up_target, up_length, up_middle):
+        self.ranks = ranks
+        self.up_offsets = up_offsets
+        self.up_target = up_target
+        self.up_length = up_length
+        self.up_middle = up_middle    # the contracted node a shortcut skips, -1 for edges of the graph
+
+    SAVED_ARRAYS = ['ranks', 'up_offsets', 'up_target', 'up_length', 'up_middle']
+
+    @classmethod
+    def build(cls, graph):
+        node_count = graph.node_count
+        # parallel edges are merged into the shortest one
+        adjacency = [{} for _ in range(node_count)]
+        sources = graph.way_nodes[graph.edge_source_slot].tolist()
+        for u, v, length in zip(sources, graph.edge_target.tolist(), graph.edge_length.tolist()):
+            if u != v and length < adjacency[u].get(v, math.inf):
+                adjacency[u][v] = length
+        middles = {}
+        deleted_neighbors = [0] * node_count
+        settled_limit = constants.CONTRACTION_WITNESS_LIMIT
+
+        # edge difference plus the number of contracted neighbors, which spreads the contractions
+        def get_priority(v, shortcuts):
+            return len(shortcuts) - len(adjacency[v]) + deleted_neighbors[v]
+
+        queue = [(get_priority(v, get_shortcuts(adjacency, v, settled_limit)), v) for v in range(node_count)]
+        heapq.heapify(queue)
+        ranks = np.zeros(node_count, dtype=np.int64)
+        upward_edges = [None] * node_count
+        rank = 0
+        start = time.time()
+        while queue:
+            _, v = heapq.heappop(queue)
+            # priorities change as nodes are contracted, they are updated lazily
+            shortcuts = get_shortcuts(adjacency, v, settled_limit)
+            priority = get_priority(v, shortcuts)
+            if queue and priority > queue[0][0]:
+                heapq.heappush(queue, (priority, v))
+                continue
+            for u, w, length in shortcuts:
+                if length < adjacency[u].get(w, math.inf):
+                    adjacency[u][w] = length
+                    adjacency[w][u] = length
+                    middles[(min(u, w), max(u, w))] = v
+            upward_edges[v] = [(u, length, middles.get((min(u, v), max(u, v)), -1))
+                               for u, length in adjacency[v].items()]
+            for u in adjacency[v]:
+                del adjacency[u][v]
+                deleted_neighbors[u] += 1
+            adjacency[v] = {}
+            ranks[v] = rank
+            rank += 1
+            if rank % 10000 == 0:
+                print(f'{rank} nodes contracted out of {node_count} in {time.time() - start:.0f}s')
+
+        up_offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum([len(edges) for edges in upward_edges], out=up_offsets[1:])
+        edges = [edge for node_edges in upward_edges for edge in node_edges]
+        return cls(
+            ranks, up_offsets,
+            np.array([edge[0] for edge in edges], dtype=np.int64),
+            np.array([edge[1] for edge in edges], dtype=np.float64),
+            np.array([edge[2] for edge in edges], dtype=np.int64))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.SAVED_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory):
+        return cls(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in cls.SAVED_ARRAYS])
+
+    # Bidirectional dijkstra going up the hierarchy from the sources, given as
+    # {node: distance}, and from the target. Returns the nodes of the shortest path
+    # from one of the sources to the target, None if there is none.
+    def search(self, sources, target):
+        up_offsets, up_target, up_length = self.up_offsets, self.up_target, self.up_length
+        distances = [dict(sources), {target: 0}]
+        parents = [{node: None for node in sources}, {target: None}]
+        queues = [[(distance, node) for node, distance in sources.items()], [(0, target)]]
+        heapq.heapify(queues[0])
+        best_distance = math.inf
+        meeting = None
+        while True:
+            # the side with the closest node, each side stops when it cannot improve the best path
+            sides = [side for side in (0, 1) if queues[side] and queues[side][0][0] < best_distance]
+            if not sides:
+                break
+            side = min(sides, key=lambda side: queues[side][0][0])
+            distance, node = heapq.heappop(queues[side])
+            side_distances = distances[side]
+            if distance > side_distances[node]:
+                continue
+            other_distance = distances[1 - side].get(node)
+            if other_distance is not None and distance + other_distance < best_distance:
+                best_distance = distance + other_distance
+                meeting = node
+            for e in range(int(up_offsets[node]), int(up_offsets[node + 1])):
+                neighbor = int(up_target[e])
+                new_distance = distance + float(up_length[e])
+                if new_distance < side_distances.get(neighbor, math.inf):
+                    side_distances[neighbor] = new_distance
+                    parents[side][neighbor] = node
+                    heapq.heappush(queues[side], (new_distance, neighbor))
+        if meeting is None:
+            return None
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = parents[0][node]
+        path.reverse()
+        node = parents[1][meeting]
+        while node is not None:
+            path.append(node)
+            node = parents[1][node]
+        return self.unpack(path)
+
+    # the edge between u and v is stored upwards from the one of lower rank
+    def get_upward_edge(self, u, v):
+        if self.ranks[u] > self.ranks[v]:
+            u, v = v, u
+        for e in range(int(self.up_offsets[u]), int(self.up_offsets[u + 1])):
+            if self.up_target[e] == v:
+                return e
+        raise ValueError(f'no edge between {u} and {v}')
+
+    # replaces the shortcuts of the path by the nodes they skip
+    def unpack(self, path):
+        nodes = [path[0]]
+        pairs = [(u, v) for u, v in zip(path[:-1], path[1:])][::-1]
+        while pairs:
+            u, v = pairs.pop()
+            middle = int(self.up_middle[self.get_upward_edge(u, v)])
+            if middle < 0:
+                nodes.append(v)
+            else:
+                pairs += [(middle, v), (u, middle)]
+        return nodes
+
+# directory is where the region was loaded from, None if it was not
+class RegionalGraph:
+    def __init__(self, name, bbox, graph, hierarchy, built_at=None, directory=None):
+        self.name = name
+        self.bbox = bbox    # south, west, north, east
+        self.graph = graph
+        self.hierarchy = hierarchy
+        self.built_at = built_at if built_at is not None else time.time()
+        self.directory = directory
+
+    def covers(self, point):
+        south, west, north, east = self.bbox
+        margin = constants.ROUTING_REGION_MARGIN
+        return south + margin <= point['lat'] <= north - margin and west + margin <= point['lon'] <= east - margin
+
+    def save(self, directory):
+        self.graph.save(os.path.join(directory, 'graph'))
+        self.hierarchy.save(os.path.join(directory, 'hierarchy'))
+        with open(os.path.join(directory, 'region.json'), 'w') as outfile:
+            json.dump({'name': self.name, 'bbox': self.bbox, 'built_at': self.built_at}, outfile)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'region.json')) as json_file:
+            region = json.load(json_file)
+        return cls(region['name'], region['bbox'],
+                   Graph.load(os.path.join(directory, 'graph')),
+                   ContractionHierarchy.load(os.path.join(directory, 'hierarchy')), region['built_at'], directory)
+
+    # the shortest edge between two nodes of the graph
+    def get_edge(self, u, v):
+        graph = self.graph
+        edges = range(int(graph.edge_offsets[u]), int(graph.edge_offsets[u + 1]))
+        return min((e for e in edges if graph.edge_target[e] == v), key=lambda e: graph.edge_length[e])
+
+    # shortest itinerary of a route prepared on the regional graph, in the format of RoutingEngine.search
+    def search(self, route):
+        not_found = {'distance': 0, 'directions': []}
+        if not route.is_routable():
+            print('Path not found')
+            return not_found
+        # the entry points of the route are the sources of the hierarchy search
+        sources = {}
+        source_links = {}
+        for i, (node, distance, _) in enumerate(route.source_links):
+            if distance < sources.get(node, math.inf):
+                sources[node] = distance
+                source_links[node] = i
+        path = self.hierarchy.search(sources, route.target)
+        if path is None:
+            print('Path not found')
+            return not_found
+
+        # the labels of the path are rebuilt with their character counts
+        engine = RoutingEngine(False, 0)
+        graph = self.graph
+        link = source_links[path[0]]
+        node, distance, slot = route.source_links[link]
+        label = Label(-1, 0, constants.ITINERARY_DISTANCE_CHARACTER_COUNT, None, -1, -1)
+        label = engine.extend_label(graph, label, node, distance, slot, -1 - link)
+        for u, v in zip(path[:-1], path[1:]):
+            e = self.get_edge(u, v)
+            label = engine.extend_label(graph, label, v, float(graph.edge_length[e]),
+                                        int(graph.edge_target_slot[e]), int(graph.edge_source_slot[e]))
+        return engine.get_itinerary(route, label)
+
+def load_regional_graphs(directory):
+    regions = []
+    if directory and os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if os.path.exists(os.path.join(directory, name, 'region.json')):
+                regions.append(RegionalGraph.load(os.path.join(directory, name)))
+    return regions
+
+regional_graphs_directory = os.environ.get('REGIONAL_GRAPHS_DIR', constants.REGIONAL_GRAPHS_DIR)
+regional_graphs = load_regional_graphs(regional_graphs_directory)
+
+# the regional graph covering both points, None if there is none
+def find_regional_graph(pointA, pointB):
+    for region in regional_graphs:
+        if region.covers(pointA) and region.covers(pointB):
+            return region
+    return None
+
+# when the loaded graph of the region was built, None if there is none
+def get_regional_graph_version(name):
+    for region in regional_graphs:
+        if region.name == name:
+            return region.built_at
+    return None
+
+def build_regional_graph(name, bbox):
+    from overpass_api import REGIONAL_WAY_FILTERS, iter_way_filters_elements
+    print(f'downloading {name}')
+    # a partial map raises an OverpassError instead of giving a region with missing ways
+    graph = Graph.from_elements(iter_way_filters_elements(
+        REGIONAL_WAY_FILTERS, *bbox, timeout=constants.REGION_DOWNLOAD_TIMEOUT,
+        settings=f'[timeout:{constants.REGION_QUERY_TIMEOUT}][maxsize:{constants.REGION_QUERY_MAXSIZE}]'))
+    print(f'{graph.node_count} nodes, {graph.edge_count} edges')
+    if graph.node_count > constants.REGION_MAX_NODES:
+        raise ValueError(f'{name} has {graph.node_count} nodes, more than the {constants.REGION_MAX_NODES} '
+                         'whose contraction takes minutes, it is to be split')
+    hierarchy = ContractionHierarchy.build(graph)
+    print(f'{len(hierarchy.up_target)} upward edges')
+    return RegionalGraph(name, bbox, graph, hierarchy)
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(constants.ROUTING_REGIONS)
+    for name in names:
+        region = build_regional_graph(name, list(constants.ROUTING_REGIONS[name]))
+        region.save(os.path.join(regional_graphs_directory, name))
@@ -1,76 +1,275 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import unidecode
 import re
-from overpass_api import get_street_location, get_map_between_points, get_full_map_between_points
+import os
+from overpass_api import get_street_location, get_graph_between_points, get_full_graph_between_points, \
+    get_delta_between_points, get_map_versions_between_points, get_tile_version, \
+    get_graph_around_point, get_pois_around_point
 from geometry_utils import get_flying_distance
 from routing_engine import RoutingEngine, get_required_sms_number
+from graph import PreparedRoute
+from fetch_pipeline import FetchPipeline
+from regional_graph import find_regional_graph, get_regional_graph_version
+from itinerary_cache import ItineraryCache
+from parallel_routing import SearchRace, reset_process_pool
+from instrumentation import count, phase, set_value
 import constants
 
 
 def get_message_from_itinerary(itinerary):
-    result = 'Distance: ' + str(round(itinerary['distance'], 2)) + 'km;'
-    for part in itinerary['directions']:
-        way_name = (part['way'].replace('Boulevard', 'Bv.')
-                              .replace('Avenue', 'Av.')
-                              .replace('Rue', 'R.')
-        )
-        way_name = unidecode.unidecode(way_name[:constants.MAX_CHARS_PER_WAY])
-        distance_str = str(round(part['distance']*1000)) + 'm;' if part['distance'] < 1 else str(round(part['distance'], 2)) + 'km;'
-        result += '\n' + str(round(part['angle'])) + 'd, ' + way_name + ', ' + distance_str
-    print(get_required_sms_number(len(result)), ' is the real required number of sms')
+    with phase('message formatting'):
+        result = 'Distance: ' + str(round(itinerary['distance'], 2)) + 'km;'
+        for part in itinerary['directions']:
+            way_name = (part['way'].replace('Boulevard', 'Bv.')
+                                  .replace('Avenue', 'Av.')
+                                  .replace('Rue', 'R.')
+            )
+            way_name = unidecode.unidecode(way_name[:constants.MAX_CHARS_PER_WAY])
+            distance_str = str(round(part['distance']*1000)) + 'm;' if part['distance'] < 1 else str(round(part['distance'], 2)) + 'km;'
+            result += '\n' + str(round(part['angle'])) + 'd, ' + way_name + ', ' + distance_str
+    set_value('message sms', get_required_sms_number(len(result)))
     return result
 
-def routing_engine_wrapper(map_data, pointA, pointB):
-    engine = RoutingEngine(False, 0)
-    itinerary = engine.dijkstra(map_data, pointA, pointB)
+# the shortest itinerary if it fits in 2 sms, otherwise the short sms one, with its message
+def choose_itinerary(route, itinerary, short_sms_engine, short_sms_itinerary=None):
     if itinerary['distance'] == 0:
-        return ''
+        return '', itinerary
     msg = get_message_from_itinerary(itinerary)
     if get_required_sms_number(len(msg)) <= 2:
-        return msg
+        return msg, itinerary
     else:
-        engine = RoutingEngine(True, constants.SMS_TO_METER_PREFERENCE)
-        itinerary = engine.dijkstra(map_data, pointA, pointB)
+        if short_sms_itinerary is None:
+            with phase('short sms search'):
+                short_sms_itinerary = short_sms_engine.search(route)
+        if short_sms_itinerary['distance'] == 0:
+            return '', short_sms_itinerary
+        msg = get_message_from_itinerary(short_sms_itinerary)
+        return msg, short_sms_itinerary
+
+def choose_message(route, itinerary, short_sms_engine, short_sms_itinerary=None):
+    return choose_itinerary(route, itinerary, short_sms_engine, short_sms_itinerary)[0]
+
+def make_engine(force_short_sms, sms_to_meter_preference):
+    return RoutingEngine(force_short_sms, sms_to_meter_preference, constants.ROUTING_STRATEGY,
+                         constants.SEARCH_LABEL_BUDGET, constants.SEARCH_TIME_BUDGET)
+
+# The endpoints are snapped once for all the searches. When no path is found, the graph
+# can be extended with more ways and the searches resumed instead of started again.
+# The chosen itinerary is kept in itinerary.
+class WalkingSearch:
+    def __init__(self, route):
+        self.route = route
+        self.engine = make_engine(False, 0)
+        self.short_sms_engine = make_engine(True, constants.SMS_TO_METER_PREFERENCE)
+        self.combined = get_flying_distance(route.pointA, route.pointB) >= constants.COMBINED_SEARCH_MIN_DISTANCE
+        self.itinerary = None
+
+    def run(self):
+        short_sms_itinerary = None
+        with phase('search'):
+            if self.combined:
+                itinerary, short_sms_itinerary = self.short_sms_engine.find_itineraries(self.route)
+            else:
+                itinerary = self.engine.search(self.route)
+        msg, self.itinerary = choose_itinerary(self.route, itinerary, self.short_sms_engine, short_sms_itinerary)
+        return msg
+
+    # delta is a GraphBuilder of the new ways and their nodes
+    def extend(self, delta):
+        graph = self.route.graph.merge(delta)
+        set_value('extension ways', graph.way_count - self.route.graph.way_count)
+        self.route = self.route.extend(graph)
+        short_sms_itinerary = None
+        with phase('resumed search'):
+            if self.combined:
+                itinerary, short_sms_itinerary = self.short_sms_engine.resume_itineraries(self.route)
+            else:
+                itinerary = self.engine.resume(self.route)
+        msg, self.itinerary = choose_itinerary(self.route, itinerary, self.short_sms_engine, short_sms_itinerary)
+        return msg
+
+def routing_engine_wrapper(graph, pointA, pointB):
+    return WalkingSearch(PreparedRoute(graph, pointA, pointB)).run()
+
+# The short sms searches for several preferences run at once in processes, the message of best
+# score being taken as soon as no search still running can beat it: a message scores at least
+# SMS_TO_METER_PREFERENCE more than the shortest distance. When the pool is broken, the short
+# sms search runs in process.
+def parallel_short_sms_routing(region, pointA, pointB, shortest_distance):
+    race = SearchRace()
+    try:
+        return race_short_sms_searches(race, region, pointA, pointB, shortest_distance)
+    except BrokenProcessPool:
+        count('broken process pools')
+        reset_process_pool(race.pool)
+        itinerary = make_engine(True, constants.SMS_TO_METER_PREFERENCE).search(
+            PreparedRoute(region.graph, pointA, pointB))
+        return get_message_from_itinerary(itinerary) if itinerary['distance'] else ''
+    finally:
+        race.cancel()
+
+def race_short_sms_searches(race, region, pointA, pointB, shortest_distance):
+    futures = [race.submit_regional_search(region, pointA, pointB, True, preference)
+               for preference in constants.PARALLEL_SMS_PREFERENCES]
+    best_msg, best_score = '', None
+    for future in as_completed(futures):
+        itinerary = future.result()
         if itinerary['distance'] == 0:
-            return ''
+            continue
         msg = get_message_from_itinerary(itinerary)
-        return msg
+        score = get_required_sms_number(len(msg)) * constants.SMS_TO_METER_PREFERENCE + itinerary['distance']
+        if best_score is None or score < best_score:
+            best_msg, best_score = msg, score
+        if best_score <= constants.SMS_TO_METER_PREFERENCE + shortest_distance:
+            break
+    return best_msg
+
+# The shortest itinerary is given by the contraction hierarchy of the region. When it does not
+# fit in 2 sms, the short sms one is searched on the regional graph, with PARALLEL_ROUTING for
+# several preferences at once in processes.
+def regional_routing_wrapper(region, pointA, pointB):
+    route = PreparedRoute(region.graph, pointA, pointB)
+    itinerary = region.search(route)
+    if constants.PARALLEL_ROUTING and region.directory is not None and itinerary['distance'] > 0:
+        msg = get_message_from_itinerary(itinerary)
+        if get_required_sms_number(len(msg)) <= 2:
+            return msg
+        return parallel_short_sms_routing(region, pointA, pointB, itinerary['distance'])
+    short_sms_engine = make_engine(True, constants.SMS_TO_METER_PREFERENCE)
+    return choose_message(route, itinerary, short_sms_engine)
+
+# the current version of a map source of ItineraryCache
+def get_map_version(source):
+    if source[0] == 'region':
+        return get_regional_graph_version(source[1])
+    return get_tile_version(*source[1:])
+
+itinerary_cache_database = os.environ.get('ITINERARY_CACHE_DATABASE', constants.ITINERARY_CACHE_DATABASE)
+itinerary_cache = ItineraryCache(
+    itinerary_cache_database, constants.ITINERARY_CACHE_SIZE, constants.ITINERARY_CACHE_TTL,
+    constants.ITINERARY_CACHE_MAX_ROWS, get_map_version) if itinerary_cache_database else None
+
+# the addresses written the same way up to case, accents and spaces, and the settings the message depends on
+def get_itinerary_key(nA, wayA, cityA, nB, wayB, cityB):
+    addresses = [' '.join(unidecode.unidecode(part).lower().split()) for part in (nA, wayA, cityA, nB, wayB, cityB)]
+    settings = [constants.ROUTING_STRATEGY, constants.SMS_TO_METER_PREFERENCE, constants.MAX_CHARS_PER_WAY,
+                constants.COMBINED_SEARCH_MIN_DISTANCE]
+    return '|'.join(addresses + [str(setting) for setting in settings])
 
 def get_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB):
-    pointA = get_street_location(nA, wayA, cityA)
-    pointB = get_street_location(nB, wayB, cityB)
-    #print(pointA)
-    #print(pointB)
+    if itinerary_cache is None:
+        return find_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB)[0]
+    key = get_itinerary_key(nA, wayA, cityA, nB, wayB, cityB)
+    with phase('itinerary cache'):
+        msg = itinerary_cache.get(key)
+    if msg is not None:
+        count('itinerary cache hits')
+        return msg
+    msg, map_versions = find_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB)
+    if msg != '':
+        itinerary_cache.put(key, msg, map_versions)
+    return msg
+
+# A and B are located at the same time, then the ways of the full map are fetched along with
+# the filtered one in case no path is found on the latter. Returns the message and the
+# versions of the maps it was computed on.
+def find_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB):
+    pipeline = FetchPipeline()
+    pipeline.submit('geocode A', get_street_location, nA, wayA, cityA)
+    pipeline.submit('geocode B', get_street_location, nB, wayB, cityB)
+    pointA = pipeline.result('geocode A', constants.GEOCODE_TIMEOUT)
+    pointB = pipeline.result('geocode B', constants.GEOCODE_TIMEOUT)
     distance = get_flying_distance(pointA, pointB)
-    #print(distance)
     if distance > constants.MAX_FLYING_DISTANCE:
-        return ''
-    map_data = get_map_between_points(pointA, pointB)
-    msg = routing_engine_wrapper(map_data, pointA, pointB)
-    if msg == '':   
-        map_data = get_full_map_between_points(pointA, pointB)
-        msg = routing_engine_wrapper(map_data, pointA, pointB)
-        return msg
+        return '', []
+    # no map to download inside the regions built offline
+    region = find_regional_graph(pointA, pointB)
+    if region is not None:
+        msg = pipeline.run('regional routing', regional_routing_wrapper, region, pointA, pointB)
+        if msg != '':
+            return msg, [[['region', region.name], region.built_at]]
+    # the ways missing from the filtered map are enough to extend its graph
+    if constants.INCREMENTAL_MAP_EXPANSION:
+        fallback_name, fallback = 'map delta', get_delta_between_points
     else:
-        return msg
-    
+        fallback_name, fallback = 'full map', get_full_graph_between_points
+    pipeline.submit('map', get_graph_between_points, pointA, pointB)
+    if constants.SPECULATIVE_FULL_MAP_PREFETCH:
+        pipeline.submit(fallback_name, fallback, pointA, pointB)
+    try:
+        graph = pipeline.result('map', constants.MAP_TIMEOUT)
+        search = WalkingSearch(PreparedRoute(graph, pointA, pointB))
+        msg = pipeline.run('routing', search.run)
+        # the full tiles prefetched for nothing do not make the itinerary depend on them
+        layers = ['filtered']
+        if msg == '':
+            layers.append('full')
+            if not constants.SPECULATIVE_FULL_MAP_PREFETCH:
+                pipeline.submit(fallback_name, fallback, pointA, pointB)
+            result = pipeline.result(fallback_name, constants.MAP_TIMEOUT)
+            if constants.INCREMENTAL_MAP_EXPANSION:
+                msg = pipeline.run('extended map routing', search.extend, result)
+            else:
+                msg = pipeline.run('full map routing', routing_engine_wrapper, result, pointA, pointB)
+    except FutureTimeoutError:
+        # the map did not come in time, the walk is answered as without path
+        count('map timeouts')
+        return '', []
+    finally:
+        # the fallback prefetched for nothing, or still running after a timeout
+        pipeline.cancel(fallback_name)
+    return msg, get_map_versions_between_points(pointA, pointB, layers)
 
-def get_walking_itinerary_response(request):
+# The points of interest around A and the map of the same disk are fetched at once, then
+# a single search goes to the closest of them, the first one reached. Its name is written
+# before the itinerary.
+def get_walking_itinerary_to_poi(nA, wayA, cityA, kind):
+    poi_kind = constants.POI_KINDS[kind]
+    pipeline = FetchPipeline()
+    pointA = pipeline.run('geocode A', get_street_location, nA, wayA, cityA)
+    pipeline.submit('pois', get_pois_around_point, kind, pointA, poi_kind['radius'])
+    pipeline.submit('map', get_graph_around_point, pointA, poi_kind['radius'])
+    pois = pipeline.result('pois', constants.MAP_TIMEOUT)
+    set_value('pois', len(pois))
+    if not pois:
+        pipeline.cancel('map')
+        return ''
+    graph = pipeline.result('map', constants.MAP_TIMEOUT)
+    route = PreparedRoute.to_nearest(graph, pointA, pois)
+    search = WalkingSearch(route)
+    msg = pipeline.run('routing', search.run)
+    if msg == '':
+        return ''
+    # the poi snapped to the node reached, several pois can share it
+    reached = graph.coordinates[search.itinerary['target']]
+    poi = min(pois, key=lambda poi: get_flying_distance(poi, reached))
+    name = unidecode.unidecode(poi['name'][:constants.MAX_CHARS_PER_WAY])
+    return (poi_kind['label'] + ' ' + name).strip() + '\n' + msg
+
+# returns (nA, wayA, cityA, kind) for a walk to the closest point of interest of a kind
+# of constants.POI_KINDS, None for a walk between addresses
+def parse_poi_request(request):
+    kinds = '|'.join(constants.POI_KINDS)
+    matchObj = re.match(r'Walk from ([0-9]+) (.*), (.*) to (?:the )?(?:nearest )?(' + kinds + r')\W*$', request, re.M|re.I)
+    if matchObj:
+        return matchObj.groups()[:3] + (matchObj.group(4).lower(),)
+    return None
+
+
+# returns (nA, wayA, cityA, nB, wayB, cityB), B being in the city of A if not given
+def parse_walking_request(request):
     matchObj = re.match( r'Walk from ([0-9]+) (.*), (.*) to ([0-9]+) (.*), (.*)', request, re.M|re.I)
     if matchObj:
-        nA = matchObj.group(1)
-        wayA = matchObj.group(2)
-        cityA = matchObj.group(3)
-        nB = matchObj.group(4)
-        wayB = matchObj.group(5)
-        cityB = matchObj.group(6)
-    if not matchObj:
-        matchObj = re.match( r'Walk from ([0-9]+) (.*), (.*) to ([0-9]+) (.*)', request, re.M|re.I)
-        nA = matchObj.group(1)
-        wayA = matchObj.group(2)
-        cityA = matchObj.group(3)
-        nB = matchObj.group(4)
-        wayB = matchObj.group(5)
-        cityB = cityA
-    result = get_walking_itinerary(nA, wayA, cityA, nB, wayB, cityB)
+        return matchObj.groups()
+    matchObj = re.match( r'Walk from ([0-9]+) (.*), (.*) to ([0-9]+) (.*)', request, re.M|re.I)
+    return matchObj.groups() + (matchObj.group(3),)
+
+def get_walking_itinerary_response(request):
+    poi_request = parse_poi_request(request)
+    if poi_request is not None:
+        result = get_walking_itinerary_to_poi(*poi_request)
+    else:
+        result = get_walking_itinerary(*parse_walking_request(request))
     print(result)
     return result
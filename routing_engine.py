@@ -1,228 +1,519 @@
-from dataclasses import dataclass, field
-from queue import PriorityQueue
-from geometry_utils import get_flying_distance, get_projection_on_segment, get_angle, get_bearing_at_node
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import count
+import heapq
+import time
+import numpy as np
+from geometry_utils import get_angles
+from graph import PreparedRoute
+import instrumentation
 import constants
 import math
 
-class Marking:
-    def __init__(self, node_id, distance_from_A, sms_character_count, preceding_marking, preceding_way):
-        self.node_id = node_id                        # int
+class Label:
+    __slots__ = ('node', 'distance_from_A', 'sms_character_count', 'preceding_label', 'slot', 'via_slot')
+
+    def __init__(self, node, distance_from_A, sms_character_count, preceding_label, slot, via_slot):
+        self.node = node                               # int, graph index, -1 for the source
         self.distance_from_A = distance_from_A         # float
         self.sms_character_count = sms_character_count # int
-        self.preceding_marking = preceding_marking     # Mark
-        self.preceding_way = preceding_way              # int
-
-    def get_id(self):
-        return str(self.node_id) + '-' + \
-            str(self.sms_character_count) + '-' + \
-            str(self.distance_from_A)
-    
-    # used by PriorityQueue to deal with equalities
-    def __gt__(self, other):
-        return self.node_id > other.node_id
-
-@dataclass(order=True)
-class PrioritizedItem:
-    score: int
-    item: object = field()
+        self.preceding_label = preceding_label         # Label
+        self.slot = slot                               # int, slot of node in the way used to reach it
+        self.via_slot = via_slot                       # int, slot of the preceding node in that way,
+                                                       # -1 - i when reached by the i-th source link
+
+# Pareto front of the labels settled at one node on (distance, character count).
+# Since no label of the front dominates another, sorting them by increasing distance
+# also sorts them by decreasing character count, so dominance checks are bisections.
+# The labels are kept so that a search can expand them again along new edges.
+class ParetoFront:
+    __slots__ = ('distances', 'character_counts', 'labels')
+
+    def __init__(self):
+        self.distances = []
+        self.character_counts = []
+        self.labels = []
+
+    def is_dominated(self, distance, character_count):
+        i = bisect_right(self.distances, distance)
+        return i > 0 and self.character_counts[i-1] <= character_count
+
+    # returns False if the label is dominated, otherwise inserts it
+    # and drops the labels it dominates
+    def insert(self, distance, character_count, label=None):
+        if self.is_dominated(distance, character_count):
+            return False
+        start = bisect_left(self.distances, distance)
+        end = start
+        while end < len(self.distances) and self.character_counts[end] >= character_count:
+            end += 1
+        self.distances[start:end] = [distance]
+        self.character_counts[start:end] = [character_count]
+        self.labels[start:end] = [label]
+        return True
 
 def get_required_sms_number(character_count):
     return math.ceil(
         (character_count + constants.TWILIO_MESSAGE_CHARACTER_COUNT) / float(constants.MAX_SMS_CHARACTER_COUNT))
 
-def get_way_name(way):
-    return way['tags']['name'] if 'name' in way['tags'] else way['tags']['highway']
+# 'dijkstra' expands labels by score, 'astar' adds the flying distance to the target to the score,
+# which stays a lower bound of what is left to walk and to write, 'bidirectional' searches from
+# both ends at once and only minimizes the distance
+ROUTING_STRATEGIES = ['dijkstra', 'astar', 'bidirectional']
+
+# how many labels were settled by the searches of each strategy
+settled_label_counts = Counter()  # type: Counter[str]
 
-def have_same_name(way1, way2):
-    return get_way_name(way1) == get_way_name(way2)
+# raised by a search whose cancelled function returned True
+class SearchCancelled(Exception):
+    pass
 
+# A search stops after popping label_budget labels or after time_budget seconds, None for no limit.
+# It then returns the best itinerary queued so far, the target labels being complete itineraries,
+# or if none reached the target yet, the shortest itinerary found by a plain bidirectional search
+# with what is left of the budgets: constants.SEARCH_FALLBACK_BUDGET_SHARE of them are kept for it.
+# A bidirectional search stopped by its budget returns the best meeting found, if any.
+# cancelled, when set, is called with the budget checks: the search raises SearchCancelled once it returns True.
 class RoutingEngine:
-    def __init__(self, force_short_sms, sms_to_meter_preference):
+    def __init__(self, force_short_sms, sms_to_meter_preference, strategy='dijkstra',
+                 label_budget=None, time_budget=None):
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError('unknown routing strategy ' + strategy)
+        if strategy == 'bidirectional' and force_short_sms:
+            raise ValueError('bidirectional search cannot force short sms')
         self.force_short_sms = force_short_sms
         self.sms_to_meter_preference = sms_to_meter_preference
+        self.strategy = strategy
+        self.label_budget = label_budget
+        self.time_budget = time_budget
+        self.cancelled = None
+        self.reset_label_counts()
+        self.search_state = None
 
     def get_score(self, distance, character_count):
         return get_required_sms_number(character_count) * self.sms_to_meter_preference + distance
 
-    def compute_neighbors(self, nodes, ways, pointA, pointB):
-        for way in list(ways.values()):
-            for i in range(1, len(way['nodes'])):
-                node1Id = way['nodes'][i-1]
-                node2Id = way['nodes'][i]
-                node1 = nodes[node1Id]
-                node2 = nodes[node2Id]
-                distance = get_flying_distance(node1, node2)
-                node2_as_neighbor = {'distance': distance, 'node': node2, 'way': way['id']}
-                if 'neighbors' in node1:
-                    node1['neighbors'].append(node2_as_neighbor)
-                else:
-                    node1['neighbors'] = [node2_as_neighbor]
-                node1_as_neighbor = {'distance': distance, 'node': node1, 'way': way['id']}
-                if 'neighbors' in node2:
-                    node2['neighbors'].append(node1_as_neighbor)
-                else:
-                    node2['neighbors'] = [node1_as_neighbor]
-        
-        # locate source. It is the projection of pointA on the closest way.
-        # the nearest node of the nearest way could be dozens of meters away
-        # in either direction so it would be impractical to use it
-        _min = 10
-        for way in list(ways.values()):
-            for i in range(1, len(way['nodes'])):
-                node1Id = way['nodes'][i-1]
-                node2Id = way['nodes'][i]
-                node1 = nodes[node1Id]
-                node2 = nodes[node2Id]
-                projection = get_projection_on_segment(pointA, [node1, node2])
-                d = get_flying_distance(projection, pointA)
-                if d < _min:
-                    _min = d
-                    _argmin = projection
-                    _argmin['neighbors'] = [
-                        {'distance': get_flying_distance(projection, node1), 'node': node1, 'way': way['id']},
-                        {'distance': get_flying_distance(projection, node2), 'node': node2, 'way': way['id']}
-                    ]
-        source = _argmin
-        source['isSource'] = True
-        source['id'] = 0
-        print('found source at distance ' + str(_min))
-        nodes[0] = source
-
-        # locate target
-        _min = 10
-        for node in list(nodes.values()):
-            d = get_flying_distance(node, pointB)
-            if d < _min:
-                _min = d
-                _argmin = node
-        _argmin['isTarget'] = True
-        
-        return source
-
-    def should_write_line(self, previous_way, next_way, node, nodes, debug=False):
-        previous_name = get_way_name(previous_way)
-        next_name = get_way_name(next_way)
-        write_line = previous_name != next_name
+    # previous_slot and next_slot are the slots of the same node in the way we arrive by
+    # and in the way we leave by, the names and bearings are looked up in tables of the graph
+    def should_write_line(self, graph, previous_slot, next_slot, debug=False):
+        slot_way, way_name_ids, _, way_is_difficult, slot_bearings = graph.get_search_lists()[5:]
+        previous_way = slot_way[previous_slot]
+        next_way = slot_way[next_slot]
+        write_line = way_name_ids[previous_way] != way_name_ids[next_way]
         if not self.force_short_sms:
             return write_line
-        elif write_line and get_way_name(previous_way) not in constants.DIFFICULT_WAYS:
-            bearing_before = get_bearing_at_node(previous_way, node, nodes, debug)
-            bearing_after = get_bearing_at_node(next_way, node, nodes, debug)
+        elif write_line and not way_is_difficult[previous_way]:
+            bearing_before = slot_bearings[previous_slot]
+            bearing_after = slot_bearings[next_slot]
             write_line = bearing_before is None or bearing_after is None \
                 or abs(bearing_after - bearing_before) > constants.PARALLELISM_TOLERANCE
-            
+
             if debug and write_line:
-                print(previous_name, next_name, bearing_before, bearing_after)
-        
+                print(graph.way_names[previous_way], graph.way_names[next_way], bearing_before, bearing_after)
+
         return write_line
 
-    def mark_id_is_dominated_by_other(self, mark_id, other):
-        node_id, sms_character_count, distance_from_A = mark_id.split('-')
-        node_id_other, sms_character_count_other, distance_from_A_other = other.split('-')
-        if self.force_short_sms:
-            return node_id == node_id_other and \
-                sms_character_count >= sms_character_count_other and \
-                distance_from_A >= distance_from_A_other
-        else:
-            return node_id == node_id_other and \
-                distance_from_A >= distance_from_A_other
-
-    def mark_next_point(self, nodes, ways, prioque, markings):
-        marking = prioque.get().item
-        mark_id = marking.get_id()
-        if mark_id in markings:
-            return None
-
-        node = nodes[marking.node_id]
-        for other_mark_id in node['mark_ids']:
-            if self.mark_id_is_dominated_by_other(mark_id, other_mark_id):
+    # without force_short_sms, only the distance matters when comparing labels
+    def get_dominance_character_count(self, sms_character_count):
+        return sms_character_count if self.force_short_sms else 0
+
+    def get_new_character_count(self, graph, label, slot, via_slot):
+        sms_character_count = label.sms_character_count
+        if label.slot < 0 or self.should_write_line(graph, label.slot, via_slot):
+            slot_way, _, way_name_character_counts = graph.get_search_lists()[5:8]
+            sms_character_count += constants.ITINERARY_BASE_DIRECTION_CHARACTER_COUNT
+            sms_character_count += way_name_character_counts[slot_way[slot]]
+        return sms_character_count
+
+    def settle(self):
+        self.settled_label_count += 1
+        settled_label_counts[self.strategy] += 1
+
+    # called when a search starts or resumes, the budgets apply to each part
+    def reset_label_counts(self):
+        self.settled_label_count = 0
+        self.pushed_label_count = 0
+        self.popped_label_count = 0
+        self.dominated_label_count = 0
+        share = 1 if self.strategy == 'bidirectional' else 1 - constants.SEARCH_FALLBACK_BUDGET_SHARE
+        self.label_limit = self.label_budget * share if self.label_budget is not None else None
+        self.started_at = time.perf_counter()
+        self.deadline = self.started_at + self.time_budget * share if self.time_budget is not None else None
+        # the target labels of best score and of shortest distance queued so far
+        self.best_target_label = None
+        self.best_target_score = math.inf
+        self.shortest_target_label = None
+
+    # the clock is only read every 256 labels, and whether the search was cancelled
+    def is_over_budget(self):
+        if self.label_limit is not None and self.popped_label_count >= self.label_limit:
+            return True
+        if self.popped_label_count % 256 != 0:
+            return False
+        if self.cancelled is not None and self.cancelled():
+            raise SearchCancelled()
+        return self.deadline is not None and time.perf_counter() > self.deadline
+
+    def queue_target_label(self, label, score):
+        if score < self.best_target_score:
+            self.best_target_label = label
+            self.best_target_score = score
+        if self.shortest_target_label is None or label.distance_from_A < self.shortest_target_label.distance_from_A:
+            self.shortest_target_label = label
+
+    # the plain bidirectional search given what is left of the budgets
+    def get_fallback_engine(self):
+        label_budget = max(0, self.label_budget - self.popped_label_count) if self.label_budget is not None else None
+        time_budget = max(0, self.time_budget - (time.perf_counter() - self.started_at)) \
+            if self.time_budget is not None else None
+        return RoutingEngine(False, 0, 'bidirectional', label_budget, time_budget)
+
+    # the itinerary of the best target label queued before the budget ran out,
+    # or the shortest one if none was
+    def get_anytime_itinerary(self, route):
+        instrumentation.count('searches over budget')
+        if self.best_target_label is not None:
+            return self.get_itinerary(route, self.best_target_label)
+        return self.get_fallback_engine().search(route)
+
+    # the label counts of the search, or of its resumed part, go to the trace of the request
+    def report_search(self, found):
+        instrumentation.count('searches')
+        if not found:
+            instrumentation.count('searches without path')
+        instrumentation.count('labels pushed', self.pushed_label_count)
+        instrumentation.count('labels popped', self.popped_label_count)
+        instrumentation.count('labels dominated', self.dominated_label_count)
+        instrumentation.count('labels settled', self.settled_label_count)
+
+    # the source is not a node of the graph, its label has node -1 and its links
+    # are the (node, distance, slot) tuples of PreparedRoute.source_links
+    def mark_next_point(self, route, prioque, fronts):
+        label = heapq.heappop(prioque)[2]
+        self.popped_label_count += 1
+        if label.node >= 0:
+            front = fronts[label.node]
+            if front is None:
+                front = fronts[label.node] = ParetoFront()
+            if not front.insert(label.distance_from_A, self.get_dominance_character_count(label.sms_character_count),
+                                label):
+                self.dominated_label_count += 1
                 return None
-        node['mark_ids'].append(mark_id)
-        markings[mark_id] = marking
-        
-        for link in node['neighbors']:
-            # no going backwards to node of previous mark
-            if marking.preceding_marking and link['node']['id'] == marking.preceding_marking.node_id:
+            edge_offsets, edge_target, edge_length, edge_source_slot, edge_target_slot = \
+                route.graph.get_search_lists()[:5]
+            edges = range(edge_offsets[label.node], edge_offsets[label.node + 1])
+        else:
+            edge_target, edge_length, edge_source_slot, edge_target_slot = route.get_source_edges()
+            edges = range(len(edge_target))
+        self.settle()
+        self.relax_edges(route, label, edges, edge_target, edge_length, edge_source_slot, edge_target_slot,
+                         prioque, fronts)
+        return label
+
+    # queues the labels reached from label by the edges
+    def relax_edges(self, route, label, edges, edge_target, edge_length, edge_source_slot, edge_target_slot,
+                    prioque, fronts):
+        preceding_node = label.preceding_label.node if label.preceding_label else -1
+        heuristic = self.heuristic
+        targets = route.targets
+        for e in edges:
+            node = edge_target[e]
+            # no going backwards to node of previous label
+            if node == preceding_node:
+                continue
+            slot = edge_target_slot[e]
+            via_slot = edge_source_slot[e]
+            new_sms_character_count = self.get_new_character_count(route.graph, label, slot, via_slot)
+            new_distance = label.distance_from_A + edge_length[e]
+            # the neighbor's front may already dominate the new label, no need to queue it
+            neighbor_front = fronts[node]
+            if neighbor_front is not None and neighbor_front.is_dominated(
+                    new_distance, self.get_dominance_character_count(new_sms_character_count)):
+                self.dominated_label_count += 1
                 continue
-            new_sms_character_count = marking.sms_character_count
-            if not marking.preceding_way or self.should_write_line(ways[marking.preceding_way], ways[link['way']], node, nodes):
-                new_sms_character_count += constants.ITINERARY_BASE_DIRECTION_CHARACTER_COUNT
-                new_sms_character_count += min(
-                    constants.MAX_CHARS_PER_WAY,
-                    len(get_way_name(ways[link['way']])))
-            new_distance = marking.distance_from_A + link['distance']
             score = self.get_score(new_distance, new_sms_character_count)
-            new_marking = Marking(link['node']['id'], new_distance, new_sms_character_count, marking, link['way'])
-            prioque.put(PrioritizedItem(score, new_marking))
-        return marking
+            if heuristic is not None:
+                score += heuristic[node]
+            new_label = Label(node, new_distance, new_sms_character_count, label, slot, via_slot)
+            heapq.heappush(prioque, (score, next(self.tie_breaker), new_label))
+            self.pushed_label_count += 1
+            if node in targets:
+                self.queue_target_label(new_label, score)
 
-    def get_node_path(self, marking, nodes):
+    def get_label_path(self, label):
         path = []
-        current_node = nodes[marking.node_id]
-        i = 0
-        current_marking = marking
-        while current_node and 'isSource' not in current_node and i < 3000:
-            if current_marking.preceding_marking is None:
-                break
-            current_node = nodes[current_marking.preceding_marking.node_id]
-            current_marking = current_marking.preceding_marking
-            path.append(current_node)
-            i+=1 
-        if i == 3000:
-            print('big trouble, failed to reassemble path')
-        if 'isSource' not in current_node:
-            print('failed to reassemble path, could not find source')
-        print(f'path has length {len(path)}')
+        while label is not None:
+            path.append(label)
+            label = label.preceding_label
         return path[::-1]
 
-    def get_actual_directions(self, path, ways, nodes, pointA):
+    def get_actual_directions(self, route, path):
+        graph = route.graph
         directions = []
-        previous_node = pointA
-        previous_way = None
+        if len(path) < 2:
+            return directions
+        # the angles at all the points of the path are computed at once, the i-th one
+        # being the angle at the point before the node of path[i]
+        source_point = route.get_source_point(-1 - path[1].via_slot)
+        nodes = [label.node for label in path[1:]]
+        lats = np.concatenate([[route.pointA['lat'], source_point['lat']], graph.lats[nodes]])
+        lons = np.concatenate([[route.pointA['lon'], source_point['lon']], graph.lons[nodes]])
+        angles = get_angles(lats[:-2], lons[:-2], lats[1:-1], lons[1:-1], lats[2:], lons[2:]).tolist()
         for i in range(1, len(path)):
-            node1 = path[i-1]
-            node2 = path[i]
-            link = [n for n in node1['neighbors'] if n['node']['id'] == node2['id']][0]
-            way = ways[link['way']]
-            name = get_way_name(way)
-            if len(directions) == 0 or self.should_write_line(previous_way, way, node1, nodes, False):
-                angle = get_angle(previous_node, node1, node2)
+            way = graph.slot_way[path[i].slot]
+            distance = path[i].distance_from_A - path[i-1].distance_from_A
+            if len(directions) == 0 or self.should_write_line(graph, path[i-1].slot, path[i].via_slot, False):
+                angle = angles[i-1]
                 angle = (360 - angle) % 360
                 angle -= 180
-                directions.append({'way': name, 'angle': angle ,'distance': get_flying_distance(node1, node1)})
+                directions.append({'way': graph.way_names[way], 'angle': angle, 'distance': distance})
             else:
-                directions[-1]['distance'] += get_flying_distance(node1, node2)
-            previous_node = node1
-            previous_way = way
+                directions[-1]['distance'] += distance
         return directions
 
+    # the target is the node reached, one of route.targets
+    def get_itinerary(self, route, label):
+        distance = label.distance_from_A
+        path = self.get_label_path(label)
+        instrumentation.set_value('short sms itinerary' if self.force_short_sms else 'itinerary', {
+            'distance': distance,
+            'characters': label.sms_character_count,
+            'sms': get_required_sms_number(label.sms_character_count),
+            'labels': len(path)
+        })
+        return {
+            'distance': distance,
+            'directions': self.get_actual_directions(route, path),
+            'target': label.node
+        }
+
     def dijkstra(self, map_data, pointA, pointB):
-        elements = map_data['elements']
-        print('nb of elements is ' + str(len(elements)))
-        nodes = {x['id']: x for x in elements if x['type'] == 'node'}
-        print('nb of nodes is ' + str(len(nodes)))
-        ways = {x['id']: x for x in elements if x['type'] == 'way'}
-        print('nb of ways is ' + str(len(ways)))
-        source = self.compute_neighbors(nodes, ways, pointA, pointB)
-        for node in list(nodes.values()):
-            node['mark_ids'] = []
-        pointA['isSource'] = True
-        markings = {}
-        prioque = PriorityQueue()
-        first_marking = Marking(source['id'], 0, constants.ITINERARY_DISTANCE_CHARACTER_COUNT, None, None)
-        prioque.put(PrioritizedItem(0, first_marking))
-        while not prioque.empty():
-            marking = self.mark_next_point(nodes, ways, prioque, markings)
-            if marking and marking.node_id and 'isTarget' in nodes[marking.node_id]:
-                print('path was found')
-                distance = marking.distance_from_A
-                print(distance)
-                print(marking.sms_character_count, ' characters')
-                print(get_required_sms_number(marking.sms_character_count), ' is the required number of sms')
-                path = self.get_node_path(marking, nodes)
-                return {
-                    'distance': distance,
-                    'directions': self.get_actual_directions(path, ways, nodes, pointA)
-                }
-        print('Path not found')
+        return self.search(PreparedRoute.from_map_data(map_data, pointA, pointB))
+
+    # the queue and fronts are kept so that the search can be resumed on an extended route
+    def start_search(self, route):
+        fronts = [None] * route.graph.node_count
+        prioque = []
+        # labels with equal scores are popped in insertion order
+        self.tie_breaker = count()
+        self.heuristic = route.get_target_distances() if self.strategy == 'astar' else None
+        self.reset_label_counts()
+        first_label = Label(-1, 0, constants.ITINERARY_DISTANCE_CHARACTER_COUNT, None, -1, -1)
+        heapq.heappush(prioque, (0, next(self.tie_breaker), first_label))
+        self.search_state = (prioque, fronts, first_label)
+        return prioque, fronts
+
+    # Continues a search that found no path on route.graph, once the route has been extended
+    # with new ways: the labels settled at the nodes of the new edges, and the source for its new
+    # links, are expanded along them, then the search goes on. The target may have changed, and
+    # the queue still holds labels when the search stopped on its budget: with astar they are
+    # queued again with the heuristic of the extended route.
+    def resume_search(self, route):
+        prioque, fronts, first_label = self.search_state
+        self.reset_label_counts()
+        graph = route.graph
+        fronts.extend([None] * (graph.node_count - len(fronts)))
+        self.heuristic = route.get_target_distances() if self.strategy == 'astar' else None
+        if self.heuristic is not None and prioque:
+            prioque[:] = [(self.get_score(label.distance_from_A, label.sms_character_count)
+                           + (self.heuristic[label.node] if label.node >= 0 else 0), tie, label)
+                          for _, tie, label in prioque]
+            heapq.heapify(prioque)
+        edge_target, edge_length, edge_source_slot, edge_target_slot = graph.get_search_lists()[1:5]
+        new_edges = np.nonzero(graph.edge_way >= route.previous_way_count)[0]
+        new_edge_sources = graph.way_nodes[graph.edge_source_slot[new_edges]]
+        for e, node in zip(new_edges.tolist(), new_edge_sources.tolist()):
+            if node < len(fronts) and fronts[node] is not None:
+                for label in fronts[node].labels:
+                    self.relax_edges(route, label, [e], edge_target, edge_length, edge_source_slot,
+                                     edge_target_slot, prioque, fronts)
+        source_edges = route.get_source_edges()
+        self.relax_edges(route, first_label, range(route.previous_source_link_count, len(source_edges[0])),
+                         *source_edges, prioque, fronts)
+        # the targets may now be nodes that were settled, their labels are queued again to be popped as targets
+        for target in route.targets:
+            target_front = fronts[target]
+            if target_front is not None:
+                fronts[target] = None
+                for label in target_front.labels:
+                    score = self.get_score(label.distance_from_A, label.sms_character_count)
+                    heapq.heappush(prioque, (score, next(self.tie_breaker), label))
+        return prioque, fronts
+
+    def search(self, route):
+        if self.strategy == 'bidirectional':
+            return self.search_bidirectional(route)
+        if route.is_routable():
+            prioque, fronts = self.start_search(route)
+            return self.continue_search(route, prioque, fronts)
+        self.report_search(False)
         return {'distance': 0, 'directions': []}
+
+    # search on a route extended after this engine's search found no path on it
+    def resume(self, route):
+        if self.strategy == 'bidirectional' or self.search_state is None \
+                or not route.is_routable():
+            return self.search(route)
+        prioque, fronts = self.resume_search(route)
+        return self.continue_search(route, prioque, fronts)
+
+    def continue_search(self, route, prioque, fronts):
+        while prioque:
+            if self.is_over_budget():
+                self.report_search(self.best_target_label is not None)
+                return self.get_anytime_itinerary(route)
+            label = self.mark_next_point(route, prioque, fronts)
+            if label and label.node in route.targets:
+                self.report_search(True)
+                return self.get_itinerary(route, label)
+        self.report_search(False)
+        return {'distance': 0, 'directions': []}
+
+    # Dijkstra on the distance from the source and from the target at once, expanding the side
+    # with the smallest distance. Labels of the backward search are chained towards the target,
+    # their via_slot being the slot of the next node. It stops when no meeting node can give
+    # a shorter itinerary than the best one found.
+    def search_bidirectional(self, route):
+        if not route.is_routable():
+            self.report_search(False)
+            return {'distance': 0, 'directions': []}
+        graph = route.graph
+        edge_offsets, edge_target, edge_length, edge_source_slot, edge_target_slot = graph.get_search_lists()[:5]
+        source_target, source_length, source_source_slot, source_target_slot = route.get_source_edges()
+        self.tie_breaker = count()
+        self.reset_label_counts()
+        forward = [None] * graph.node_count
+        backward = [None] * graph.node_count
+        forward_queue = [(0, next(self.tie_breaker), Label(-1, 0, 0, None, -1, -1))]
+        # the backward search starts from all the targets at once
+        backward_queue = []
+        for target in route.targets:
+            backward[target] = Label(target, 0, 0, None, -1, -1)
+            backward_queue.append((0, next(self.tie_breaker), backward[target]))
+        best_distance = math.inf
+        meeting = None
+        while forward_queue and backward_queue:
+            if forward_queue[0][0] + backward_queue[0][0] >= best_distance:
+                break
+            # the best meeting found so far is a complete itinerary
+            if self.is_over_budget():
+                instrumentation.count('searches over budget')
+                break
+            is_forward = forward_queue[0][0] <= backward_queue[0][0]
+            prioque, labels, other_labels = (forward_queue, forward, backward) if is_forward \
+                else (backward_queue, backward, forward)
+            label = heapq.heappop(prioque)[2]
+            self.popped_label_count += 1
+            if label.node >= 0 and labels[label.node] is not label:
+                self.dominated_label_count += 1
+                continue
+            self.settle()
+            if label.node >= 0:
+                edges = range(edge_offsets[label.node], edge_offsets[label.node + 1])
+                targets, lengths, source_slots, target_slots = \
+                    edge_target, edge_length, edge_source_slot, edge_target_slot
+            else:
+                edges = range(len(source_target))
+                targets, lengths, source_slots, target_slots = \
+                    source_target, source_length, source_source_slot, source_target_slot
+            for e in edges:
+                node = targets[e]
+                new_distance = label.distance_from_A + lengths[e]
+                if labels[node] is not None and labels[node].distance_from_A <= new_distance:
+                    continue
+                # slot is always the slot of the label's node in the way of the edge
+                labels[node] = Label(node, new_distance, 0, label, target_slots[e], source_slots[e])
+                heapq.heappush(prioque, (new_distance, next(self.tie_breaker), labels[node]))
+                self.pushed_label_count += 1
+                if other_labels[node] is not None and \
+                        new_distance + other_labels[node].distance_from_A < best_distance:
+                    best_distance = new_distance + other_labels[node].distance_from_A
+                    meeting = (labels[node], other_labels[node]) if is_forward \
+                        else (other_labels[node], labels[node])
+        if meeting is None:
+            self.report_search(False)
+            return {'distance': 0, 'directions': []}
+        self.report_search(True)
+
+        # rebuild the forward labels with their character counts
+        path = self.get_label_path(meeting[0])
+        label = Label(-1, 0, constants.ITINERARY_DISTANCE_CHARACTER_COUNT, None, -1, -1)
+        for forward_label in path[1:]:
+            label = self.extend_label(graph, label, forward_label.node,
+                                      forward_label.distance_from_A - forward_label.preceding_label.distance_from_A,
+                                      forward_label.slot, forward_label.via_slot)
+        backward_label = meeting[1]
+        while backward_label.preceding_label is not None:
+            next_label = backward_label.preceding_label
+            label = self.extend_label(graph, label, next_label.node,
+                                      backward_label.distance_from_A - next_label.distance_from_A,
+                                      backward_label.via_slot, backward_label.slot)
+            backward_label = next_label
+        return self.get_itinerary(route, label)
+
+    def extend_label(self, graph, label, node, distance, slot, via_slot):
+        return Label(node, label.distance_from_A + distance,
+                     self.get_new_character_count(graph, label, slot, via_slot), label, slot, via_slot)
+
+    # Single search giving both the shortest itinerary and the one minimizing the score.
+    # The first target label popped minimizes the score, then we keep popping labels
+    # shorter than the shortest itinerary found so far: the score only bounds the distance
+    # from above, so any of them could still lead to a shorter itinerary.
+    def find_itineraries(self, route):
+        if self.strategy == 'bidirectional':
+            raise ValueError('bidirectional search only finds the shortest itinerary')
+        not_found = {'distance': 0, 'directions': []}
+        if not route.is_routable():
+            self.report_search(False)
+            return not_found, not_found
+        prioque, fronts = self.start_search(route)
+        return self.continue_itineraries(route, prioque, fronts)
+
+    # find_itineraries on a route extended after this engine's search found no path on it
+    def resume_itineraries(self, route):
+        if self.search_state is None or not route.is_routable():
+            return self.find_itineraries(route)
+        prioque, fronts = self.resume_search(route)
+        return self.continue_itineraries(route, prioque, fronts)
+
+    def continue_itineraries(self, route, prioque, fronts):
+        not_found = {'distance': 0, 'directions': []}
+        best_score_label = None
+        shortest_label = None
+        while prioque:
+            if self.is_over_budget():
+                return self.get_anytime_itineraries(route, best_score_label, shortest_label)
+            # with astar, the flying distance to the target is a lower bound of what is left to walk
+            next_label = prioque[0][2]
+            if shortest_label is not None and next_label.distance_from_A + \
+                    (self.heuristic[next_label.node] if self.heuristic is not None else 0) \
+                    >= shortest_label.distance_from_A:
+                heapq.heappop(prioque)
+                self.popped_label_count += 1
+                continue
+            label = self.mark_next_point(route, prioque, fronts)
+            if label and label.node in route.targets:
+                if best_score_label is None:
+                    best_score_label = label
+                if shortest_label is None or label.distance_from_A < shortest_label.distance_from_A:
+                    shortest_label = label
+        self.report_search(best_score_label is not None)
+        if best_score_label is None:
+            return not_found, not_found
+        # the shortest itinerary is written without merging lines of similar bearings
+        shortest = RoutingEngine(False, 0).get_itinerary(route, shortest_label)
+        return shortest, self.get_itinerary(route, best_score_label)
+
+    # find_itineraries stopped by the budget, the target labels settled are
+    # preferred to the ones only queued
+    def get_anytime_itineraries(self, route, best_score_label, shortest_label):
+        best_score_label = best_score_label or self.best_target_label
+        self.report_search(best_score_label is not None)
+        instrumentation.count('searches over budget')
+        candidates = [label for label in (shortest_label, self.shortest_target_label) if label is not None]
+        shortest_label = min(candidates, key=lambda label: label.distance_from_A) if candidates else None
+        if best_score_label is None:
+            shortest = self.get_fallback_engine().search(route)
+            return shortest, shortest
+        shortest = RoutingEngine(False, 0).get_itinerary(route, shortest_label)
+        return shortest, self.get_itinerary(route, best_score_label)
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import threading
+import time
+import requests
+
+from http_client import RETRY_STATUSES
+from instrumentation import count, phase
+from rate_limit import FileTokenBucket, TokenBucket
+import constants
+
+# Long messages are sent as numbered sms split on line boundaries, so that each part of an
+# itinerary reads on its own whatever the order they arrive in. The parts are sent concurrently
+# under a rate limit shared by all the messages of the processes, failed sends being retried.
+
+# characters of the default gsm alphabet, the extension ones take two characters
+GSM_CHARACTERS = set(
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM_EXTENSION_CHARACTERS = set('^{}\\[~]|€\f')
+
+# a message with a character out of the gsm alphabet is sent in ucs-2, with fewer characters per sms
+def is_gsm(text):
+    return all(c in GSM_CHARACTERS or c in GSM_EXTENSION_CHARACTERS for c in text)
+
+def get_sms_length(text):
+    if not is_gsm(text):
+        return len(text)
+    return len(text) + sum(1 for c in text if c in GSM_EXTENSION_CHARACTERS)
+
+def get_max_sms_length(text):
+    max_length = constants.MAX_SMS_CHARACTER_COUNT if is_gsm(text) else constants.MAX_UCS2_SMS_CHARACTER_COUNT
+    return max_length - constants.TWILIO_MESSAGE_CHARACTER_COUNT
+
+def get_part_header(index, part_count):
+    return f'({index}/{part_count})\n'
+
+# the lines of text grouped in parts of at most length characters, lines too long being cut
+def group_lines(lines, length):
+    parts = []
+    current = ''
+    for line in lines:
+        while get_sms_length(line) > length:
+            cut = length
+            while get_sms_length(line[:cut]) > length:
+                cut -= 1
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:cut])
+            line = line[cut:]
+        candidate = current + '\n' + line if current else line
+        if get_sms_length(candidate) <= length:
+            current = candidate
+        else:
+            parts.append(current)
+            current = line
+    if current:
+        parts.append(current)
+    return parts
+
+# Splits text in sms numbered (i/n), at most max_parts of them: the last part of
+# a longer message ends with ... instead of the lines that do not fit.
+def split_message(text, max_parts):
+    max_length = get_max_sms_length(text)
+    if get_sms_length(text) <= max_length:
+        return [text]
+    header_length = len(get_part_header(max_parts, max_parts))
+    parts = group_lines(text.split('\n'), max_length - header_length)
+    if len(parts) > max_parts:
+        count('sms parts dropped', len(parts) - max_parts)
+        last = parts[max_parts - 1]
+        while last and get_sms_length(last + '\n...') > max_length - header_length:
+            last = last[:last.rfind('\n')] if '\n' in last else last[:-1]
+        # when the ... leaves no room for any text, the last part is sent without it
+        parts = parts[:max_parts - 1] + [last + '\n...' if last else parts[max_parts - 1]]
+    return [get_part_header(i + 1, len(parts)) + part for i, part in enumerate(parts)]
+
+# connection failures and overloaded twilio servers are worth retrying, not rejected messages
+def is_retryable(error):
+    if isinstance(error, (OSError, requests.ConnectionError, requests.Timeout)):
+        return True
+    return getattr(error, 'status', None) in RETRY_STATUSES
+
+# Records the messages instead of sending them, for local testing without twilio credentials.
+class FakeTwilioClient:
+    class Messages:
+        def __init__(self):
+            self.sent = []
+
+        def create(self, from_, to, body):
+            self.sent.append({'from': from_, 'to': to, 'body': body})
+            print(f'sms to {to}:\n{body}')
+
+    def __init__(self):
+        self.messages = FakeTwilioClient.Messages()
+
+def make_twilio_client():
+    if os.environ.get('TWILIO_FAKE'):
+        return FakeTwilioClient()
+    from twilio.rest import Client
+    # Find these values at https://twilio.com/user/account
+    return Client(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'])
+
+# The client is made by make_client when the first sms is sent. limiter has an acquire
+# method called before each sms, a TokenBucket or a FileTokenBucket.
+class SmsSender:
+    def __init__(self, make_client, from_number, limiter, workers, retries, backoff, max_parts):
+        self.make_client = make_client
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.from_number = from_number
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sms')
+        self.retries = retries
+        self.backoff = backoff
+        self.max_parts = max_parts
+
+    def get_client(self):
+        with self.client_lock:
+            if self.client is None:
+                self.client = self.make_client()
+            return self.client
+
+    def send_part(self, body, destination):
+        client = self.get_client()
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                return client.messages.create(from_=self.from_number, to=destination, body=body)
+            except Exception as e:
+                if attempt == self.retries or not is_retryable(e):
+                    raise
+                print(f'sms to {destination} failed: {e}')
+                count('sms retries')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def split(self, text):
+        return split_message(text, self.max_parts) if text else []
+
+    # waits for all the parts to be sent, returns the outcome of each one:
+    # the message created by twilio or the error it failed with
+    def send_parts(self, parts, destination):
+        count('sms sent', len(parts))
+        with phase('twilio send'):
+            futures = [self.executor.submit(contextvars.copy_context().run, self.send_part, part, destination)
+                       for part in parts]
+            return [future.exception() or future.result() for future in futures]
+
+    # waits for all the parts to be sent, raises the error of the first part that failed
+    def send(self, text, destination):
+        outcomes = self.send_parts(self.split(text), destination)
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome
+        return outcomes
+
+# export SMS_RATE_LIMIT_PATH= to limit the rate of each process on its own,
+# export TWILIO_FAKE=1 to print the sms instead of sending them
+def make_sms_sender():
+    path = os.environ.get('SMS_RATE_LIMIT_PATH', constants.SMS_RATE_LIMIT_PATH)
+    limiter = FileTokenBucket(path, constants.SMS_SEND_RATE, constants.SMS_SEND_BURST) if path \
+        else TokenBucket(constants.SMS_SEND_RATE, constants.SMS_SEND_BURST)
+    return SmsSender(
+        make_twilio_client, os.environ.get('TWILIO_NUMBER'), limiter, constants.SMS_SEND_WORKERS,
+        constants.SMS_SEND_RETRIES, constants.SMS_SEND_RETRY_BACKOFF, constants.SMS_MAX_PARTS)
@@ -0,0 +1,130 @@
+import math
+import numpy as np
+from geometry_utils import get_flying_distances, get_distances_to_segments
+
+# km per degree of latitude, with the earth radius of get_flying_distance
+KM_PER_DEGREE = 6370 * math.pi / 180
+
+# the grid is a plane approximation of the sphere, ring distances are
+# multiplied by this before being compared to haversine distances
+RING_DISTANCE_MARGIN = 0.9
+
+# Uniform grid over segments given by the coordinates of their ends
+# (points are segments whose ends are equal). Each segment is registered
+# in all the cells its bounding box covers. Nearest neighbor queries look at
+# the cells ring by ring around the query point, so they only compute
+# exact distances for the segments of a few cells.
+class GridIndex:
+    def __init__(self, lats1, lons1, lats2, lons2, groups=None, items_per_cell=2):
+        self.lats1 = lats1
+        self.lons1 = lons1
+        self.lats2 = lats2
+        self.lons2 = lons2
+        self.groups = groups
+        self.is_point_index = np.array_equal(lats1, lats2) and np.array_equal(lons1, lons2)
+        self.cells = {}
+        if len(lats1) == 0:
+            self.cell_size = 1
+            return
+
+        self.reference_cos = math.cos(math.radians(float(np.mean(lats1))))
+        x1, y1 = self.get_plane_coordinates(lats1, lons1)
+        x2, y2 = self.get_plane_coordinates(lats2, lons2)
+        width = max(x1.max(), x2.max()) - min(x1.min(), x2.min())
+        height = max(y1.max(), y2.max()) - min(y1.min(), y2.min())
+        # in km, about items_per_cell items per cell if they were evenly spread
+        self.cell_size = max(0.01, math.sqrt(width * height * items_per_cell / len(lats1)))
+
+        cx0 = np.floor(np.minimum(x1, x2) / self.cell_size).astype(np.int64)
+        cx1 = np.floor(np.maximum(x1, x2) / self.cell_size).astype(np.int64)
+        cy0 = np.floor(np.minimum(y1, y2) / self.cell_size).astype(np.int64)
+        cy1 = np.floor(np.maximum(y1, y2) / self.cell_size).astype(np.int64)
+        widths = cx1 - cx0 + 1
+        counts = widths * (cy1 - cy0 + 1)
+        items = np.repeat(np.arange(len(lats1)), counts)
+        # rank of each repeated item among the cells of its bounding box
+        ranks = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells_x = cx0[items] + ranks % widths[items]
+        cells_y = cy0[items] + ranks // widths[items]
+        order = np.lexsort((cells_y, cells_x))
+        items = items[order]
+        cells_x = cells_x[order]
+        cells_y = cells_y[order]
+        # the cells of the index are all in these bounds
+        self.cell_bounds = (int(cx0.min()), int(cy0.min()), int(cx1.max()), int(cy1.max()))
+        starts = np.nonzero(np.concatenate([[True], (np.diff(cells_x) != 0) | (np.diff(cells_y) != 0)]))[0]
+        ends = np.append(starts[1:], len(items))
+        for start, end, cell_x, cell_y in zip(starts.tolist(), ends.tolist(),
+                                              cells_x[starts].tolist(), cells_y[starts].tolist()):
+            self.cells[(cell_x, cell_y)] = items[start:end]
+
+    def get_plane_coordinates(self, lats, lons):
+        return lons * self.reference_cos * KM_PER_DEGREE, lats * KM_PER_DEGREE
+
+    # the cells at distance r of the cell of the point, only those in the bounds of the index are looked up
+    def get_ring(self, cell_x, cell_y, r):
+        if r == 0:
+            cells = [(cell_x, cell_y)]
+        else:
+            min_x, min_y, max_x, max_y = self.cell_bounds
+            xs = range(max(cell_x - r, min_x), min(cell_x + r, max_x) + 1)
+            ys = range(max(cell_y - r + 1, min_y), min(cell_y + r - 1, max_y) + 1)
+            cells = [(x, y) for y in (cell_y - r, cell_y + r) if min_y <= y <= max_y for x in xs]
+            cells += [(x, y) for x in (cell_x - r, cell_x + r) if min_x <= x <= max_x for y in ys]
+        return [self.cells[cell] for cell in cells if cell in self.cells]
+
+    # returns the projections of point on the items and their distances to it
+    def get_distances(self, point, items):
+        if self.is_point_index:
+            lats = self.lats1[items]
+            lons = self.lons1[items]
+            return lats, lons, get_flying_distances(lats, lons, point['lat'], point['lon'])
+        return get_distances_to_segments(
+            point['lat'], point['lon'], self.lats1[items], self.lons1[items], self.lats2[items], self.lons2[items])
+
+    # Returns up to k (item, distance, projection) tuples sorted by distance, for the items
+    # closer than max_distance (in km) to point. With distinct_groups, at most one item
+    # per group is returned, for example one segment per way.
+    def nearest(self, point, k=1, max_distance=10, distinct_groups=False):
+        if not self.cells:
+            return []
+        x, y = self.get_plane_coordinates(point['lat'], point['lon'])
+        cell_x = int(math.floor(x / self.cell_size))
+        cell_y = int(math.floor(y / self.cell_size))
+        min_x, min_y, max_x, max_y = self.cell_bounds
+        # the rings before the first one are out of the bounds of the index, the last one covers them
+        first_ring = max(0, min_x - cell_x, cell_x - max_x, min_y - cell_y, cell_y - max_y)
+        last_ring = max(cell_x - min_x, max_x - cell_x, cell_y - min_y, max_y - cell_y)
+        seen = set()
+        candidates = []
+        r = first_ring
+        while True:
+            # an item is registered in all the cells its bounding box covers
+            new_items = list({item: None for cell_items in self.get_ring(cell_x, cell_y, r)
+                              for item in cell_items.tolist() if item not in seen})
+            if new_items:
+                seen.update(new_items)
+                items = np.array(new_items, dtype=np.int64)
+                lats, lons, distances = self.get_distances(point, items)
+                candidates += zip(distances.tolist(), items.tolist(), lats.tolist(), lons.tolist())
+            # nothing outside of the rings already seen is closer than this
+            ring_distance = r * self.cell_size * RING_DISTANCE_MARGIN
+            result = self.select(candidates, k, max_distance, distinct_groups)
+            # with fewer than k items or groups, the rings stop once they have seen them all
+            if (len(result) == k and result[-1][1] <= ring_distance) or ring_distance > max_distance \
+                    or r >= last_ring or len(seen) == len(self.lats1):
+                return result
+            r += 1
+
+    def select(self, candidates, k, max_distance, distinct_groups):
+        result = []
+        groups = set()
+        for distance, item, lat, lon in sorted(candidates):
+            if distance >= max_distance or len(result) == k:
+                break
+            if distinct_groups:
+                if self.groups[item] in groups:
+                    continue
+                groups.add(self.groups[item])
+            result.append((item, distance, {'lat': lat, 'lon': lon}))
+        return result
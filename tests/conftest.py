@@ -0,0 +1,55 @@
+import os
+import random
+import sys
+
+# the modules are imported without disk caches, regional graphs or weather credentials
+os.environ['MAP_TILE_CACHE_DIR'] = ''
+os.environ['REGIONAL_GRAPHS_DIR'] = ''
+os.environ['ITINERARY_CACHE_DATABASE'] = ''
+os.environ['ADDRESS_INDEX_PATH'] = ''
+os.environ.setdefault('WEATHER_TOKEN', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+# n x n nodes about 100m apart in Paris, joined by named streets of a few blocks along
+# both directions, some of them footways without name
+def make_grid_elements(n, seed, step=0.001, lat0=48.85, lon0=2.35):
+    rng = random.Random(seed)
+    elements = []
+    node_id = lambda i, j: 1000 + i * n + j
+    for i in range(n):
+        for j in range(n):
+            elements.append({'type': 'node', 'id': node_id(i, j),
+                             'lat': lat0 + i * step + rng.uniform(-step / 5, step / 5),
+                             'lon': lon0 + j * step + rng.uniform(-step / 5, step / 5)})
+    names = ['Rue A', 'Rue B', 'Avenue C', 'Boulevard D', 'Rue Eeeeeeeeeeeeeeeeeeeeeeee']
+    way_id = 1
+    for vertical in (False, True):
+        for i in range(n):
+            k = 0
+            while k < n - 1:
+                block = range(k, min(n - 1, k + rng.randint(1, 7)) + 1)
+                nodes = [node_id(j, i) if vertical else node_id(i, j) for j in block]
+                tags = {'highway': 'footway'} if vertical and rng.random() < 0.2 \
+                    else {'highway': 'residential', 'name': f'{rng.choice(names)} {"v" if vertical else "h"}{i}'}
+                elements.append({'type': 'way', 'id': way_id, 'nodes': nodes, 'tags': tags})
+                way_id += 1
+                k = block[-1]
+    return elements
+
+def make_points(count, seed, n, step=0.001, lat0=48.85, lon0=2.35):
+    rng = random.Random(seed)
+    size = (n - 1) * step
+    return [({'lat': lat0 + rng.uniform(0, size), 'lon': lon0 + rng.uniform(0, size)},
+             {'lat': lat0 + rng.uniform(0, size), 'lon': lon0 + rng.uniform(0, size)})
+            for _ in range(count)]
+
+@pytest.fixture(scope='session')
+def grid_graph():
+    from graph import Graph
+    return Graph.from_elements(make_grid_elements(25, 1))
+
+@pytest.fixture(scope='session')
+def grid_points():
+    return make_points(12, 2, 25)
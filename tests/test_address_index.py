@@ -0,0 +1,51 @@
+import address_index
+from address_index import AddressIndex, build_address_index
+import overpass_api
+
+elements = [
+    {'type': 'relation', 'id': 1, 'tags': {'name': 'Boulevard Saint-Michel'},
+     'members': [{'type': 'node', 'ref': 10}, {'type': 'way', 'ref': 5}]},
+    {'type': 'node', 'id': 10, 'lat': 48.85, 'lon': 2.34, 'tags': {'addr:housenumber': '12;14'}},
+    {'type': 'node', 'id': 11, 'lat': 48.86, 'lon': 2.35,
+     'tags': {'addr:housenumber': '3', 'addr:street': 'Rue de Rivoli'}},
+    # no street, not indexed
+    {'type': 'node', 'id': 12, 'lat': 48.87, 'lon': 2.36, 'tags': {'addr:housenumber': '7'}}
+]
+
+def make_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(overpass_api, 'query_overpass', lambda query: {'elements': elements})
+    path = str(tmp_path / 'address_index.npy')
+    build_address_index(['Paris'], path)
+    return AddressIndex.load(path)
+
+def test_lookup_finds_the_addresses_written_differently(tmp_path, monkeypatch):
+    index = make_index(tmp_path, monkeypatch)
+    assert len(index.records) == 3
+    assert list(index.records['key']) == sorted(index.records['key'])
+    assert index.lookup('14', 'bd saint michel', 'PARIS') == {'type': 'node', 'id': 10, 'lat': 48.85, 'lon': 2.34}
+    assert index.lookup(3, 'Rue de Rivoli', 'Paris')['id'] == 11
+
+def test_lookup_misses(tmp_path, monkeypatch):
+    index = make_index(tmp_path, monkeypatch)
+    assert index.lookup('5', 'Rue de Rivoli', 'Paris') is None
+    assert index.lookup('3', 'Rue de Rivoli', 'Dunkerque') is None
+    assert index.lookup('7', '', 'Paris') is None
+
+def test_street_location_falls_back_to_overpass(tmp_path, monkeypatch):
+    index = make_index(tmp_path, monkeypatch)
+    queried = []
+    def query_street_location(n, way, city):
+        queried.append((n, way, city))
+        return {'type': 'node', 'id': 99, 'lat': 48.9, 'lon': 2.4}
+    monkeypatch.setattr(overpass_api, 'offline_address_index', index)
+    monkeypatch.setattr(overpass_api, 'query_street_location', query_street_location)
+    overpass_api.street_location_cache.clear()
+    assert overpass_api.get_street_location('3', 'Rue de Rivoli', 'Paris')['id'] == 11
+    assert queried == []
+    assert overpass_api.get_street_location('5', 'Rue de Rivoli', 'Paris')['id'] == 99
+    assert queried == [('5', 'Rue de Rivoli', 'Paris')]
+    # then from the cache
+    assert overpass_api.get_street_location('5', 'rue de rivoli', 'paris')['id'] == 99
+    assert len(queried) == 1
+    assert address_index.get_address_key('5', 'rue de rivoli', 'paris') == \
+        address_index.get_address_key('5', 'Rue de Rivoli', 'Paris')
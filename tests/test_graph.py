@@ -0,0 +1,22 @@
+import numpy as np
+
+from conftest import make_grid_elements
+from graph import Graph
+
+def test_extend_ignores_the_nodes_already_known():
+    elements = make_grid_elements(6, seed=3)
+    nodes = [element for element in elements if element['type'] == 'node']
+    ways = [element for element in elements if element['type'] == 'way']
+    graph = Graph.from_elements(nodes[:20] + ways[:5])
+    extended = graph.extend(nodes + ways)
+    full = Graph.from_elements(elements)
+    assert extended.node_count == full.node_count == len(nodes)
+    assert sorted(extended.node_ids.tolist()) == sorted(full.node_ids.tolist())
+    assert extended.way_count == full.way_count
+
+def test_save_and_load(tmp_path):
+    graph = Graph.from_elements(make_grid_elements(6, seed=4))
+    graph.save(str(tmp_path))
+    loaded = Graph.load(str(tmp_path))
+    for name in Graph.SAVED_ARRAYS:
+        assert np.array_equal(getattr(loaded, name), getattr(graph, name))
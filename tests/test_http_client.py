@@ -0,0 +1,93 @@
+import json
+
+import pytest
+import requests
+
+import http_client
+from http_client import HttpClient, HttpError, iter_json_array, iter_response_array
+
+elements = [{'type': 'node', 'id': i, 'lat': 48.85 + i / 1000, 'lon': 2.35, 'tags': {'name': 'Rue Étienne [é]'}}
+            for i in range(50)]
+document = json.dumps({'version': 0.6, 'osm3s': {'copyright': '[odbl]'}, 'elements': elements, 'remark': 'x'}).encode()
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 1024, len(document)])
+def test_iter_json_array_parses_any_chunking(chunk_size):
+    assert list(iter_json_array(split(document, chunk_size), 'elements')) == elements
+
+def test_iter_json_array_without_the_key():
+    assert list(iter_json_array([b'{"remark": "runtime error"}'], 'elements')) == []
+
+def test_iter_json_array_empty_array():
+    assert list(iter_json_array(split(b'{"elements": [ ]}', 3), 'elements')) == []
+
+# the clock of http_client, moved only by the waits of the client and of the fake servers
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+    def monotonic(self):
+        return self.now
+    def sleep(self, delay):
+        self.now += delay
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(http_client, 'time', clock)
+    return clock
+
+class FakeResponse:
+    def __init__(self, status_code, chunks=(), clock=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.chunks = chunks
+        self.clock = clock
+        self.closed = False
+        self.headers = {}
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} error')
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            self.clock.sleep(0.1)
+            yield chunk
+    def close(self):
+        self.closed = True
+
+def test_retries_stop_at_the_timeout_of_the_call(monkeypatch, clock):
+    client = HttpClient(1, 10, 0.01)
+    timeouts = []
+    def get(url, params, stream, timeout):
+        timeouts.append(timeout)
+        clock.sleep(timeout)
+        raise requests.Timeout('read timeout')
+    monkeypatch.setattr(client.session, 'get', get)
+    with pytest.raises(HttpError):
+        client.get(['http://a', 'http://b'], timeout=0.3)
+    assert clock.now <= 0.3
+    assert len(timeouts) == 1
+    assert timeouts[0] == 0.3
+
+def test_the_timeout_bounds_reading_the_body(monkeypatch, clock):
+    client = HttpClient(1, 0, 0.01)
+    response = FakeResponse(200, split(document, 64), clock)
+    monkeypatch.setattr(client.session, 'get', lambda url, params, stream, timeout: response)
+    with pytest.raises(HttpError):
+        list(iter_response_array(client.get('http://a', timeout=1, stream=True), 'elements'))
+    assert clock.now < 1.2
+    assert response.closed
+
+def test_client_errors_close_the_response(monkeypatch):
+    client = HttpClient(1, 2, 0.01)
+    response = FakeResponse(404)
+    monkeypatch.setattr(client.session, 'get', lambda url, params, stream, timeout: response)
+    with pytest.raises(requests.HTTPError):
+        client.get('http://a', timeout=1)
+    assert response.closed
+
+def test_iter_json_array_gives_the_members_after_the_array():
+    following = {}
+    assert list(iter_json_array(split(document, 5), 'elements', following)) == elements
+    assert following == {'remark': 'x'}
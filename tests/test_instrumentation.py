@@ -0,0 +1,52 @@
+from fetch_pipeline import FetchPipeline
+import instrumentation
+from instrumentation import Metrics, count, phase, set_value, trace_request
+
+def test_traces_collect_the_phases_counters_and_values():
+    with trace_request('Walk from') as trace:
+        with phase('search'):
+            count('labels popped', 3)
+        count('labels popped')
+        set_value('graph', {'nodes': 4})
+        # the fetch threads record in the trace of the request they run for
+        pipeline = FetchPipeline()
+        pipeline.submit('map', count, 'bytes downloaded', 10)
+        pipeline.result('map', 5)
+    trace_dict = trace.to_dict()
+    assert trace_dict['kind'] == 'Walk from'
+    assert set(trace_dict['phases']) == {'search', 'map'}
+    assert trace_dict['counters'] == {'labels popped': 4, 'bytes downloaded': 10}
+    assert trace_dict['values'] == {'graph': {'nodes': 4}}
+    assert trace.duration >= trace_dict['phases']['search']
+
+def test_records_outside_of_a_request_are_ignored():
+    count('labels popped')
+    set_value('graph', {})
+    with phase('search'):
+        pass
+    assert instrumentation.get_current_trace() is None
+
+def test_metrics_aggregate_the_traces():
+    metrics = Metrics(2)
+    for duration in [1.0, 3.0, 2.0]:
+        with trace_request('Hello') as trace:
+            count('http requests', 2)
+        trace.duration = duration
+        trace.phases['geocode A'] = duration
+        metrics.record(trace)
+    snapshot = metrics.snapshot()
+    assert snapshot['requests'] == {'Hello': {'count': 3, 'mean_duration': 2.0}}
+    assert snapshot['phases'] == {'geocode A': {'count': 3, 'mean': 2.0, 'max': 3.0}}
+    assert snapshot['counters'] == {'http requests': 6}
+    assert [trace['duration'] for trace in snapshot['recent']] == [3.0, 2.0]
+
+def test_metrics_endpoint():
+    from app import app
+    with trace_request('Will it rain'):
+        count('http requests')
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    snapshot = response.get_json()
+    assert snapshot['requests']['Will it rain']['count'] >= 1
+    assert snapshot['counters']['http requests'] >= 1
+    assert snapshot['recent'][-1]['kind'] == 'Will it rain'
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from conftest import make_grid_elements
+import caching
+import itinerary_cache
+from itinerary_cache import ItineraryCache
+from map_tiles import TileStore, get_tile_index
+from regional_graph import RegionalGraph
+import overpass_api
+import regional_graph
+import routing
+
+# the clock of the cache and of its memory entries, moved by the tests
+class FakeTime:
+    def __init__(self):
+        self.now = 1000000.0
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(itinerary_cache, 'time', clock)
+    monkeypatch.setattr(caching, 'time', clock)
+    return clock
+
+def make_cache(tmp_path, versions, ttl=3600):
+    return ItineraryCache(str(tmp_path / 'itineraries.sqlite'), 10, ttl, 100,
+                          lambda source: versions.get(tuple(source)))
+
+def test_repeated_walks_are_answered_from_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, 'itinerary_cache', make_cache(tmp_path, {}))
+    walks = []
+    def find_walking_itinerary(*addresses):
+        walks.append(addresses)
+        return 'Distance 1km', []
+    monkeypatch.setattr(routing, 'find_walking_itinerary', find_walking_itinerary)
+    assert routing.get_walking_itinerary('5', 'Rue Étienne', 'Paris', '7', 'rue  de la paix', 'paris') == 'Distance 1km'
+    # written another way, the addresses are the same
+    assert routing.get_walking_itinerary('5', 'rue etienne', 'PARIS', '7', 'Rue de la Paix', 'Paris') == 'Distance 1km'
+    assert len(walks) == 1
+
+def test_walks_without_path_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, 'itinerary_cache', make_cache(tmp_path, {}))
+    walks = []
+    monkeypatch.setattr(routing, 'find_walking_itinerary', lambda *addresses: walks.append(addresses) or ('', []))
+    for _ in range(2):
+        assert routing.get_walking_itinerary('5', 'rue a', 'paris', '7', 'rue b', 'paris') == ''
+    assert len(walks) == 2
+
+def test_entries_expire(tmp_path, clock):
+    cache = make_cache(tmp_path, {}, ttl=60)
+    cache.put('walk', 'Distance 1km', [])
+    clock.now += 59
+    assert cache.get('walk') == 'Distance 1km'
+    clock.now += 2
+    assert cache.get('walk') is None
+    # nor are they read back from the database
+    assert make_cache(tmp_path, {}, ttl=60).get('walk') is None
+
+def test_entries_are_read_back_from_the_database(tmp_path):
+    sources = {('tile', 'filtered', 1, 2): 10.0}
+    make_cache(tmp_path, sources).put('walk', 'Distance 1km', [[['tile', 'filtered', 1, 2], 10.0]])
+    cache = make_cache(tmp_path, sources)
+    assert cache.get('walk') == 'Distance 1km'
+    sources[('tile', 'filtered', 1, 2)] = 11.0
+    assert cache.get('walk') is None
+    assert make_cache(tmp_path, sources).get('walk') is None
+
+def test_entries_are_dropped_when_a_tile_is_fetched_again(tmp_path, monkeypatch):
+    store = TileStore(str(tmp_path / 'tiles'), lambda layer, *bbox: iter(make_grid_elements(3, 1)), 0.005, 3600, 10 ** 9)
+    key = get_tile_index(48.851, 2.351, store.tile_size)
+    store.get_tiles('filtered', [key])
+    monkeypatch.setattr(overpass_api, 'tile_store', store)
+    cache = ItineraryCache(str(tmp_path / 'itineraries.sqlite'), 10, 3600, 100, routing.get_map_version)
+    source = ['tile', 'filtered', *key]
+    cache.put('walk', 'Distance 1km', [[source, routing.get_map_version(source)]])
+    assert cache.get('walk') == 'Distance 1km'
+    path = store.get_path('filtered', key)
+    fetched_at = os.stat(path).st_mtime + 10
+    os.utime(path, (fetched_at, fetched_at))
+    assert cache.get('walk') is None
+
+def test_entries_are_dropped_when_a_region_is_built_again(tmp_path, monkeypatch, grid_graph):
+    region = RegionalGraph('grid', [48.84, 2.34, 48.88, 2.38], grid_graph, None, built_at=100.0)
+    monkeypatch.setattr(regional_graph, 'regional_graphs', [region])
+    cache = ItineraryCache(str(tmp_path / 'itineraries.sqlite'), 10, 3600, 100, routing.get_map_version)
+    cache.put('walk', 'Distance 1km', [[['region', 'grid'], 100.0]])
+    assert cache.get('walk') == 'Distance 1km'
+    region.built_at = 200.0
+    assert cache.get('walk') is None
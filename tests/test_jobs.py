@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from jobs import InProcessBackend, Job, JobQueue, JobQueueFull, SQLiteBackend
+
+def wait_for_status(job_queue, job_id, statuses, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = job_queue.get_status(job_id)
+        if status['status'] in statuses:
+            return status
+        time.sleep(0.02)
+    raise AssertionError(f'job {job_id} still {status["status"]}')
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteBackend(str(tmp_path / 'jobs.sqlite'), 10, 3600, poll_interval=0.01)
+    return InProcessBackend(10)
+
+def test_failed_job_is_retried(backend):
+    calls = []
+    def flaky(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise OSError('network')
+        return x * 2
+    job_queue = JobQueue(backend, 1, 5, 1, 0)
+    job_queue.register('flaky', flaky)
+    status = wait_for_status(job_queue, job_queue.enqueue('flaky', 21), ['done', 'failed'])
+    assert status['status'] == 'done'
+    assert status['result'] == 42
+    assert calls == [21, 21]
+
+def test_job_not_retryable_runs_once(backend):
+    calls = []
+    def send(x):
+        calls.append(x)
+        raise OSError('twilio')
+    job_queue = JobQueue(backend, 1, 5, 3, 0)
+    job_queue.register('send', send, retryable=False)
+    status = wait_for_status(job_queue, job_queue.enqueue('send', 1), ['done', 'failed'])
+    assert status['status'] == 'failed'
+    assert calls == [1]
+
+def test_rejected_job_has_no_status():
+    backend = InProcessBackend(1)
+    backend.put(Job('f', []))
+    job = Job('f', [])
+    with pytest.raises(JobQueueFull):
+        backend.put(job)
+    assert backend.load(job.id) is None
+
+def test_finished_jobs_are_deleted_after_their_ttl(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'jobs.sqlite'), 10, 60)
+    old = Job('f', ['+33600000000'], status='done', created_at=time.time() - 120)
+    backend.put(old)
+    backend.put(Job('f', []))
+    assert backend.load(old.id) is None
+
+def test_stale_running_jobs_are_reset(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'jobs.sqlite'), 10, 3600)
+    reply = Job('reply', [], status='running', run_at=time.time() - 1000)
+    send = Job('send', [], status='running', run_at=time.time() - 1000)
+    recent = Job('reply', [], status='running')
+    for job in (reply, send, recent):
+        backend.put(job)
+    assert backend.reset_stale_jobs(time.time() - 100, {'reply'}) == 2
+    assert backend.load(reply.id).status == 'queued'
+    assert backend.load(send.id).status == 'failed'
+    assert backend.load(recent.id).status == 'running'
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from conftest import make_grid_elements
+from graph import Graph
+from map_tiles import TileBuilder, TileStore, get_tile_rectangles, get_tiles_covering
+
+TILE_SIZE = 0.005
+elements = make_grid_elements(25, 1)
+nodes = {element['id']: element for element in elements if element['type'] == 'node'}
+ways = [element for element in elements if element['type'] == 'way']
+
+# the ways with a node in the bounding box and all their nodes, like overpass
+def make_fetch(calls):
+    def fetch(layer, south, west, north, east):
+        calls.append((layer, south, west, north, east))
+        time.sleep(0.05)
+        selected = [way for way in ways if any(
+            south <= nodes[n]['lat'] <= north and west <= nodes[n]['lon'] <= east for n in way['nodes'])]
+        node_ids = {n for way in selected for n in way['nodes']}
+        return iter(selected + [nodes[n] for n in sorted(node_ids)])
+    return fetch
+
+def test_tile_rectangles():
+    assert get_tile_rectangles([]) == []
+    assert get_tile_rectangles([(0, 0), (0, 1), (1, 0), (1, 1)]) == [[(0, 0), (0, 1), (1, 0), (1, 1)]]
+    assert get_tile_rectangles([(0, 0), (5, 5)]) == [[(0, 0)], [(5, 5)]]
+    assert get_tile_rectangles([(0, 0), (0, 1), (1, 1), (2, 1)]) == [[(0, 0), (0, 1)], [(1, 1), (2, 1)]]
+
+def test_tiles_give_the_graph_of_the_bounding_box(tmp_path):
+    calls = []
+    store = TileStore(str(tmp_path), make_fetch(calls), TILE_SIZE, 3600, 10 ** 9)
+    bbox = (48.853, 2.353, 48.866, 2.366)
+    graph = Graph.from_elements(store.iter_elements('filtered', *bbox))
+    assert len(calls) == 1
+    # the whole tiles are read
+    expected = Graph.from_elements(make_fetch([])(*calls[0]))
+    assert graph.edge_count == expected.edge_count
+    # read from the disk the second time
+    store.memory_cache.clear()
+    assert Graph.from_elements(store.iter_elements('filtered', *bbox)).edge_count == expected.edge_count
+    assert len(calls) == 1
+
+def test_scattered_missing_tiles_are_fetched_by_rectangles(tmp_path):
+    calls = []
+    store = TileStore(str(tmp_path), make_fetch(calls), TILE_SIZE, 3600, 10 ** 9)
+    store.get_tiles('filtered', [(9770, 470)])
+    store.get_tiles('filtered', [(9773, 473)])
+    calls.clear()
+    list(store.iter_elements('filtered', 48.851, 2.351, 48.869, 2.369))
+    keys = get_tiles_covering(48.851, 2.351, 48.869, 2.369, TILE_SIZE)
+    fetched = [key for _, south, west, north, east in calls
+               for key in get_tiles_covering(south + 1e-9, west + 1e-9, north - 1e-9, east - 1e-9, TILE_SIZE)]
+    assert sorted(fetched) == sorted(set(keys) - {(9770, 470), (9773, 473)})
+
+def test_concurrent_requests_fetch_each_tile_once(tmp_path):
+    calls = []
+    store = TileStore(str(tmp_path), make_fetch(calls), TILE_SIZE, 3600, 10 ** 9)
+    errors = []
+    def get_map():
+        try:
+            list(store.iter_elements('filtered', 48.853, 2.353, 48.866, 2.366))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=get_map) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(calls) == 1
+    assert not [path for path in tmp_path.iterdir() if path.suffix == '.tmp']
+
+def test_tile_builder_drops_the_ways_with_missing_nodes():
+    builder = TileBuilder(TILE_SIZE)
+    for element in [{'type': 'way', 'id': 1, 'nodes': [10, 11], 'tags': {'highway': 'footway'}},
+                    {'type': 'way', 'id': 2, 'nodes': [11, 12], 'tags': {'highway': 'residential', 'name': 'Rue A'}},
+                    {'type': 'node', 'id': 11, 'lat': 48.851, 'lon': 2.351},
+                    {'type': 'node', 'id': 12, 'lat': 48.856, 'lon': 2.351}]:
+        builder.add(element)
+    tiles = builder.build([(9770, 470), (9771, 470), (0, 0)])
+    assert tiles[(9770, 470)]['way_ids'].tolist() == tiles[(9771, 470)]['way_ids'].tolist() == [2]
+    assert tiles[(9770, 470)]['node_ids'].tolist() == [11, 12]
+    assert tiles[(9770, 470)]['way_names'].tolist() == ['Rue A']
+    assert tiles[(0, 0)]['way_ids'].tolist() == []
+    assert TileBuilder(TILE_SIZE).build([(0, 0)])[(0, 0)]['way_offsets'].tolist() == [0]
+
+def test_tile_versions_are_read_without_loading_the_tiles(tmp_path, monkeypatch):
+    store = TileStore(str(tmp_path), make_fetch([]), TILE_SIZE, 3600, 10 ** 9)
+    tile = store.get_tiles('filtered', [(9770, 470)])[0]
+    assert store.get_tile_version('full', (9770, 470)) is None
+    version = store.get_tile_version('filtered', (9770, 470))
+    assert version == pytest.approx(float(tile['fetched_at']))
+    monkeypatch.setattr(store, 'load_tile', None)
+    assert store.get_tile_version('filtered', (9770, 470)) == version
+
+def test_reading_a_tile_keeps_its_version(tmp_path):
+    store = TileStore(str(tmp_path), make_fetch([]), TILE_SIZE, 3600, 10 ** 9)
+    store.get_tiles('filtered', [(9770, 470)])
+    version = store.get_tile_version('filtered', (9770, 470))
+    store.memory_cache.clear()
+    time.sleep(0.01)
+    store.load_tile('filtered', (9770, 470))
+    assert store.get_tile_version('filtered', (9770, 470)) == version
+
+def test_tiles_read_from_disk_expire_with_their_fetch_time(tmp_path):
+    store = TileStore(str(tmp_path), make_fetch([]), TILE_SIZE, 3600, 10 ** 9)
+    store.get_tiles('filtered', [(9770, 470)])
+    path = store.get_path('filtered', (9770, 470))
+    fetched_at = time.time() - 3000
+    with np.load(path) as data:
+        tile = {name: data[name] for name in data.files}
+    tile['fetched_at'] = np.array(fetched_at)
+    store.save_tile('filtered', (9770, 470), tile)
+    store.memory_cache.clear()
+    assert store.load_tile('filtered', (9770, 470)) is not None
+    _, expires_at = store.memory_cache.entries[('filtered', (9770, 470))]
+    assert expires_at == pytest.approx(fetched_at + 3600, abs=5)
+
+def test_memory_hits_count_as_accesses_of_the_files(tmp_path):
+    store = TileStore(str(tmp_path), make_fetch([]), TILE_SIZE, 3600, 10 ** 9)
+    store.get_tiles('filtered', [(9770, 470)])
+    path = store.get_path('filtered', (9770, 470))
+    version = store.get_tile_version('filtered', (9770, 470))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns))
+    store.load_tile('filtered', (9770, 470))
+    assert os.stat(path).st_atime > time.time() - 60
+    assert store.get_tile_version('filtered', (9770, 470)) == version
+
+def test_the_tiles_delta_holds_the_ways_missing_from_the_filtered_tiles(tmp_path, monkeypatch):
+    import overpass_api
+    fetch_all = make_fetch([])
+    # the filtered layer has the footways, which have no name
+    def fetch(layer, south, west, north, east):
+        return [element for element in fetch_all(layer, south, west, north, east)
+                if layer == 'full' or element['type'] == 'node' or 'name' not in element['tags']]
+    store = TileStore(str(tmp_path), fetch, TILE_SIZE, 3600, 10 ** 9)
+    monkeypatch.setattr(overpass_api, 'tile_store', store)
+    pointA, pointB = {'lat': 48.855, 'lon': 2.355}, {'lat': 48.865, 'lon': 2.365}
+    filtered = Graph.from_elements(overpass_api.iter_tiles_elements('filtered', pointA, pointB))
+    full = Graph.from_elements(overpass_api.iter_tiles_elements('full', pointA, pointB))
+    delta = overpass_api.get_delta_between_points(pointA, pointB)
+    assert sorted(delta.way_ids) == sorted(set(full.way_ids.tolist()) - set(filtered.way_ids.tolist()))
+    extended = filtered.merge(delta)
+    assert sorted(extended.way_ids.tolist()) == sorted(full.way_ids.tolist())
+    assert sorted(extended.node_ids.tolist()) == sorted(full.node_ids.tolist())
+    assert sorted(extended.way_names) == sorted(full.way_names)
@@ -0,0 +1,74 @@
+from concurrent.futures import wait
+import os
+
+import pytest
+
+from graph import PreparedRoute
+from parallel_routing import SearchRace, get_process_pool, search_region
+from regional_graph import ContractionHierarchy, RegionalGraph
+from routing_engine import RoutingEngine, SearchCancelled, get_required_sms_number
+import constants
+import routing
+
+@pytest.fixture(scope='module')
+def region(grid_graph, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('region'))
+    RegionalGraph('grid', [48.84, 2.34, 48.88, 2.38], grid_graph, ContractionHierarchy.build(grid_graph)).save(directory)
+    yield RegionalGraph.load(directory)
+    get_process_pool().shutdown()
+
+def search_in_process(region, pointA, pointB, preference):
+    return routing.make_engine(True, preference).search(PreparedRoute(region.graph, pointA, pointB))
+
+def test_searches_in_the_pool_match_the_searches_in_process(region, grid_points):
+    for pointA, pointB in grid_points[:3]:
+        race = SearchRace()
+        futures = [race.submit_regional_search(region, pointA, pointB, True, preference)
+                   for preference in constants.PARALLEL_SMS_PREFERENCES]
+        for preference, future in zip(constants.PARALLEL_SMS_PREFERENCES, futures):
+            expected = RoutingEngine(True, preference).search(PreparedRoute(region.graph, pointA, pointB))
+            assert future.result(timeout=60)['distance'] == pytest.approx(expected['distance'])
+
+def test_loaded_graphs_keep_their_slot_bearings(region, grid_graph):
+    assert region.graph.get_slot_bearings() == pytest.approx(grid_graph.get_slot_bearings(), nan_ok=True)
+
+# the message of one of the preferences, the best one unless it is already within a sms of the shortest
+def test_parallel_short_sms_routing_takes_the_best_message(region, grid_points):
+    for pointA, pointB in grid_points[:3]:
+        shortest_distance = region.search(PreparedRoute(region.graph, pointA, pointB))['distance']
+        scores = {}
+        for preference in constants.PARALLEL_SMS_PREFERENCES:
+            msg = routing.get_message_from_itinerary(search_in_process(region, pointA, pointB, preference))
+            scores[msg] = get_required_sms_number(len(msg)) * constants.SMS_TO_METER_PREFERENCE \
+                + search_in_process(region, pointA, pointB, preference)['distance']
+        msg = routing.parallel_short_sms_routing(region, pointA, pointB, shortest_distance)
+        assert msg in scores
+        assert scores[msg] <= max(min(scores.values()), constants.SMS_TO_METER_PREFERENCE + shortest_distance)
+
+def test_a_broken_pool_is_replaced(region, grid_points):
+    pointA, pointB = grid_points[0]
+    pool = get_process_pool()
+    # a process of the pool dies
+    wait([pool.submit(os._exit, 1)], timeout=60)
+    msg = routing.parallel_short_sms_routing(region, pointA, pointB, 0)
+    expected = search_in_process(region, pointA, pointB, constants.SMS_TO_METER_PREFERENCE)
+    assert msg == routing.get_message_from_itinerary(expected)
+    assert get_process_pool() is not pool
+    assert routing.parallel_short_sms_routing(region, pointA, pointB, 0)
+
+def test_cancelled_searches_stop(region, grid_points, tmp_path):
+    pointA, pointB = grid_points[0]
+    engine = RoutingEngine(True, 0.3)
+    engine.cancelled = lambda: True
+    with pytest.raises(SearchCancelled):
+        engine.search(PreparedRoute(region.graph, pointA, pointB))
+    cancel_path = str(tmp_path / 'cancel')
+    open(cancel_path, 'w').close()
+    assert search_region(cancel_path, region.directory, region.built_at, pointA, pointB, True, 0.3) is None
+
+def test_the_marker_of_a_cancelled_race_is_removed(region, grid_points):
+    race = SearchRace()
+    futures = [race.submit_regional_search(region, pointA, pointB, True, 0.3) for pointA, pointB in grid_points]
+    race.cancel()
+    wait(futures, timeout=60)
+    assert not os.path.exists(race.cancel_path)
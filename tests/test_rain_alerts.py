@@ -0,0 +1,39 @@
+import rain_alerts
+from rain_alerts import RainAlerts, SubscriptionStore
+
+def test_subscriptions(tmp_path):
+    store = SubscriptionStore(str(tmp_path / 'rain_alerts.sqlite'))
+    store.subscribe('+331', '59183')
+    store.subscribe('+331', '59183')
+    store.subscribe('+332', '59183')
+    store.subscribe('+331', '75056')
+    assert store.get_subscribers_by_insee() == {'59183': ['+331', '+332'], '75056': ['+331']}
+    assert store.unsubscribe('+331', '75056') == 1
+    assert store.unsubscribe('+331') == 1
+    assert store.get_subscribers_by_insee() == {'59183': ['+332']}
+
+def test_cycle_fetches_each_town_once(tmp_path, monkeypatch):
+    store = SubscriptionStore(str(tmp_path / 'rain_alerts.sqlite'))
+    for phone_number in ['+331', '+332', '+333']:
+        store.subscribe(phone_number, '59183')
+    store.subscribe('+331', '75056')
+    fetched = []
+    def get_rain_message(insee):
+        fetched.append(insee)
+        return 'probarain = 80 at 14:00' if insee == '59183' else ''
+    monkeypatch.setattr(rain_alerts, 'get_rain_message', get_rain_message)
+    sent = []
+    alerts = RainAlerts(store, lambda message, phone_number: sent.append(phone_number), 2)
+    assert alerts.run_cycle() == (2, 3)
+    assert sorted(fetched) == ['59183', '75056']
+    assert sorted(sent) == ['+331', '+332', '+333']
+
+def test_the_store_is_made_on_first_use(tmp_path, monkeypatch):
+    path = tmp_path / 'rain_alerts.sqlite'
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.setenv('RAIN_ALERTS_DATABASE', str(path))
+    monkeypatch.setattr(rain_alerts, 'subscription_store', None)
+    assert not path.exists()
+    store = rain_alerts.get_subscription_store()
+    assert path.exists()
+    assert rain_alerts.get_subscription_store() is store
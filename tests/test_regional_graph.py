@@ -0,0 +1,60 @@
+import heapq
+import json
+import math
+import random
+
+import pytest
+
+import overpass_api
+from regional_graph import ContractionHierarchy, RegionalGraph, build_regional_graph
+
+def get_distances(graph, source):
+    distances = {source: 0}
+    queue = [(0, source)]
+    while queue:
+        distance, node = heapq.heappop(queue)
+        if distance > distances[node]:
+            continue
+        for e in range(int(graph.edge_offsets[node]), int(graph.edge_offsets[node + 1])):
+            neighbor = int(graph.edge_target[e])
+            new_distance = distance + float(graph.edge_length[e])
+            if new_distance < distances.get(neighbor, math.inf):
+                distances[neighbor] = new_distance
+                heapq.heappush(queue, (new_distance, neighbor))
+    return distances
+
+def test_hierarchy_paths_are_shortest_paths(grid_graph):
+    region = RegionalGraph('grid', [48.84, 2.34, 48.88, 2.38], grid_graph, ContractionHierarchy.build(grid_graph))
+    rng = random.Random(3)
+    for _ in range(5):
+        source = rng.randrange(grid_graph.node_count)
+        distances = get_distances(grid_graph, source)
+        for target in rng.sample(range(grid_graph.node_count), 20):
+            path = region.hierarchy.search({source: 0}, target)
+            if target not in distances:
+                assert path is None
+                continue
+            assert path[0] == source and path[-1] == target
+            length = sum(float(grid_graph.edge_length[region.get_edge(u, v)]) for u, v in zip(path[:-1], path[1:]))
+            assert length == pytest.approx(distances[target])
+
+class FakeResponse:
+    deadline = None
+    def __init__(self, document):
+        self.document = document
+    def iter_content(self, chunk_size):
+        return [self.document[i:i + chunk_size] for i in range(0, len(self.document), chunk_size)]
+    def close(self):
+        pass
+
+def test_the_build_fails_on_a_partial_map(monkeypatch):
+    queries = []
+    def get(urls, params, timeout, stream):
+        queries.append(params['data'])
+        return FakeResponse(json.dumps({'elements': [{'type': 'node', 'id': 1, 'lat': 48.85, 'lon': 2.35}],
+                                        'remark': 'runtime error: Query timed out'}).encode())
+    monkeypatch.setattr(overpass_api, 'overpass_mode', 'live')
+    monkeypatch.setattr(overpass_api.default_client, 'get', get)
+    with pytest.raises(overpass_api.OverpassError):
+        build_regional_graph('grid', [48.84, 2.34, 48.88, 2.38])
+    assert '[timeout:' in queries[0] and '[maxsize:' in queries[0]
@@ -0,0 +1,69 @@
+import threading
+
+from conftest import make_grid_elements
+from graph import Graph, GraphBuilder
+import constants
+import routing
+
+pointA = {'lat': 48.851, 'lon': 2.351}
+pointB = {'lat': 48.862, 'lon': 2.362}
+
+def patch_fetches(monkeypatch, get_graph, get_delta):
+    monkeypatch.setattr(routing, 'get_street_location', lambda n, way, city: dict(pointA if n == 'A' else pointB))
+    monkeypatch.setattr(routing, 'find_regional_graph', lambda pointA, pointB: None)
+    monkeypatch.setattr(routing, 'get_graph_between_points', get_graph)
+    monkeypatch.setattr(routing, 'get_delta_between_points', get_delta)
+
+def test_the_full_map_is_only_fetched_when_no_path_is_found(monkeypatch, grid_graph):
+    fetched = []
+    patch_fetches(monkeypatch, lambda a, b: grid_graph, lambda a, b: fetched.append(a) or GraphBuilder())
+    monkeypatch.setattr(constants, 'SPECULATIVE_FULL_MAP_PREFETCH', False)
+    msg, _ = routing.find_walking_itinerary('A', 'x', 'Paris', 'B', 'y', 'Paris')
+    assert msg.startswith('Distance')
+    assert fetched == []
+
+def test_map_timeouts_answer_without_path(monkeypatch, grid_graph):
+    release = threading.Event()
+    def slow_graph(a, b):
+        release.wait(5)
+        return grid_graph
+    patch_fetches(monkeypatch, slow_graph, lambda a, b: GraphBuilder())
+    monkeypatch.setattr(constants, 'SPECULATIVE_FULL_MAP_PREFETCH', True)
+    monkeypatch.setattr(constants, 'MAP_TIMEOUT', 0.05)
+    try:
+        assert routing.find_walking_itinerary('A', 'x', 'Paris', 'B', 'y', 'Paris') == ('', [])
+    finally:
+        release.set()
+
+def test_poi_requests():
+    assert routing.parse_poi_request('Walk from 5 rue de rivoli, paris to nearest ATM ?') == \
+        ('5', 'rue de rivoli', 'paris', 'atm')
+    assert routing.parse_poi_request('Walk from 5 rue de rivoli, paris to the nearest sncf') == \
+        ('5', 'rue de rivoli', 'paris', 'sncf')
+    assert routing.parse_poi_request('Walk from 5 rue de rivoli, paris to atm') == ('5', 'rue de rivoli', 'paris', 'atm')
+    # an address in a street named after a kind is not a poi
+    assert routing.parse_poi_request('Walk from 5 rue de rivoli, paris to 5 rue atm, paris') is None
+    assert routing.parse_walking_request('Walk from 5 rue de rivoli, paris to 5 rue atm, paris') == \
+        ('5', 'rue de rivoli', 'paris', '5', 'rue atm', 'paris')
+    assert routing.parse_poi_request('Walk from 5 rue de rivoli, paris to nearest bakery') is None
+
+def test_the_walk_goes_to_the_closest_reachable_poi(monkeypatch):
+    # the rows of the grid are not connected to each other
+    elements = make_grid_elements(25, 1)
+    graph = Graph.from_elements([element for element in elements
+                                 if element['type'] == 'node' or ' h' in element['tags'].get('name', '')])
+    pointA = {'lat': 48.855, 'lon': 2.355}
+    pois = [{'lat': 48.8575, 'lon': 2.355, 'name': 'Across the rows'},
+            {'lat': 48.855, 'lon': 2.3605, 'name': 'Along the row'},
+            {'lat': 48.855, 'lon': 2.368, 'name': 'Further along the row'}]
+    monkeypatch.setattr(routing, 'get_street_location', lambda n, way, city: dict(pointA))
+    monkeypatch.setattr(routing, 'get_pois_around_point', lambda kind, point, radius: pois)
+    monkeypatch.setattr(routing, 'get_graph_around_point', lambda point, radius: graph)
+    msg = routing.get_walking_itinerary_to_poi('5', 'rue a', 'paris', 'atm')
+    assert msg.startswith('ATM Along the row\n')
+
+def test_walks_to_a_kind_without_poi_around_have_no_itinerary(monkeypatch, grid_graph):
+    monkeypatch.setattr(routing, 'get_street_location', lambda n, way, city: dict(pointA))
+    monkeypatch.setattr(routing, 'get_pois_around_point', lambda kind, point, radius: [])
+    monkeypatch.setattr(routing, 'get_graph_around_point', lambda point, radius: grid_graph)
+    assert routing.get_walking_itinerary_to_poi('5', 'rue a', 'paris', 'sncf') == ''
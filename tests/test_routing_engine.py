@@ -0,0 +1,137 @@
+import random
+
+import pytest
+
+from conftest import make_grid_elements
+from graph import Graph, PreparedRoute
+from routing_engine import ParetoFront, RoutingEngine, get_required_sms_number
+import constants
+
+def search(graph, pointA, pointB, force_short_sms, strategy):
+    preference = constants.SMS_TO_METER_PREFERENCE if force_short_sms else 0
+    return RoutingEngine(force_short_sms, preference, strategy).search(PreparedRoute(graph, pointA, pointB))
+
+def test_pareto_front_keeps_only_non_dominated_labels():
+    front = ParetoFront()
+    assert front.insert(2.0, 100)
+    assert front.insert(1.0, 200)
+    assert front.insert(3.0, 50)
+    assert not front.insert(2.5, 150)
+    assert not front.insert(2.0, 100)
+    # dominates (2.0, 100) and (3.0, 50)
+    assert front.insert(1.5, 50)
+    assert front.distances == [1.0, 1.5]
+    assert front.character_counts == [200, 50]
+    assert front.is_dominated(1.6, 60)
+    assert not front.is_dominated(0.5, 300)
+
+def test_required_sms_number():
+    available = constants.MAX_SMS_CHARACTER_COUNT - constants.TWILIO_MESSAGE_CHARACTER_COUNT
+    assert get_required_sms_number(available) == 1
+    assert get_required_sms_number(available + 1) == 2
+
+def test_short_sms_itinerary_is_never_shorter_than_the_shortest(grid_graph, grid_points):
+    for pointA, pointB in grid_points:
+        shortest = search(grid_graph, pointA, pointB, False, 'dijkstra')
+        short_sms = search(grid_graph, pointA, pointB, True, 'dijkstra')
+        assert short_sms['distance'] >= shortest['distance'] - 1e-9
+
+def test_combined_search_matches_the_separate_searches(grid_graph, grid_points):
+    for strategy in ['dijkstra', 'astar']:
+        for pointA, pointB in grid_points:
+            route = PreparedRoute(grid_graph, pointA, pointB)
+            shortest, short_sms = RoutingEngine(True, constants.SMS_TO_METER_PREFERENCE, strategy) \
+                .find_itineraries(route)
+            assert shortest['distance'] == pytest.approx(search(grid_graph, pointA, pointB, False, strategy)['distance'])
+            assert short_sms['distance'] == pytest.approx(search(grid_graph, pointA, pointB, True, strategy)['distance'])
+
+def test_plain_strategies_find_the_same_distance(grid_graph, grid_points):
+    for pointA, pointB in grid_points:
+        distances = [search(grid_graph, pointA, pointB, False, strategy)['distance']
+                     for strategy in ['dijkstra', 'astar', 'bidirectional']]
+        assert distances[0] > 0
+        assert distances[1] == pytest.approx(distances[0])
+        assert distances[2] == pytest.approx(distances[0])
+
+def test_astar_finds_the_short_sms_itinerary_of_dijkstra(grid_graph, grid_points):
+    for pointA, pointB in grid_points:
+        route = PreparedRoute(grid_graph, pointA, pointB)
+        results = []
+        for strategy in ['dijkstra', 'astar']:
+            engine = RoutingEngine(True, constants.SMS_TO_METER_PREFERENCE, strategy)
+            itinerary = engine.search(route)
+            results.append((itinerary['distance'], engine.settled_label_count))
+        assert results[1][0] == pytest.approx(results[0][0])
+        # the heuristic only prunes
+        assert results[1][1] <= results[0][1]
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        RoutingEngine(False, 0, 'bfs')
+    with pytest.raises(ValueError):
+        RoutingEngine(True, 0.3, 'bidirectional')
+
+def test_budget_returns_a_complete_itinerary(grid_graph, grid_points):
+    pointA, pointB = grid_points[0]
+    shortest = search(grid_graph, pointA, pointB, False, 'dijkstra')
+    # enough labels left for the fallback search
+    fallback = RoutingEngine(False, 0, 'bidirectional')
+    fallback.search(PreparedRoute(grid_graph, pointA, pointB))
+    label_budget = int(fallback.popped_label_count / constants.SEARCH_FALLBACK_BUDGET_SHARE) + 1
+    engine = RoutingEngine(True, constants.SMS_TO_METER_PREFERENCE, 'dijkstra', label_budget=label_budget)
+    itinerary = engine.search(PreparedRoute(grid_graph, pointA, pointB))
+    assert itinerary['distance'] >= shortest['distance'] - 1e-9
+    assert itinerary['directions']
+
+def test_fallback_search_gets_what_is_left_of_the_budget(grid_graph, grid_points):
+    pointA, pointB = grid_points[0]
+    engine = RoutingEngine(True, constants.SMS_TO_METER_PREFERENCE, 'dijkstra', label_budget=10)
+    engine.search(PreparedRoute(grid_graph, pointA, pointB))
+    assert engine.popped_label_count == 8
+    assert engine.get_fallback_engine().label_budget == 2
+    # stopped before meeting the other side, the bidirectional search has no itinerary
+    bidirectional = RoutingEngine(False, 0, 'bidirectional', label_budget=2)
+    assert bidirectional.search(PreparedRoute(grid_graph, pointA, pointB))['distance'] == 0
+    assert bidirectional.popped_label_count == 2
+
+# the grid with only the horizontal streets of its southern half, where the points of different
+# rows are not connected and the points of the northern half are snapped to other nodes
+@pytest.fixture(scope='module')
+def southern_graph():
+    elements = make_grid_elements(25, 1)
+    ways = [element for element in elements if element['type'] == 'way'
+            and ' h' in element['tags'].get('name', '') and int(element['tags']['name'].split(' h')[1]) < 12]
+    nodes = {node for way in ways for node in way['nodes']}
+    return Graph.from_elements([element for element in elements if element['id'] in nodes] + ways)
+
+@pytest.mark.parametrize('strategy', ['dijkstra', 'astar'])
+@pytest.mark.parametrize('label_budget', [None, 10])
+def test_resumed_searches_match_fresh_searches(southern_graph, strategy, label_budget):
+    elements = make_grid_elements(25, 1)
+    rng = random.Random(5)
+    for _ in range(8):
+        pointA = {'lat': 48.85 + rng.uniform(0, 0.01), 'lon': 2.35 + rng.uniform(0, 0.024)}
+        pointB = {'lat': 48.865 + rng.uniform(0, 0.008), 'lon': 2.35 + rng.uniform(0, 0.024)}
+        engine = RoutingEngine(False, 0, strategy, label_budget)
+        route = PreparedRoute(southern_graph, pointA, pointB)
+        assert engine.search(route)['distance'] == 0
+        # the resumed part runs without budget, to be compared with a complete search
+        engine.label_budget = None
+        extended = route.extend(southern_graph.extend(elements))
+        expected = RoutingEngine(False, 0, strategy).search(extended)
+        assert engine.resume(extended)['distance'] == pytest.approx(expected['distance'])
+
+def test_resumed_astar_queues_are_keyed_with_the_extended_route(southern_graph):
+    pointA = {'lat': 48.853, 'lon': 2.36}
+    pointB = {'lat': 48.87, 'lon': 2.365}
+    engine = RoutingEngine(False, 0, 'astar', 10)
+    route = PreparedRoute(southern_graph, pointA, pointB)
+    assert engine.search(route)['distance'] == 0
+    extended = route.extend(southern_graph.extend(make_grid_elements(25, 1)))
+    assert extended.target != route.target
+    prioque, _ = engine.resume_search(extended)
+    heuristic = extended.get_target_distances()
+    assert prioque
+    for score, _, label in prioque:
+        assert score == pytest.approx(engine.get_score(label.distance_from_A, label.sms_character_count)
+                                      + heuristic[label.node])
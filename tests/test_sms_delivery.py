@@ -0,0 +1,122 @@
+import pytest
+
+import rate_limit
+from rate_limit import FileTokenBucket, TokenBucket
+from sms_delivery import FakeTwilioClient, SmsSender, get_max_sms_length, get_sms_length, group_lines, is_gsm, \
+    split_message
+import constants
+
+def get_body(part):
+    return part.split('\n', 1)[1]
+
+def test_gsm_lengths():
+    assert is_gsm('Rue de la Paix 200m')
+    assert not is_gsm('Rue Œuf')
+    assert get_sms_length('a€b') == 4
+    assert get_sms_length('aŒb') == 3
+    assert get_max_sms_length('Œ') < get_max_sms_length('a')
+
+def test_group_lines_fills_parts_with_whole_lines():
+    assert group_lines(['aaa', 'bbb', 'cc'], 7) == ['aaa\nbbb', 'cc']
+    assert group_lines(['aaa', 'bbbb'], 7) == ['aaa', 'bbbb']
+
+def test_group_lines_cuts_lines_too_long():
+    assert group_lines(['a' * 10, 'b'], 4) == ['aaaa', 'aaaa', 'aa\nb']
+
+def test_group_lines_counts_extension_characters_twice():
+    assert group_lines(['€€€'], 4) == ['€€', '€']
+
+def test_short_message_is_sent_as_is():
+    assert split_message('Rue A 200m', 10) == ['Rue A 200m']
+
+def test_long_message_parts_are_numbered_and_fit():
+    lines = [f'Rue numero {i} 100m' for i in range(40)]
+    parts = split_message('\n'.join(lines), 10)
+    assert len(parts) > 1
+    for i, part in enumerate(parts):
+        assert part.startswith(f'({i + 1}/{len(parts)})\n')
+        assert get_sms_length(part) <= get_max_sms_length(part)
+    assert '\n'.join(get_body(part) for part in parts) == '\n'.join(lines)
+
+def test_message_longer_than_max_parts_ends_with_ellipsis():
+    lines = [f'Rue numero {i} 100m' for i in range(200)]
+    parts = split_message('\n'.join(lines), 3)
+    assert len(parts) == 3
+    assert parts[-1].endswith('\n...')
+    assert get_body(parts[-1]) != '\n...'
+    for part in parts:
+        assert get_sms_length(part) <= get_max_sms_length(part)
+
+def test_last_part_of_one_long_line_is_cut_before_the_ellipsis():
+    parts = split_message('x' * 1000, 2)
+    assert len(parts) == 2
+    assert get_body(parts[-1]).startswith('x')
+    assert get_sms_length(parts[-1]) <= get_max_sms_length(parts[-1])
+
+def test_last_part_is_never_only_the_ellipsis(monkeypatch):
+    # parts of 3 characters after the header leave no room for text next to the ...
+    monkeypatch.setattr(constants, 'TWILIO_MESSAGE_CHARACTER_COUNT', constants.MAX_SMS_CHARACTER_COUNT - 9)
+    parts = split_message('abc\ndef\nghi\njkl', 2)
+    assert len(parts) == 2
+    assert [get_body(part) for part in parts] == ['abc', 'def']
+    for part in parts:
+        assert get_sms_length(part) <= get_max_sms_length(part)
+
+def test_ucs2_message_uses_shorter_parts():
+    lines = [f'Œuvre numero {i}' for i in range(10)]
+    parts = split_message('\n'.join(lines), 10)
+    assert len(parts) > 1
+    for part in parts:
+        assert len(part) <= constants.MAX_UCS2_SMS_CHARACTER_COUNT - constants.TWILIO_MESSAGE_CHARACTER_COUNT
+
+@pytest.mark.parametrize('max_parts', [1, 2, 10])
+def test_split_message_respects_max_parts(max_parts):
+    parts = split_message('\n'.join(['y' * 50] * 100), max_parts)
+    assert len(parts) == max_parts
+
+class RejectedMessage(Exception):
+    status = 400
+
+def test_send_parts_gives_the_outcome_of_each_part():
+    client = FakeTwilioClient()
+    create = client.messages.create
+    def flaky_create(from_, to, body):
+        if body.startswith('(2/'):
+            raise RejectedMessage('rejected')
+        return create(from_, to, body)
+    client.messages.create = flaky_create
+    sender = SmsSender(lambda: client, '+33100000000', TokenBucket(1000, 1000), 2, 1, 0, 10)
+    parts = sender.split('\n'.join(f'line {i} ' + 'x' * 100 for i in range(3)))
+    outcomes = sender.send_parts(parts, '+33600000000')
+    assert len(outcomes) == len(parts) == 3
+    assert isinstance(outcomes[1], RejectedMessage)
+    assert [sms['body'] for sms in client.messages.sent] == [parts[0], parts[2]]
+    with pytest.raises(RejectedMessage):
+        sender.send('\n'.join(parts), '+33600000000')
+
+# the clock of rate_limit, moved only by its waits, which the threads of other tests do not move
+class FakeTime:
+    def __init__(self):
+        # binary fractions of seconds, so that the waits add up exactly
+        self.now = 1024.0
+        self.sleeps = []
+    def time(self):
+        return self.now
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+def test_file_token_bucket_is_shared(tmp_path, monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    path = str(tmp_path / 'sms_rate_limit')
+    buckets = [FileTokenBucket(path, 1, 2), FileTokenBucket(path, 1, 2)]
+    assert buckets[0].take() == 0
+    assert buckets[1].take() == 0
+    assert buckets[0].take() == 1
+    # a faster bucket on the same file waits for the token of its own rate
+    FileTokenBucket(path, 16, 2).acquire()
+    assert clock.sleeps == [1 / 16]
+    assert buckets[1].take() > 0
+    clock.now += 1
+    assert buckets[1].take() == 0
@@ -0,0 +1,57 @@
+import random
+
+import numpy as np
+
+from geometry_utils import get_distances_to_segments
+from spatial_index import GridIndex
+
+def make_segments(count, seed):
+    rng = random.Random(seed)
+    lats1 = np.array([48.85 + rng.uniform(0, 0.02) for _ in range(count)])
+    lons1 = np.array([2.35 + rng.uniform(0, 0.02) for _ in range(count)])
+    lats2 = lats1 + np.array([rng.uniform(-0.001, 0.001) for _ in range(count)])
+    lons2 = lons1 + np.array([rng.uniform(-0.001, 0.001) for _ in range(count)])
+    return lats1, lons1, lats2, lons2
+
+def test_nearest_segments_match_brute_force():
+    lats1, lons1, lats2, lons2 = make_segments(500, 1)
+    index = GridIndex(lats1, lons1, lats2, lons2)
+    rng = random.Random(2)
+    for _ in range(50):
+        # some of the points are out of the bounds of the index
+        point = {'lat': 48.84 + rng.uniform(0, 0.04), 'lon': 2.34 + rng.uniform(0, 0.04)}
+        _, _, distances = get_distances_to_segments(point['lat'], point['lon'], lats1, lons1, lats2, lons2)
+        expected = np.sort(distances)[:3]
+        found = [distance for _, distance, _ in index.nearest(point, 3)]
+        assert np.allclose(found, expected)
+
+def test_nearest_distinct_groups():
+    lats1, lons1, lats2, lons2 = make_segments(200, 3)
+    groups = np.arange(200) % 7
+    index = GridIndex(lats1, lons1, lats2, lons2, groups)
+    result = index.nearest({'lat': 48.86, 'lon': 2.36}, 5, distinct_groups=True)
+    assert len(result) == 5
+    assert len({groups[item] for item, _, _ in result}) == 5
+
+def test_nearest_stops_with_fewer_groups_than_asked():
+    # two parallel ways of 1000 nodes along a street, so that the cells are of the minimum size
+    lats = np.concatenate([np.full(1000, 48.85), np.full(1000, 48.85005)])
+    lons = np.concatenate([np.linspace(2.34, 2.36, 1000), np.linspace(2.34, 2.36, 1000)])
+    starts = np.r_[0:999, 1000:1999]
+    groups = np.repeat([0, 1], 999)
+    index = GridIndex(lats[starts], lons[starts], lats[starts + 1], lons[starts + 1], groups)
+    rings = []
+    get_ring = index.get_ring
+    def counted_get_ring(cell_x, cell_y, r):
+        rings.append(r)
+        return get_ring(cell_x, cell_y, r)
+    index.get_ring = counted_get_ring
+    result = index.nearest({'lat': 48.8501, 'lon': 2.351}, 3, distinct_groups=True)
+    assert sorted(groups[item] for item, _, _ in result) == [0, 1]
+    # the rings stop once they cover the bounds of the index
+    min_x, min_y, max_x, max_y = index.cell_bounds
+    assert len(rings) <= max(max_x - min_x, max_y - min_y) + 1
+
+def test_nearest_in_empty_index():
+    empty = np.array([])
+    assert GridIndex(empty, empty, empty, empty).nearest({'lat': 48.85, 'lon': 2.35}) == []
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+import threading
+
+import warmup
+from app import app
+
+def test_ready_answers_503_until_the_warm_up_has_run(monkeypatch):
+    monkeypatch.setattr(warmup, 'ready', threading.Event())
+    client = app.test_client()
+    assert client.get('/ready').status_code == 503
+    warmup.warm_up()
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.get_json() == {'ready': True}
+
+def test_importing_the_app_loads_neither_numpy_nor_requests():
+    output = subprocess.run(
+        [sys.executable, '-c', "import app, sys; print('numpy' in sys.modules, 'requests' in sys.modules)"],
+        capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['False', 'False']
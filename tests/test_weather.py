@@ -0,0 +1,34 @@
+import json
+import threading
+
+from weather import InseeCodes, get_request_town
+
+def test_insee_codes_are_saved_by_concurrent_writers(tmp_path):
+    path = str(tmp_path / 'insee_codes.json')
+    writers = [InseeCodes(path) for _ in range(4)]
+    errors = []
+    def learn(k):
+        try:
+            for i in range(20):
+                writers[k].put(f'town {k} {i}', str(k * 100 + i))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=learn, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with open(path) as json_file:
+        codes = json.load(json_file)
+    assert codes['paris'] == '75056'
+    assert [name for name in tmp_path.iterdir() if name.suffix == '.tmp'] == []
+    # the last writes of each writer are there
+    assert all(f'town {k} 19' in codes for k in range(4))
+    assert InseeCodes(path).get('Town 2 19') == '219'
+
+def test_request_town_is_given_as_written():
+    assert get_request_town('Subscribe rain at Dunkerque') == 'Dunkerque'
+    assert get_request_town('Subscribe rain in Paris 18') == 'Paris 18'
+    assert get_request_town('Will it rain in Dunkerque ?') == 'Dunkerque'
+    assert get_request_town('Subscribe rain') == ''
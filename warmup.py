@@ -0,0 +1,49 @@
+import mmap
+import threading
+import time
+
+# Work done once per process before serving, instead of on the first sms after a dyno boot:
+# importing the routing, weather and sms modules, reading the pages of the memory mapped regional
+# graphs and address index, and building the search lists and spatial indexes of the regional
+# graphs. With the preload_app of gunicorn.conf.py it runs in the master process before the
+# workers are forked, so they share what it loaded. Nothing here opens a connection or starts
+# a thread, which would not survive the fork: the http pools are created with the modules
+# but connect from the workers.
+# numpy is only imported by warm_up, so that the app can import this module to tell it is ready.
+
+ready = threading.Event()
+
+# every page of a memory mapped array is read once, so that it is in the page cache
+def touch(array):
+    import numpy as np
+    if isinstance(array, np.memmap) and array.size:
+        np.frombuffer(array, dtype=np.uint8)[::mmap.PAGESIZE].sum()
+
+def warm_up():
+    start = time.time()
+    import routing  # noqa: F401
+    import rain_alerts  # noqa: F401
+    import sms_delivery  # noqa: F401
+    from graph import Graph
+    from overpass_api import offline_address_index
+    from regional_graph import ContractionHierarchy, regional_graphs
+    if offline_address_index is not None:
+        touch(offline_address_index.records)
+    for region in regional_graphs:
+        for name in Graph.SAVED_ARRAYS:
+            touch(getattr(region.graph, name))
+        for name in ContractionHierarchy.SAVED_ARRAYS:
+            touch(getattr(region.hierarchy, name))
+        region.graph.get_search_lists()
+        region.graph.get_segment_index()
+        region.graph.get_node_index()
+    print(f'warmed up in {time.time() - start:.1f}s, {len(regional_graphs)} regional graphs')
+    ready.set()
+
+# under gunicorn, warm_up has run before the workers listen, the development server answers before
+def is_ready():
+    return ready.is_set()
+
+# for the development server, which answers while warming up
+def start_warm_up():
+    threading.Thread(target=warm_up, daemon=True, name='warm-up').start()
@@ -1,45 +1,129 @@
+import fcntl
+import json
 import os
 import re
-from contextlib import closing
-from urllib.request import urlopen
+import tempfile
+import threading
+import time
 import dateutil.parser
 
-import json
+from http_client import default_client
+from caching import LRUCache, SingleFlight
+import constants
 
 # see https://api.meteo-concept.com
 
-weather_token = os.environ['WEATHER_TOKEN']
-def get_rain_response(request):
-    insee = ''
-    matchObj = re.match( r'Will it rain at ([0-9]{5}) ?', request, re.M|re.I)
+# read when the api is called, the app can start without it
+def get_weather_token():
+    return os.environ['WEATHER_TOKEN']
+
+# Lowercase city names resolved to their insee code, saved to a json file as they are
+# learned. Paris and its arrondissements are known from the start.
+class InseeCodes:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.codes = {'paris': '75056'}
+        for arrondissement in range(1, 21):
+            self.codes[f'paris {arrondissement}'] = str(75100 + arrondissement)
+        if path and os.path.exists(path):
+            with open(path) as json_file:
+                self.codes.update(json.load(json_file))
+
+    def get(self, city):
+        return self.codes.get(city.lower())
+
+    def put(self, city, insee):
+        with self.lock:
+            self.codes[city.lower()] = insee
+            if not self.path:
+                return
+            # the processes take turns, each one keeping the codes learned by the others
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if os.path.exists(self.path):
+                    with open(self.path) as json_file:
+                        self.codes = {**json.load(json_file), **self.codes}
+                # written aside then renamed, so that a crash never leaves half a file
+                descriptor, temporary_path = tempfile.mkstemp(
+                    suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.path)))
+                try:
+                    with os.fdopen(descriptor, 'w') as outfile:
+                        json.dump(self.codes, outfile)
+                    os.replace(temporary_path, self.path)
+                except BaseException:
+                    os.remove(temporary_path)
+                    raise
+
+insee_codes = InseeCodes(os.environ.get('INSEE_CODES_PATH', constants.INSEE_CODES_PATH))
+forecast_cache = LRUCache(constants.FORECAST_CACHE_SIZE)
+# concurrent requests for the same town make a single call to the api
+upstream_calls = SingleFlight()
+
+def query_insee(city):
+    url = 'https://api.meteo-concept.com/api/location/cities'
+    print(url + '?search=' + city)
+    return str(default_client.get_json(
+        url, {'token': get_weather_token(), 'search': city}, constants.WEATHER_TIMEOUT)['cities'][0]['insee'])
+
+def get_insee(city):
+    insee = insee_codes.get(city)
+    if insee is None:
+        insee = upstream_calls.do('city ' + city.lower(), query_insee, city)
+        insee_codes.put(city, insee)
+    return insee
+
+def query_forecast(insee):
+    url = 'https://api.meteo-concept.com/api/forecast/nextHours'
+    return default_client.get_json(url, {'token': get_weather_token(), 'insee': insee}, constants.WEATHER_TIMEOUT)['forecast']
+
+# seconds until the next forecast is issued
+def get_forecast_ttl():
+    now = time.time()
+    return 3600 - (now - constants.FORECAST_ISSUE_DELAY) % 3600
+
+def get_forecast(insee):
+    forecast = forecast_cache.get(insee)
+    if forecast is None:
+        forecast = upstream_calls.do('forecast ' + insee, query_forecast, insee)
+        forecast_cache.put(insee, forecast, get_forecast_ttl())
+    return forecast
+
+# the insee code of the town in a request like 'Will it rain at Dunkerque', '' if none
+def get_request_insee(request):
+    matchObj = re.match( r'(?:Will it rain|Subscribe rain) (?:at|in) ([0-9]{5}) ?', request, re.M|re.I)
     if matchObj:
-        insee = matchObj.group(1)
-    if not insee:
-        matchObj = re.match( r'Will it rain at [Pp]aris ([0-9]{1,2}) ?', request, re.M|re.I)
-        if matchObj:
-            insee = int(matchObj.group(1)) + 75100
-    if not insee:
-        matchObj = re.match( r'Will it rain at (\w*) ?', request, re.M|re.I)
-        if matchObj:
-            city = matchObj.group(1)    
-            url = 'https://api.meteo-concept.com/api/location/cities?token={}&search={}'.format(weather_token, city)
-            print(url)
-            with closing(urlopen(url)) as f:
-                insee = json.loads(f.read())['cities'][0]['insee']
-    if not insee:
-        return ''
+        return matchObj.group(1)
+    matchObj = re.match( r'(?:Will it rain|Subscribe rain) (?:at|in) [Pp]aris ([0-9]{1,2}) ?', request, re.M|re.I)
+    if matchObj:
+        return str(int(matchObj.group(1)) + 75100)
+    matchObj = re.match( r'(?:Will it rain|Subscribe rain) (?:at|in) (\w*) ?', request, re.M|re.I)
+    if matchObj and matchObj.group(1):
+        return get_insee(matchObj.group(1))
+    return ''
+
+# the town of a request like 'Subscribe rain at Dunkerque' as the user wrote it
+def get_request_town(request):
+    matchObj = re.match(r'(?:Will it rain|Subscribe rain) (?:at|in) ([^?]*)', request, re.M|re.I)
+    return matchObj.group(1).strip() if matchObj else ''
+
+# the rain probabilities of the next hours, '' if it is not likely to rain
+def get_rain_message(insee):
     message = ''
     send = False
-    url = 'https://api.meteo-concept.com/api/forecast/nextHours?token={}&insee={}'.format(weather_token, insee)
-    with closing(urlopen(url)) as f:
-        forecast = json.loads(f.read())['forecast']
-        for f in forecast:
-            time = dateutil.parser.parse(f['datetime']).strftime('%H:%M  ')
-            message += '\n' + ('probarain = {} at {}'.format(f['probarain'], time)).strip()
-            if f['probarain'] >= 20:
-                send = True
+    forecast = get_forecast(insee)
+    for f in forecast:
+        time = dateutil.parser.parse(f['datetime']).strftime('%H:%M  ')
+        message += '\n' + ('probarain = {} at {}'.format(f['probarain'], time)).strip()
+        if f['probarain'] >= 20:
+            send = True
     if send:
         return message
     else:
         return ''
 
+def get_rain_response(request):
+    insee = get_request_insee(request)
+    if not insee:
+        return ''
+    return get_rain_message(insee)